@@ -0,0 +1,259 @@
+# チャートの処理とユーザーデータの読み書きのマイクロベンチマーク
+# Spotifyには接続せず、生成したデータで計測する
+#
+#   cd backend
+#   python -m scripts.benchmark --output before.json
+#   python -m scripts.benchmark --output after.json --compare before.json
+import datetime
+import json
+import logging
+import pathlib
+import platform
+import statistics
+import tempfile
+import timeit
+from dataclasses import dataclass, asdict
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import click
+
+from spotify import api, chart, data, response, user
+from spotify.service.user import select_playlist_uris
+
+CHART_SIZES = (200, 1000, 10000, 50000)
+BLOCK_SIZES = (0, 100, 1000, 10000)
+QUICK_CHART_SIZES = (200, 1000)
+QUICK_BLOCK_SIZES = (0, 100)
+
+CSV_HEADER = ",,Note that these figures are generated using a formula that" \
+             " protects against any artificial inflation of chart positions.,,\n" \
+             "Position,Track Name,Artist,Streams,URL\n"
+
+
+@dataclass()
+class Result:
+  name: str
+  params: Dict[str, object]
+  number: int
+  best: float
+  median: float
+
+  @property
+  def key(self) -> Tuple[str, str]:
+    return self.name, json.dumps(self.params, sort_keys=True)
+
+
+Case = Tuple[str, Dict[str, object], Callable[[], object]]
+
+
+def track_id(i: int) -> str:
+  return f"{i:022d}"
+
+
+def make_csv(size: int) -> str:
+  rows = [f'{i + 1},"Song {i}, part {i % 3}",Artist {i % (size // 3 + 1)},'
+          f'{1000000 - i},https://open.spotify.com/track/{track_id(i)}\n'
+          for i in range(size)]
+  return CSV_HEADER + ''.join(rows)
+
+
+def make_tracks(size: int) -> List[api.Track]:
+  artists = [api.Artist(f"artist{i}", f"Artist {i}")
+             for i in range(size // 3 + 1)]
+  tracks = []
+  for i in range(size):
+    track_artists = [artists[i % len(artists)]]
+    if i % 4 == 0:
+      # 共演(同じアーティストが重複することもある)
+      track_artists.append(artists[(i * 7) % len(artists)])
+    tracks.append(api.Track(track_id(i), f"Song {i}", 50, track_artists))
+  return tracks
+
+
+def make_user_data(index: chart.ChartIndex, blocks: int) -> user.UserData:
+  # 半分はチャートにある曲/アーティスト、残りはチャートにないもの
+  user_data = user.UserData()
+  user_data.profile = api.Profile('benchmark', 'benchmark', 'uri', 'JP')
+  tracks = [t.id for t in index.tracks[:blocks // 4]]
+  tracks += [f"missing{i}" for i in range(blocks // 2 - len(tracks))]
+  artists = [a.id for a in index.artists[:blocks // 4]]
+  artists += [f"missing{i}" for i in range(blocks - len(tracks) - len(artists))]
+  user_data.blocking_tracks = set(tracks)
+  user_data.blocking_artists = set(artists)
+  return user_data
+
+
+def chart_cases(
+  chart_sizes: Tuple[int, ...],
+  block_sizes: Tuple[int, ...],
+  directory: pathlib.Path
+) -> Iterator[Case]:
+  for size in chart_sizes:
+    text = make_csv(size)
+    content = text.encode('utf-8')
+    path = directory / f"chart-{size}.csv"
+    path.write_bytes(content)
+
+    def parse_download(content=content):
+      parser = data.ChartParser()
+      for i in range(0, len(content), data.CHUNK_SIZE):
+        parser.feed(content[i:i + data.CHUNK_SIZE])
+      return parser.close()
+
+    yield 'parse_chart_download', dict(size=size), parse_download
+    yield 'parse_chart_file', dict(size=size), \
+      lambda path=path: data.parse_chart_file(path)
+
+    tracks = make_tracks(size)
+    yield 'build_chart_index', dict(size=size), \
+      lambda tracks=tracks: chart.build_chart_index(tracks, 'v1')
+
+    index = chart.build_chart_index(tracks, 'v1')
+    for blocks in block_sizes:
+      user_data = make_user_data(index, blocks)
+      params = dict(size=size, blocks=blocks)
+      yield 'build_tracks_and_artists', params, \
+        lambda index=index, user_data=user_data: \
+          response.build_tracks_and_artists(index, user_data)
+      yield 'select_playlist_uris', params, \
+        lambda index=index, user_data=user_data: \
+          select_playlist_uris(index, user_data)
+
+    body = response.build_tracks_and_artists(index, make_user_data(index, 0))
+    yield 'compress_gzip', dict(size=size), \
+      lambda body=body: response.compress(body, response.GZIP)
+    if response.brotli is not None:
+      yield 'compress_brotli', dict(size=size), \
+        lambda body=body: response.compress(body, response.BROTLI)
+
+
+def user_cases(
+  block_sizes: Tuple[int, ...],
+  directory: pathlib.Path,
+  stores: List[user.UserStore]
+) -> Iterator[Case]:
+  index = chart.build_chart_index(make_tracks(max(block_sizes) or 1))
+  factories = {
+    'sqlite': lambda b: user.SqliteUserStore(directory / f'users-{b}.sqlite3'),
+    'json': lambda b: user.JsonUserStore(directory / f'users-{b}'),
+  }
+  for name, create_store in factories.items():
+    for blocks in block_sizes:
+      store = create_store(blocks)
+      stores.append(store)
+      user_data = make_user_data(index, blocks)
+      store.save(user_data)
+      # saveではブロックリストを書かないので、update_blockingで書く
+      store.update_blocking(
+        'benchmark', dict.fromkeys(user_data.blocking_tracks, True),
+        dict.fromkeys(user_data.blocking_artists, True))
+      params = dict(store=name, blocks=blocks)
+
+      def get_user_data(store=store):
+        user.set_store(store)
+        return user.get_user_data('benchmark')
+
+      def save(store=store, user_data=user_data):
+        # token更新などの保存(ブロックリストは書かない)を計測する
+        user.set_store(store)
+        user_data.save()
+
+      yield 'get_user_data', params, get_user_data
+      yield 'save_user_data', params, save
+
+
+def measure(fn: Callable[[], object], repeat: int) -> Tuple[int, float, float]:
+  timer = timeit.Timer(fn)
+  number, _ = timer.autorange()
+  times = [t / number for t in timer.repeat(repeat, number)]
+  return number, min(times), statistics.median(times)
+
+
+def compare(
+  baseline: List[Result],
+  results: List[Result],
+  threshold: float
+) -> List[Result]:
+  previous = {r.key: r for r in baseline}
+  regressions = []
+  for result in results:
+    if (old := previous.get(result.key)) is None:
+      continue
+    ratio = result.best / old.best
+    mark = ''
+    if ratio > threshold:
+      mark = '\tREGRESSION'
+      regressions.append(result)
+    click.echo(f"{result.name}\t{result.key[1]}\t{old.best * 1e3:.3f}ms"
+               f"\t{result.best * 1e3:.3f}ms\tx{ratio:.2f}{mark}")
+  return regressions
+
+
+def load_results(path: str) -> List[Result]:
+  with open(path, encoding='utf-8') as f:
+    return [Result(**r) for r in json.load(f)['results']]
+
+
+@click.command()
+@click.option('--output', type=click.Path(dir_okay=False),
+              help='Write results as JSON.')
+@click.option('--compare', 'baseline_path',
+              type=click.Path(exists=True, dir_okay=False),
+              help='Compare with a previous result file.')
+@click.option('--threshold', default=1.2, show_default=True,
+              help='Slowdown ratio reported as a regression.')
+@click.option('--quick', is_flag=True, help='Run small sizes only.')
+@click.option('--filter', 'pattern', help='Run benchmarks containing this.')
+@click.option('--repeat', default=5, show_default=True)
+def main(
+  output: Optional[str],
+  baseline_path: Optional[str],
+  threshold: float,
+  quick: bool,
+  pattern: Optional[str],
+  repeat: int
+):
+  chart_sizes = QUICK_CHART_SIZES if quick else CHART_SIZES
+  block_sizes = QUICK_BLOCK_SIZES if quick else BLOCK_SIZES
+  results = []
+  with tempfile.TemporaryDirectory() as tmp:
+    directory = pathlib.Path(tmp)
+    stores = []
+    cases = [*chart_cases(chart_sizes, block_sizes, directory),
+             *user_cases(block_sizes, directory, stores)]
+    # JsonUserStore.getなどが呼び出しごとにINFOのログを出すので、
+    # 計測中はログの出力を計らないように止めておく
+    user_logger = logging.getLogger(user.__name__)
+    level = user_logger.level
+    user_logger.setLevel(logging.WARNING)
+    try:
+      for name, params, fn in cases:
+        if pattern and pattern not in name:
+          continue
+        number, best, median = measure(fn, repeat)
+        result = Result(name, params, number, best, median)
+        results.append(result)
+        click.echo(f"{name}\t{result.key[1]}\tbest:{best * 1e3:.3f}ms"
+                   f"\tmedian:{median * 1e3:.3f}ms")
+    finally:
+      user_logger.setLevel(level)
+      user.set_store(None)
+      for store in stores:
+        store.close()
+
+  if output:
+    content = dict(
+      created_at=datetime.datetime.now().isoformat(timespec='seconds'),
+      python=platform.python_version(),
+      platform=platform.platform(),
+      results=[asdict(r) for r in results],
+    )
+    pathlib.Path(output).write_text(json.dumps(content, indent=2))
+
+  if baseline_path:
+    if compare(load_results(baseline_path), results, threshold):
+      raise SystemExit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,188 @@
+# アプリに対する負荷試験
+# N人のユーザーがログインし、一覧の取得、ミュートの切り替え、プレイリストの更新を繰り返す
+#
+#   cd backend
+#   python -m spotify.cli fake-server --port 8001 --latency 0.05 &
+#   SPOTIFY_ACCOUNTS_URL=http://127.0.0.1:8001 \
+#   SPOTIFY_API_URL=http://127.0.0.1:8001 \
+#   SPOTIFY_CHARTS_URL=http://127.0.0.1:8001 \
+#   SPOTIFY_DATA_DIR=/tmp/loadtest uvicorn spotify.app:app --port 8000 &
+#   python -m scripts.loadtest --users 50 --iterations 20
+import asyncio
+import json
+import pathlib
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import click
+import httpx
+
+
+@dataclass()
+class Stats:
+  latencies: Dict[str, List[float]] = field(default_factory=dict)
+  errors: Dict[str, int] = field(default_factory=dict)
+
+  def record(self, name: str, elapsed: float, ok: bool):
+    self.latencies.setdefault(name, []).append(elapsed)
+    if not ok:
+      self.errors[name] = self.errors.get(name, 0) + 1
+
+
+def percentile(values: List[float], p: float) -> float:
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class VirtualUser:
+
+  def __init__(self, client: httpx.AsyncClient, user_id: str, stats: Stats):
+    self.client = client
+    self.user_id = user_id
+    self.stats = stats
+    self.headers: Dict[str, str] = {}
+    self.etag: Optional[str] = None
+    self.tracks: List[dict] = []
+
+  async def call(self, name: str, method: str, url: str,
+                 headers: Optional[Dict[str, str]] = None,
+                 **kwargs) -> Optional[httpx.Response]:
+    started = time.perf_counter()
+    try:
+      r = await self.client.request(method, url,
+                                    headers={**self.headers, **(headers or {})},
+                                    **kwargs)
+    except httpx.HTTPError:
+      self.stats.record(name, time.perf_counter() - started, False)
+      return None
+    ok = r.status_code < 400
+    self.stats.record(name, time.perf_counter() - started, ok)
+    return r if ok else None
+
+  async def login(self) -> bool:
+    # フェイクサーバーはcodeをそのままユーザーidとして扱う
+    r = await self.call('login', 'GET', '/login/callback',
+                        params=dict(code=self.user_id, origin='http://loadtest'))
+    if r is None:
+      return False
+    self.headers['Authorization'] = f"Bearer {r.json()}"
+
+    r = await self.call('playlists', 'GET', '/playlists')
+    if r is None or not r.json():
+      return False
+    playlist_id = r.json()[0]['id']
+    return await self.call(
+      'set_playlist', 'POST', f'/playlists/{playlist_id}/set') is not None
+
+  async def browse(self):
+    headers = {'If-None-Match': self.etag} if self.etag else {}
+    r = await self.call('tracks_and_artists', 'GET', '/tracks_and_artists',
+                        headers=headers)
+    if r is None:
+      return
+    if r.status_code == 200:
+      self.etag = r.headers.get('ETag')
+      self.tracks = r.json()['tracks']
+
+  async def toggle_mute(self):
+    if not self.tracks:
+      return
+    track = random.choice(self.tracks)
+    track['blocked'] = not track['blocked']
+    await self.call('mute', 'PUT', f"/tracks/{track['id']}",
+                    json=dict(mute=track['blocked']))
+
+  async def run(self, iterations: int, think_time: float):
+    if not await self.login():
+      return
+    for _ in range(iterations):
+      await self.browse()
+      await self.toggle_mute()
+      await self.browse()
+      await self.call('replace_playlist', 'POST', '/replace_playlist')
+      if think_time:
+        await asyncio.sleep(random.uniform(0, think_time * 2))
+
+
+async def run(
+  app_url: str,
+  users: int,
+  iterations: int,
+  concurrency: int,
+  think_time: float,
+  timeout: float
+) -> Stats:
+  stats = Stats()
+  limits = httpx.Limits(max_connections=concurrency,
+                        max_keepalive_connections=concurrency)
+  async with httpx.AsyncClient(base_url=app_url, limits=limits,
+                               timeout=timeout) as client:
+    prefix = f"loadtest-{int(time.time())}"
+    await asyncio.gather(*[
+      VirtualUser(client, f"{prefix}-{i}", stats).run(iterations, think_time)
+      for i in range(users)
+    ])
+  return stats
+
+
+def summarize(stats: Stats, elapsed: float) -> dict:
+  operations = {}
+  for name, latencies in stats.latencies.items():
+    operations[name] = dict(
+      count=len(latencies),
+      errors=stats.errors.get(name, 0),
+      rps=len(latencies) / elapsed,
+      p50=percentile(latencies, 50),
+      p90=percentile(latencies, 90),
+      p99=percentile(latencies, 99),
+      max=max(latencies),
+    )
+  total = sum(len(v) for v in stats.latencies.values())
+  return dict(elapsed=elapsed, requests=total, rps=total / elapsed,
+              errors=sum(stats.errors.values()), operations=operations)
+
+
+@click.command()
+@click.option('--app-url', default='http://127.0.0.1:8000', show_default=True)
+@click.option('--users', default=10, show_default=True)
+@click.option('--iterations', default=10, show_default=True,
+              help='Browse/mute/replace rounds per user.')
+@click.option('--concurrency', default=100, show_default=True,
+              help='Maximum connections to the app.')
+@click.option('--think-time', default=0.0, show_default=True,
+              help='Average pause between rounds, in seconds.')
+@click.option('--timeout', default=30.0, show_default=True)
+@click.option('--output', type=click.Path(dir_okay=False),
+              help='Write the summary as JSON.')
+def main(
+  app_url: str,
+  users: int,
+  iterations: int,
+  concurrency: int,
+  think_time: float,
+  timeout: float,
+  output: Optional[str]
+):
+  started = time.perf_counter()
+  stats = asyncio.run(
+    run(app_url, users, iterations, concurrency, think_time, timeout))
+  summary = summarize(stats, time.perf_counter() - started)
+
+  for name, o in summary['operations'].items():
+    click.echo(f"{name}\tcount:{o['count']}\terrors:{o['errors']}"
+               f"\trps:{o['rps']:.1f}\tp50:{o['p50'] * 1000:.0f}ms"
+               f"\tp90:{o['p90'] * 1000:.0f}ms\tp99:{o['p99'] * 1000:.0f}ms"
+               f"\tmax:{o['max'] * 1000:.0f}ms")
+  click.echo(f"requests:{summary['requests']}\terrors:{summary['errors']}"
+             f"\trps:{summary['rps']:.1f}\telapsed:{summary['elapsed']:.1f}s")
+
+  if output:
+    pathlib.Path(output).write_text(json.dumps(summary, indent=2))
+  if summary['errors']:
+    raise SystemExit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -1,13 +1,32 @@
+import abc
+import asyncio
 import base64
 import logging
+import os
+import time
 from dataclasses import dataclass
 from typing import Optional, List
 from urllib.parse import urlencode
 
-import requests
+import httpx
+
+from spotify import tracing
+from spotify.http_client import HttpClient, parse_retry_after
 
 logger = logging.getLogger(__name__)
 
+# ローカルのフェイクサーバーなどに向けられるように、環境変数で変更できる
+ACCOUNTS_URL = os.environ.get('SPOTIFY_ACCOUNTS_URL') or \
+               "https://accounts.spotify.com"
+API_URL = os.environ.get('SPOTIFY_API_URL') or "https://api.spotify.com"
+
+# GET /v1/tracks で一度に指定できるidの上限
+MAX_SEVERAL_TRACKS = 50
+# GET /v1/me/playlists で一度に取得できる件数の上限
+MAX_PLAYLISTS_PER_PAGE = 50
+# プレイリストの残りのページを同時に取得する数
+PLAYLIST_PAGE_CONCURRENCY = 4
+
 
 class AuthorizationError(Exception):
   pass
@@ -25,6 +44,13 @@ class ApiError(Exception):
   pass
 
 
+class RateLimitError(ApiError):
+
+  def __init__(self, message: str, retry_after: Optional[float] = None):
+    super().__init__(message)
+    self.retry_after = retry_after
+
+
 @dataclass()
 class ClientCredentials:
   id: str
@@ -39,6 +65,11 @@ class ClientCredentialsFlowToken:
   access_token: str
   token_type: str
   expires_in: int
+  # 期限(unix time)。不明な場合は0で、期限切れとして扱う
+  expires_at: float = 0
+
+  def expires_within(self, seconds: float) -> bool:
+    return self.expires_at - time.time() <= seconds
 
 
 @dataclass()
@@ -48,6 +79,10 @@ class AuthorizationCodeFlowToken:
   scope: str
   expires_in: int
   refresh_token: str
+  expires_at: float = 0
+
+  def expires_within(self, seconds: float) -> bool:
+    return self.expires_at - time.time() <= seconds
 
 
 @dataclass(frozen=True)
@@ -78,7 +113,8 @@ def create_token_from_dict(o: dict) -> AuthorizationCodeFlowToken:
     o['token_type'],
     o['scope'],
     o['expires_in'],
-    o['refresh_token']
+    o['refresh_token'],
+    o.get('expires_at', 0),
   )
 
 
@@ -106,14 +142,16 @@ class Playlist:
   public: bool
   uri: str
   owner_id: str
+  snapshot_id: Optional[str] = None
 
 
-def fetch_token(
+async def fetch_token(
+  http_client: HttpClient,
   code: str,
   client_credentials: ClientCredentials,
   redirect_uri: str,
 ) -> AuthorizationCodeFlowToken:
-  url = f"https://accounts.spotify.com/api/token"
+  url = f"{ACCOUNTS_URL}/api/token"
 
   headers = dict(Authorization=f"Basic {client_credentials.get_basic_code()}")
   payload = dict(
@@ -121,14 +159,64 @@ def fetch_token(
     code=code,
     redirect_uri=redirect_uri,
   )
-  r = requests.post(url, data=payload, headers=headers)
+  r = await http_client.post(url, data=payload, headers=headers,
+                             endpoint='/api/token')
   validate_response(r)
   body = r.json()
+  body['expires_at'] = time.time() + body['expires_in']
   return create_token_from_dict(body)
 
 
-def validate_response(r: requests.Response):
-  if r.ok:
+async def fetch_client_credentials_token(
+  http_client: HttpClient,
+  client_credentials: ClientCredentials,
+) -> ClientCredentialsFlowToken:
+  payload = dict(grant_type='client_credentials')
+  headers = dict(Authorization=f"Basic {client_credentials.get_basic_code()}")
+
+  r = await http_client.post(f"{ACCOUNTS_URL}/api/token",
+                             data=payload, headers=headers)
+  validate_response(r)
+  data = r.json()
+  return ClientCredentialsFlowToken(
+    data['access_token'],
+    data['token_type'],
+    data['expires_in'],
+    time.time() + data['expires_in'],
+  )
+
+
+async def refresh_access_token(
+  http_client: HttpClient,
+  client_credentials: ClientCredentials,
+  refresh_token: str,
+) -> AuthorizationCodeFlowToken:
+  payload = dict(grant_type='refresh_token', refresh_token=refresh_token)
+  headers = dict(Authorization=f"Basic {client_credentials.get_basic_code()}")
+  with tracing.span('token_refresh'):
+    r = await http_client.post(f"{ACCOUNTS_URL}/api/token",
+                               data=payload, headers=headers)
+
+  # 429や5xxではrefresh_tokenが無効になったわけではない
+  if r.status_code == 429 or r.status_code >= 500:
+    validate_response(r)
+  if r.is_error:
+    raise AuthorizationError(r.json().get("error"))
+
+  data = r.json()
+  return AuthorizationCodeFlowToken(
+    data['access_token'],
+    data['token_type'],
+    data['scope'],
+    data['expires_in'],
+    # 新しいrefresh_tokenが返ってくることもある
+    data.get('refresh_token') or refresh_token,
+    time.time() + data['expires_in'],
+  )
+
+
+def validate_response(r: httpx.Response):
+  if not r.is_error:
     return
 
   if r.status_code == 401:
@@ -138,37 +226,40 @@ def validate_response(r: requests.Response):
       raise AccessTokenExpiredError(message)
     else:
       raise UnauthorizedError(message)
+  elif r.status_code == 429:
+    retry_after = parse_retry_after(r)
+    raise RateLimitError(f"{r.status_code}: retry after {retry_after}s",
+                         retry_after)
   else:
     raise ApiError(f"{r.status_code}: {r.text}")
 
 
+class ClientTokenProvider(abc.ABC):
+  # client credentialsのtokenを渡す(auth.TokenManager)
+
+  @abc.abstractmethod
+  async def get_client_token(self) -> ClientCredentialsFlowToken:
+    pass
+
+  @abc.abstractmethod
+  async def refresh_client_token(self) -> ClientCredentialsFlowToken:
+    pass
+
+
 @dataclass()
 class ApiClient:
-  __credentials: ClientCredentials
-  __token: ClientCredentialsFlowToken = None
+  __http_client: HttpClient
+  __token_provider: ClientTokenProvider
 
-  def _headers(self):
-    if self.__token is None:
-      self.refresh_token()
-    headers = dict(Authorization="Bearer " + self.__token.access_token)
+  async def _headers(self):
+    token = await self.__token_provider.get_client_token()
+    headers = dict(Authorization="Bearer " + token.access_token)
     return headers
 
-  def refresh_token(self) -> ClientCredentialsFlowToken:
-    payload = dict(grant_type='client_credentials')
-    headers = dict(Authorization=f"Basic {self.__credentials.get_basic_code()}")
+  async def refresh_token(self) -> ClientCredentialsFlowToken:
+    return await self.__token_provider.refresh_client_token()
 
-    r = requests.post('https://accounts.spotify.com/api/token', payload,
-                      headers=headers)
-    validate_response(r)
-    data = r.json()
-    self.__token = ClientCredentialsFlowToken(
-      data['access_token'],
-      data['token_type'],
-      data['expires_in']
-    )
-    return self.__token
-
-  def get_several_tracks(self,
+  async def get_several_tracks(self,
     ids: List[str],
     market: Optional[str] = None
   ) -> List[Track]:
@@ -176,16 +267,22 @@ class ApiClient:
     if market:
       params['market'] = market
 
-    r = requests.get(
-      f"https://api.spotify.com/v1/tracks?{urlencode(params)}",
-      headers=self._headers()
-    )
+    headers = await self._headers()
+    with tracing.span('get_tracks'):
+      r = await self.__http_client.get(
+        f"{API_URL}/v1/tracks?{urlencode(params)}",
+        headers=headers,
+        endpoint='/v1/tracks',
+      )
     validate_response(r)
     items = r.json()['tracks']
     logger.info("Fetched %d tracks", len(items))
 
     tracks = []
     for item in items:
+      # 存在しないidにはnullが返る
+      if item is None:
+        continue
       artists = [Artist(a['id'], a['name']) for a in item['artists']]
       tracks.append(
         Track(item['id'], item['name'], item['popularity'], artists=artists))
@@ -196,38 +293,27 @@ class ApiClient:
 @dataclass()
 class UserResourceApiClient:
   __credentials: ClientCredentials
+  __http_client: HttpClient
   __token: AuthorizationCodeFlowToken
 
   def _headers(self):
     headers = dict(Authorization="Bearer " + self.__token.access_token)
     return headers
 
-  def refresh_token(self) -> AuthorizationCodeFlowToken:
-    payload = dict(grant_type='refresh_token',
-                   refresh_token=self.__token.refresh_token)
-
-    headers = dict(Authorization=f"Basic {self.__credentials.get_basic_code()}")
-    r = requests.post(f"https://accounts.spotify.com/api/token", data=payload,
-                      headers=headers)
-
-    if not r.ok:
-      raise AuthorizationError(r.json().get("error"))
+  def set_token(self, token: AuthorizationCodeFlowToken):
+    self.__token = token
 
-    data = r.json()
-    token = AuthorizationCodeFlowToken(
-      data['access_token'],
-      data['token_type'],
-      data['scope'],
-      data['expires_in'],
-      self.__token.refresh_token
-    )
+  async def refresh_token(self) -> AuthorizationCodeFlowToken:
+    token = await refresh_access_token(
+      self.__http_client, self.__credentials, self.__token.refresh_token)
     self.__token = token
 
     return token
 
-  def get_current_user_profile(self) -> Optional[Profile]:
-    r = requests.get("https://api.spotify.com/v1/me",
-                     headers=self._headers())
+  async def get_current_user_profile(self) -> Optional[Profile]:
+    with tracing.span('get_profile'):
+      r = await self.__http_client.get(f"{API_URL}/v1/me",
+                                       headers=self._headers())
     validate_response(r)
 
     data = r.json()
@@ -235,22 +321,43 @@ class UserResourceApiClient:
       data.get('id'), data.get('display_name'), data.get('uri'),
       data.get('country'))
 
-  def get_current_user_playlists(self) -> List[Playlist]:
-    r = requests.get("https://api.spotify.com/v1/me/playlists",
-                     headers=self._headers())
-
+  async def __get_playlists_page(self, offset: int, limit: int) -> dict:
+    params = dict(offset=offset, limit=limit)
+    with tracing.span('get_playlists'):
+      r = await self.__http_client.get(
+        f"{API_URL}/v1/me/playlists?{urlencode(params)}",
+        headers=self._headers(),
+        endpoint='/v1/me/playlists',
+      )
     validate_response(r)
+    return r.json()
+
+  async def get_current_user_playlists(self,
+    limit: int = MAX_PLAYLISTS_PER_PAGE,
+    concurrency: int = PLAYLIST_PAGE_CONCURRENCY
+  ) -> List[Playlist]:
+    # 1ページ目で件数がわかるので、残りのページは同時にconcurrencyまで取得する
+    first = await self.__get_playlists_page(0, limit)
+    offsets = range(limit, first.get('total', 0), limit)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def get_page(offset: int) -> dict:
+      async with semaphore:
+        return await self.__get_playlists_page(offset, limit)
+
+    pages = await asyncio.gather(*[get_page(offset) for offset in offsets])
 
     playlists = []
-    for item in r.json()['items']:
-      playlists.append(Playlist(
-        item['id'], item['name'], item['public'], item['uri'],
-        item['owner']['id']
-      ))
+    for page in [first, *pages]:
+      for item in page['items']:
+        playlists.append(Playlist(
+          item['id'], item['name'], item['public'], item['uri'],
+          item['owner']['id'], item.get('snapshot_id')
+        ))
 
     return playlists
 
-  def change_playlist_details(self,
+  async def change_playlist_details(self,
     playlist_id: str,
     name: Optional[str] = None,
     public: Optional[bool] = None,
@@ -261,20 +368,96 @@ class UserResourceApiClient:
                    description=description)
     payload = {k: v for k, v in payload.items() if v is not None}
 
-    r = requests.put(
-      f"https://api.spotify.com/v1/playlists/{playlist_id}",
-      json=payload,
-      headers=self._headers()
-    )
+    with tracing.span('change_playlist_details'):
+      r = await self.__http_client.put(
+        f"{API_URL}/v1/playlists/{playlist_id}",
+        json=payload,
+        headers=self._headers(),
+        endpoint='/v1/playlists/{id}',
+      )
+    validate_response(r)
+
+  async def replace_playlist_items(self,
+    playlist_id: str,
+    uris: List[str]
+  ) -> str:
+    # URIはボディだけで送る(クエリに入れるとurl too longになる)
+    with tracing.span('replace_playlist_items'):
+      r = await self.__http_client.put(
+        f"{API_URL}/v1/playlists/{playlist_id}/tracks",
+        json=dict(uris=uris),
+        headers=self._headers(),
+        endpoint='/v1/playlists/{id}/tracks',
+      )
+    validate_response(r)
+
+    return r.json().get('snapshot_id')
+
+  async def get_playlist_snapshot_id(self, playlist_id: str) -> str:
+    with tracing.span('get_playlist'):
+      r = await self.__http_client.get(
+        f"{API_URL}/v1/playlists/{playlist_id}?fields=snapshot_id",
+        headers=self._headers(),
+        endpoint='/v1/playlists/{id}',
+      )
     validate_response(r)
 
-  def replace_playlist_items(self, playlist_id: str, uris: List[str]) -> str:
-    # urlencodeするとurl too longになる
-    uris = ','.join(uris)
+    return r.json()['snapshot_id']
+
+  async def add_playlist_items(self,
+    playlist_id: str,
+    uris: List[str],
+    position: Optional[int] = None
+  ) -> str:
     payload = dict(uris=uris)
+    if position is not None:
+      payload['position'] = position
+
+    with tracing.span('add_playlist_items'):
+      r = await self.__http_client.post(
+        f"{API_URL}/v1/playlists/{playlist_id}/tracks",
+        json=payload,
+        headers=self._headers(),
+        endpoint='/v1/playlists/{id}/tracks',
+      )
+    validate_response(r)
 
-    url = f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks?uris={uris}"
-    r = requests.put(url, json=payload, headers=self._headers())
+    return r.json().get('snapshot_id')
+
+  async def remove_playlist_items(self,
+    playlist_id: str,
+    uris: List[str]
+  ) -> str:
+    with tracing.span('remove_playlist_items'):
+      r = await self.__http_client.delete(
+        f"{API_URL}/v1/playlists/{playlist_id}/tracks",
+        json=dict(tracks=[dict(uri=uri) for uri in uris]),
+        headers=self._headers(),
+        endpoint='/v1/playlists/{id}/tracks',
+      )
+    validate_response(r)
+
+    return r.json().get('snapshot_id')
+
+  async def reorder_playlist_items(self,
+    playlist_id: str,
+    range_start: int,
+    insert_before: int,
+    range_length: int = 1
+  ) -> str:
+    payload = dict(range_start=range_start, insert_before=insert_before,
+                   range_length=range_length)
+
+    # 位置で指定する並べ替えは冪等でない。応答だけが失われたときに再送すると
+    # 別の曲が動くので、5xxや通信エラーでは再送しない
+    with tracing.span('reorder_playlist_items'):
+      r = await self.__http_client.put(
+        f"{API_URL}/v1/playlists/{playlist_id}/tracks",
+        json=payload,
+        headers=self._headers(),
+        endpoint='/v1/playlists/{id}/tracks',
+        retry=False,
+      )
     validate_response(r)
 
     return r.json().get('snapshot_id')
@@ -1,14 +1,20 @@
+import asyncio
+import datetime
 import logging
 import time
 import urllib.parse
+from typing import Optional, List, Dict
 
-import jwt
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Request, HTTPException, Depends, Header
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, Response, StreamingResponse
 from pydantic import BaseModel
 
-from spotify import data, api, service, user, config
+from spotify import data, api, service, user, config, metadata, cache, chart, \
+  auth, session, history, response, metrics, tracing, playlist, scheduler, \
+  events
+from spotify.http_client import HttpClient
 
 logger = logging.getLogger(__name__)
 
@@ -17,8 +23,19 @@ class PutTrack(BaseModel):
   mute: bool
 
 
-JWT_SECRET = config.get_jwt_secret()
-JWT_ALG = "HS256"
+class PutAutoRefresh(BaseModel):
+  enabled: bool
+
+
+class PostBlocking(BaseModel):
+  # id -> ミュートするかどうか
+  tracks: Dict[str, bool] = {}
+  artists: Dict[str, bool] = {}
+
+
+# 一度に変更できるミュートの件数
+MAX_BLOCKING_CHANGES = 1000
+
 
 REDIRECT_PATH = '/app/login/callback'
 SCOPES = [
@@ -28,12 +45,47 @@ SCOPES = [
 ]
 
 client_credentials = config.get_client_credentials()
-ranking_client = data.RankingClient()
-api_client = api.ApiClient(client_credentials)
-ranking_service = service.RankingService(api_client, ranking_client)
+http_client = HttpClient(config.get_http_settings())
+ranking_clients = data.RankingClients(
+  http_client, config.get_chart_max_age(), config.get_data_dir(),
+  [data.ChartKey(region, period)
+   for region in config.get_chart_regions() for period in data.PERIODS])
+token_manager = auth.TokenManager(client_credentials, http_client,
+                                  config.get_token_refresh_margin())
+api_client = api.ApiClient(http_client, token_manager)
+track_store = metadata.TrackStore(
+  config.get_data_dir() / 'tracks.sqlite3', config.get_track_ttl())
+event_hub = events.EventHub()
+
+
+def publish_chart_update(chart_key: data.ChartKey, index: chart.ChartIndex):
+  event_hub.publish_chart(chart_key,
+                          events.chart_event(chart_key, index.version))
+
+
+ranking_service = service.RankingService(
+  api_client, ranking_clients, track_store, config.get_hydrate_concurrency(),
+  publish_chart_update)
+response_cache = cache.ResponseCache()
+playlists_cache = cache.TtlCache(ttl=config.get_playlists_cache_ttl(),
+                                 name='playlists')
+history_store = history.HistoryStore(config.get_data_dir() / 'history')
+playlist_store = playlist.PlaylistStore(
+  config.get_data_dir() / 'playlists.sqlite3')
+session_manager = session.SessionManager(config.get_jwt_secret(),
+                                         config.get_session_ttl())
 
 app = FastAPI()
 
+app.add_middleware(metrics.MetricsMiddleware)
+
+profiler = None
+if config.get_profile_sample_rate() > 0:
+  profiler = tracing.Profiler(config.get_profile_dir(),
+                              config.get_profile_threshold(),
+                              config.get_profile_sample_rate())
+app.add_middleware(tracing.TracingMiddleware, profiler=profiler)
+
 app.add_middleware(
   CORSMiddleware,
   allow_credentials=True,
@@ -43,42 +95,114 @@ app.add_middleware(
 )
 
 
+def collect_chart_ages():
+  now = time.time()
+  clients = [ranking_clients.get(key) for key in ranking_clients.keys]
+  return {(str(c.key),): now - c.fetched_at for c in clients if c.fetched_at}
+
+
+metrics.REGISTRY.register(metrics.Gauge(
+  'spotify_chart_age_seconds',
+  'Seconds since the chart was last confirmed with Spotify.',
+  ('chart',), collect=collect_chart_ages))
+
+
+async def list_auto_refresh_users() -> List[str]:
+  # ストアの読み込みはブロックするので、イベントループの外で実行する
+  return await run_in_threadpool(user.list_auto_refresh_profile_ids)
+
+
+async def refresh_user_playlist(
+  profile_id: str,
+  chart_key: data.ChartKey = data.DEFAULT_CHART_KEY
+):
+  # 結果は、開いているタブにSSEで知らせる
+  try:
+    await get_api_service(profile_id).replace_playlist(chart_key=chart_key)
+  except Exception as e:
+    event_hub.publish(profile_id, events.playlist_event(chart_key, e))
+    raise
+  event_hub.publish(profile_id, events.playlist_event(chart_key))
+
+
+scheduler_settings = config.get_scheduler_settings()
+job_store = scheduler.JobStore(config.get_data_dir() / 'scheduler.sqlite3')
+refresh_scheduler = scheduler.RefreshScheduler(
+  ranking_service, job_store, list_auto_refresh_users, refresh_user_playlist,
+  settings=scheduler_settings)
+scheduler_task: Optional[asyncio.Task] = None
+
+
+@app.on_event("startup")
+async def startup():
+  global scheduler_task
+  if scheduler_settings.interval > 0:
+    scheduler_task = asyncio.create_task(refresh_scheduler.run_forever())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+  if scheduler_task is not None:
+    scheduler_task.cancel()
+    await asyncio.gather(scheduler_task, return_exceptions=True)
+  await http_client.aclose()
+  track_store.close()
+  history_store.close()
+  playlist_store.close()
+  job_store.close()
+  user.get_store().close()
+
+
 def intersect(a, b):
   return set(a).intersection(b)
 
 
-def get_user_resource_api_client(profile_id: str) -> api.UserResourceApiClient:
-  user_data = user.get_user_data(profile_id)
+def get_user_resource_api_client(
+  user_data: user.UserData
+) -> api.UserResourceApiClient:
   if not user_data.token:
     raise Exception('tokenがありません')
 
-  return api.UserResourceApiClient(client_credentials, user_data.token)
+  return api.UserResourceApiClient(client_credentials, http_client,
+                                   user_data.token)
 
 
 def get_api_service(profile_id: str) -> service.UserService:
+  with tracing.span('user_load'):
+    user_data = user.get_user_data(profile_id)
   return service.UserService(
-    user.get_user_data(profile_id),
-    get_user_resource_api_client(profile_id),
-    ranking_service)
+    user_data,
+    get_user_resource_api_client(user_data),
+    ranking_service,
+    token_manager,
+    playlist_store,
+    playlists_cache)
 
 
-def get_profile_id_from(request: Request) -> str:
-  token: str = request.headers.get("Authorization")
-  if not token:
+def get_bearer_token(authorization: Optional[str] = Header(None)) -> str:
+  if not authorization:
     logger.warning("No required header given")
     raise HTTPException(status_code=400, detail="No required header given")
-  if not token.startswith("Bearer "):
+  if not authorization.startswith("Bearer "):
     logger.warning("Header format was wrong")
     raise HTTPException(status_code=400, detail="Header format was wrong")
-  token = token.split(" ")[-1]
+  return authorization.split(" ")[-1]
+
+
+def get_chart_key(region: str = 'jp', period: str = 'daily') -> data.ChartKey:
+  key = data.ChartKey(region.lower(), period.lower())
+  if key not in ranking_clients.keys:
+    raise HTTPException(status_code=404, detail=f"Unknown chart: {key}")
+  return key
+
+
+def get_session(token: str = Depends(get_bearer_token)) -> session.Session:
   try:
-    session = jwt.decode(token, JWT_SECRET, [JWT_ALG])
-  except Exception as e:
+    with tracing.span('jwt'):
+      return session_manager.verify(token)
+  except session.SessionError as e:
     logger.error(e)
     raise HTTPException(status_code=403, detail=str(e))
-  profile_id = session.get("sub")
-
-  return profile_id
 
 
 @app.get("/")
@@ -86,77 +210,213 @@ async def home():
   return RedirectResponse("/app")
 
 
-@app.get("/tracks_and_artists")
-async def tracks_and_artists(request: Request):
-  profile_id = get_profile_id_from(request)
-  user_data = user.get_user_data(profile_id)
-  tracks = ranking_service.get_tracks()
+@app.get("/metrics")
+async def get_metrics():
+  return Response(metrics.REGISTRY.render(),
+                  media_type='text/plain; version=0.0.4')
+
 
-  blocking_tracks = set(user_data.blocking_tracks)
-  blocking_artists = set(user_data.blocking_artists)
-  user_tracks = []
-  user_artists = {}
-  for track in tracks:
-    artist_ids = []
-    for artist in track.artists:
-      artist_ids.append(artist.id)
-      if artist.id in user_artists:
-        continue
+@app.post("/events/token")
+async def issue_events_token(current: session.Session = Depends(get_session)):
+  return dict(token=session_manager.issue_events_token(
+    current, config.get_events_token_ttl()))
 
-      user_artists[artist.id] = data.UserArtist(
-        artist.id, artist.name, artist.id in blocking_artists)
 
-    user_tracks.append(data.UserTrack(
-      track.id, track.name, artist_ids, track.id in blocking_tracks))
+@app.get("/events")
+async def get_events(
+  token: str,
+  chart_key: data.ChartKey = Depends(get_chart_key)
+):
+  # EventSourceはヘッダーを付けられないので、POST /events/tokenで発行した
+  # SSE専用の短い期限のトークンをクエリで受け取る(セッションのJWTは受け付けない)
+  try:
+    current = session_manager.verify_events_token(token)
+  except session.SessionError as e:
+    logger.warning(e)
+    raise HTTPException(status_code=403, detail=str(e))
+  subscription = event_hub.subscribe(current.profile_id, chart_key)
+  # 接続した時点のチャートを送り、表示しているものと違えば取り直してもらう
+  version = ranking_service.get_version(chart_key)
+  initial = None
+  if version is not None:
+    initial = events.chart_event(chart_key, version)
+  return StreamingResponse(
+    events.stream(event_hub, subscription, initial,
+                  config.get_events_heartbeat()),
+    media_type='text/event-stream',
+    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 
-  return dict(tracks=user_tracks, artists=list(user_artists.values()))
+@app.get("/tracks_and_artists")
+async def tracks_and_artists(
+  request: Request,
+  chart_key: data.ChartKey = Depends(get_chart_key),
+  current: session.Session = Depends(get_session)
+):
+  profile_id = current.profile_id
+  with tracing.span('user_load'):
+    user_data = current.user_data
+  index = await ranking_service.get_index(chart_key)
+
+  key = (index.version, index.revision, user_data.blocking_version)
+  cached = response_cache.get(profile_id, key, chart_key)
+  if cached is None:
+    with tracing.span('render'):
+      body = response.build_tracks_and_artists(index, user_data)
+    cached = response_cache.put(profile_id, key, body, chart_key)
+
+  return cached_response(request, cached)
+
+
+def cached_response(request: Request, cached: cache.CachedResponse) -> Response:
+  # Accept-Encodingに合わせて圧縮する。ETagは表現ごとに変える
+  encoding = response.negotiate_encoding(
+    request.headers.get('Accept-Encoding'), len(cached.body))
+  etag = cached.etag if encoding is None else f'{cached.etag[:-1]}-{encoding}"'
+  headers = {'ETag': etag, 'Cache-Control': 'private, no-cache',
+             'Vary': 'Accept-Encoding'}
+  if etag in cache.parse_if_none_match(request.headers.get('If-None-Match')):
+    return Response(status_code=304, headers=headers)
+
+  body = cached.body
+  if encoding is not None:
+    with tracing.span('compress'):
+      body = response.get_encoded(cached, encoding)
+    headers['Content-Encoding'] = encoding
+  return Response(body, media_type='application/json', headers=headers)
 
 
 @app.get('/playlists')
-async def playlists(request: Request):
-  profile_id = get_profile_id_from(request)
+async def playlists(
+  request: Request,
+  current: session.Session = Depends(get_session)
+):
+  profile_id = current.profile_id
   api_service = get_api_service(profile_id)
-  playlists = api_service.get_playlists()
+  playlists = await api_service.get_playlists()
 
-  return playlists
+  # 名前や曲が変わるとsnapshot_idが変わる
+  key = tuple((p.id, p.snapshot_id) for p in playlists)
+  cached = response_cache.get(profile_id, key, 'playlists')
+  if cached is None:
+    cached = response_cache.put(profile_id, key,
+                                response.build_playlists(playlists), 'playlists')
+  return cached_response(request, cached)
 
 
 @app.put('/tracks/{id}')
-async def put_track(request: Request, id: str, body: PutTrack):
-  profile_id = get_profile_id_from(request)
-  user_data = user.get_user_data(profile_id)
-  if body.mute and id not in user_data.blocking_tracks:
-    user_data.blocking_tracks.append(id)
-  if not body.mute and id in user_data.blocking_tracks:
-    user_data.blocking_tracks.remove(id)
-  user_data.save()
+async def put_track(
+  id: str, body: PutTrack,
+  current: session.Session = Depends(get_session)
+):
+  profile_id = current.profile_id
+  await run_in_threadpool(user.update_blocking, profile_id,
+                          tracks={id: body.mute})
+  response_cache.invalidate(profile_id)
 
 
 @app.put('/artists/{id}')
-async def put_artist(request: Request, id: str, body: PutTrack):
-  profile_id = get_profile_id_from(request)
-  user_data = user.get_user_data(profile_id)
-  if body.mute and id not in user_data.blocking_artists:
-    user_data.blocking_tracks.append(id)
-  if not body.mute and id in user_data.blocking_artists:
-    user_data.blocking_artists.append(id)
-  user_data.save()
+async def put_artist(
+  id: str, body: PutTrack,
+  current: session.Session = Depends(get_session)
+):
+  profile_id = current.profile_id
+  await run_in_threadpool(user.update_blocking, profile_id,
+                          artists={id: body.mute})
+  response_cache.invalidate(profile_id)
+
+
+@app.post('/blocking')
+async def post_blocking(
+  body: PostBlocking,
+  current: session.Session = Depends(get_session)
+):
+  if len(body.tracks) + len(body.artists) > MAX_BLOCKING_CHANGES:
+    raise HTTPException(status_code=400, detail="Too many changes")
+
+  profile_id = current.profile_id
+  # update_blockingはディスクに書き終わるまで待つので、イベントループの外で呼ぶ
+  user_data = await run_in_threadpool(user.update_blocking, profile_id,
+                                      body.tracks, body.artists)
+  if user_data is None:
+    raise HTTPException(status_code=404, detail="User not found")
+  response_cache.invalidate(profile_id)
+  return dict(blockingVersion=user_data.blocking_version)
 
 
 @app.post('/replace_playlist')
-async def replace_playlist(request: Request):
-  profile_id = get_profile_id_from(request)
-  get_api_service(profile_id).replace_playlist()
+async def replace_playlist(
+  chart_key: data.ChartKey = Depends(get_chart_key),
+  current: session.Session = Depends(get_session)
+):
+  await refresh_user_playlist(current.profile_id, chart_key)
 
 
 @app.post('/playlists/{playlist_id}/set')
-async def set_target_playlist(request: Request, playlist_id: str):
-  profile_id = get_profile_id_from(request)
-  user_data = user.get_user_data(profile_id)
+async def set_target_playlist(
+  playlist_id: str,
+  current: session.Session = Depends(get_session)
+):
+  user_data = current.user_data
   user_data.reload_playlist_id = playlist_id
   user_data.save()
 
 
+@app.put('/auto_refresh')
+async def put_auto_refresh(
+  body: PutAutoRefresh,
+  current: session.Session = Depends(get_session)
+):
+  user_data = current.user_data
+  user_data.auto_refresh = body.enabled
+  user_data.save()
+
+
+def track_info_to_dict(track: history.TrackInfo) -> dict:
+  return dict(id=track.id, name=track.name, artist=track.artist)
+
+
+@app.get('/history/tracks/{track_id}')
+async def track_history(
+  track_id: str, days: int = 90,
+  current: session.Session = Depends(get_session)
+):
+  track = history_store.get_track(track_id)
+  if track is None:
+    raise HTTPException(status_code=404, detail="Track not found")
+
+  dates = history_store.get_dates()
+  start = dates[-1] - datetime.timedelta(days=days - 1) if dates else None
+  points = history_store.get_rank_trajectory(track_id, start)
+  return dict(
+    **track_info_to_dict(track),
+    points=[dict(date=p.date.isoformat(), rank=p.rank, streams=p.streams)
+            for p in points],
+  )
+
+
+@app.get('/history/movers')
+async def top_movers(
+  date: Optional[datetime.date] = None, limit: int = 10,
+  current: session.Session = Depends(get_session)
+):
+  movers = history_store.get_top_movers(date, limit=limit)
+  if movers is None:
+    raise HTTPException(status_code=404, detail="History not found")
+
+  def to_dicts(items: List[history.Mover]) -> List[dict]:
+    return [dict(track=track_info_to_dict(m.track), rank=m.rank,
+                 previousRank=m.previous_rank, change=m.change)
+            for m in items]
+
+  return dict(
+    date=movers.date.isoformat(),
+    previousDate=movers.previous_date.isoformat(),
+    up=to_dicts(movers.up),
+    down=to_dicts(movers.down),
+  )
+
+
 @app.get("/login")
 async def login(request: Request, origin: str):
   base_url = origin
@@ -173,7 +433,8 @@ async def login(request: Request, origin: str):
   if SCOPES:
     params['scope'] = ' '.join(SCOPES)
 
-  url = f"https://accounts.spotify.com/authorize?{urllib.parse.urlencode(params)}"
+  query = urllib.parse.urlencode(params)
+  url = f"{api.ACCOUNTS_URL}/authorize?{query}"
   return RedirectResponse(url)
 
 
@@ -185,21 +446,26 @@ async def login_callback(request: Request, code: str, origin: str):
   redirect_uri = f"{base_url.strip('/')}{REDIRECT_PATH}"
   logger.info("redirec_url: %s", redirect_uri)
   try:
-    token = api.fetch_token(code, client_credentials, redirect_uri)
+    token = await api.fetch_token(http_client, code, client_credentials,
+                                  redirect_uri)
   except Exception as e:
     logger.error(str(e))
     return RedirectResponse('/', 302)
 
-  client = api.UserResourceApiClient(client_credentials, token)
-  profile = client.get_current_user_profile()
+  client = api.UserResourceApiClient(client_credentials, http_client, token)
+  profile = await client.get_current_user_profile()
 
   user_data = user.get_user_data(profile.id)
   user_data.profile = profile
   user_data.token = token
   user_data.save()
 
-  return jwt.encode(
-    dict(sub=profile.id, iss=int(time.time())),
-    JWT_SECRET,
-    JWT_ALG
-  )
+  return session_manager.issue(profile.id)
+
+
+@app.post("/logout")
+async def logout(token: str = Depends(get_bearer_token)):
+  try:
+    session_manager.revoke(token)
+  except session.SessionError as e:
+    raise HTTPException(status_code=403, detail=str(e))
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Hashable, Optional, TypeVar
+
+from spotify import api, user
+from spotify.http_client import HttpClient
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class SingleFlight:
+  # 同じkeyの処理が実行中なら、新たに実行せずその結果を待つ
+
+  def __init__(self):
+    self.__calls: Dict[Hashable, asyncio.Future] = {}
+
+  async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+    future = self.__calls.get(key)
+    if future is None:
+      future = asyncio.ensure_future(fn())
+      self.__calls[key] = future
+      future.add_done_callback(lambda _: self.__calls.pop(key, None))
+    # 待っている側がキャンセルされても、処理自体は止めない
+    return await asyncio.shield(future)
+
+  def in_flight(self, key: Hashable) -> bool:
+    return key in self.__calls
+
+
+class TokenManager(api.ClientTokenProvider):
+  # client credentialsとユーザーのtokenを期限の少し前に更新する
+
+  def __init__(self,
+    credentials: api.ClientCredentials,
+    http_client: HttpClient,
+    margin: float = 60
+  ):
+    self.__credentials = credentials
+    self.__http_client = http_client
+    self.margin = margin
+    self.__client_token: Optional[api.ClientCredentialsFlowToken] = None
+    self.__flight = SingleFlight()
+
+  async def get_client_token(self) -> api.ClientCredentialsFlowToken:
+    token = self.__client_token
+    if token is None or token.expires_within(self.margin):
+      token = await self.refresh_client_token()
+    return token
+
+  async def refresh_client_token(self) -> api.ClientCredentialsFlowToken:
+    async def refresh():
+      token = await api.fetch_client_credentials_token(
+        self.__http_client, self.__credentials)
+      self.__client_token = token
+      logger.info("Client token was refreshed")
+      return token
+
+    return await self.__flight.do(('client',), refresh)
+
+  async def get_user_token(self,
+    user_data: user.UserData
+  ) -> api.AuthorizationCodeFlowToken:
+    token = user_data.token
+    if token is None:
+      raise api.AuthorizationError('tokenがありません')
+    if token.expires_within(self.margin):
+      token = await self.refresh_user_token(user_data, token)
+    return token
+
+  async def refresh_user_token(self,
+    user_data: user.UserData,
+    stale: Optional[api.AuthorizationCodeFlowToken] = None
+  ) -> api.AuthorizationCodeFlowToken:
+    # staleを使っている間に他のリクエストが更新済みなら、それを使う
+    current = user_data.token
+    if current is None:
+      raise api.AuthorizationError('tokenがありません')
+    if stale is not None and current is not stale \
+        and not current.expires_within(self.margin):
+      return current
+
+    async def refresh():
+      try:
+        token = await api.refresh_access_token(
+          self.__http_client, self.__credentials, current.refresh_token)
+      except api.AuthorizationError:
+        # refreshに失敗する場合は、user_dataからtokenを削除する
+        user_data.token = None
+        user_data.save()
+        raise
+      user_data.token = token
+      user_data.save()
+      logger.info("User token was refreshed(profile_id=%s)", key[1])
+      return token
+
+    key = ('user', user_data.profile.id if user_data.profile else id(user_data))
+    token = await self.__flight.do(key, refresh)
+    user_data.token = token
+    return token
@@ -0,0 +1,113 @@
+import hashlib
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+from spotify import metrics
+
+
+@dataclass(frozen=True)
+class CachedResponse:
+  key: Hashable
+  etag: str
+  body: bytes
+  # Content-Encoding -> 圧縮したbody
+  encoded: Dict[str, bytes] = field(default_factory=dict, compare=False)
+
+
+def parse_if_none_match(header: Optional[str]) -> List[str]:
+  if not header:
+    return []
+  etags = []
+  for etag in header.split(','):
+    etag = etag.strip()
+    if etag.startswith('W/'):
+      etag = etag[2:]
+    etags.append(etag)
+  return etags
+
+
+class ResponseCache:
+  # ユーザーごと、slot(チャートの種類など)ごとにシリアライズ済みのレスポンスを保持する
+  # keyが変わったら(チャート更新、ブロックリスト更新)作り直す
+
+  def __init__(self, max_size: int = 10000, name: str = 'response'):
+    self.max_size = max_size
+    self.name = name
+    self.__entries: 'OrderedDict[str, Dict[Hashable, CachedResponse]]' = \
+      OrderedDict()
+
+  def get(self,
+    owner: str,
+    key: Hashable,
+    slot: Hashable = None
+  ) -> Optional[CachedResponse]:
+    entry = self.__entries.get(owner, {}).get(slot)
+    if entry is None or entry.key != key:
+      metrics.cache_result(self.name, False)
+      return None
+    metrics.cache_result(self.name, True)
+    self.__entries.move_to_end(owner)
+    return entry
+
+  def put(self,
+    owner: str,
+    key: Hashable,
+    body: bytes,
+    slot: Hashable = None
+  ) -> CachedResponse:
+    entry = CachedResponse(key, f'"{hashlib.md5(body).hexdigest()}"', body)
+    self.__entries.setdefault(owner, {})[slot] = entry
+    self.__entries.move_to_end(owner)
+    while len(self.__entries) > self.max_size:
+      self.__entries.popitem(last=False)
+    return entry
+
+  def invalidate(self, owner: str):
+    self.__entries.pop(owner, None)
+
+  def __len__(self):
+    return len(self.__entries)
+
+
+class TtlCache:
+  # 件数の上限と有効期限を持つLRUキャッシュ
+
+  def __init__(self, max_size: int = 10000, ttl: float = 300,
+               name: str = 'ttl'):
+    self.max_size = max_size
+    self.ttl = ttl
+    self.name = name
+    self.__entries: 'OrderedDict[Hashable, Tuple[float, Any]]' = OrderedDict()
+
+  def get(self, key: Hashable) -> Optional[Any]:
+    entry = self.__entries.get(key)
+    if entry is None:
+      metrics.cache_result(self.name, False)
+      return None
+    expires_at, value = entry
+    if expires_at <= time.monotonic():
+      del self.__entries[key]
+      metrics.cache_result(self.name, False)
+      return None
+    metrics.cache_result(self.name, True)
+    self.__entries.move_to_end(key)
+    return value
+
+  def put(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+    ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+    self.__entries[key] = (time.monotonic() + ttl, value)
+    self.__entries.move_to_end(key)
+    while len(self.__entries) > self.max_size:
+      self.__entries.popitem(last=False)
+
+  def pop(self, key: Hashable) -> Optional[Any]:
+    entry = self.__entries.pop(key, None)
+    return None if entry is None else entry[1]
+
+  def clear(self):
+    self.__entries.clear()
+
+  def __len__(self):
+    return len(self.__entries)
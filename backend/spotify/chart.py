@@ -0,0 +1,92 @@
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from spotify import api
+
+
+@dataclass(frozen=True)
+class ChartIndex:
+  # リフレッシュごとに一度だけ作る。作成後は変更しない
+  version: Optional[str]
+  revision: int
+  tracks: Tuple[api.Track, ...]
+  artists: Tuple[api.Artist, ...]
+  # idから位置(整数id)への対応
+  track_positions: Dict[str, int]
+  artist_positions: Dict[str, int]
+  # track位置 -> artist位置, artist位置 -> track位置
+  track_artists: Tuple[Tuple[int, ...], ...]
+  artist_tracks: Tuple[Tuple[int, ...], ...]
+
+  def get_track(self, track_id: str) -> Optional[api.Track]:
+    position = self.track_positions.get(track_id)
+    return None if position is None else self.tracks[position]
+
+  def get_tracks_by_artist(self, artist_id: str) -> List[api.Track]:
+    position = self.artist_positions.get(artist_id)
+    if position is None:
+      return []
+    return [self.tracks[i] for i in self.artist_tracks[position]]
+
+  def blocked_positions(self,
+    blocking_tracks: Iterable[str],
+    blocking_artists: Iterable[str]
+  ) -> Set[int]:
+    positions = set()
+    for track_id in blocking_tracks:
+      if (position := self.track_positions.get(track_id)) is not None:
+        positions.add(position)
+    for artist_id in blocking_artists:
+      if (position := self.artist_positions.get(artist_id)) is not None:
+        positions.update(self.artist_tracks[position])
+    return positions
+
+  def __len__(self):
+    return len(self.tracks)
+
+
+def build_chart_index(
+  tracks: Iterable[api.Track],
+  version: Optional[str] = None,
+  revision: int = 0,
+) -> ChartIndex:
+  track_list = []
+  track_positions = {}
+  artists = []
+  artist_positions = {}
+  track_artists = []
+  artist_tracks: List[List[int]] = []
+
+  for track in tracks:
+    if track.id in track_positions:
+      continue
+    track_position = len(track_list)
+    track_positions[track.id] = track_position
+    track_list.append(track)
+
+    positions = []
+    for artist in track.artists:
+      artist_position = artist_positions.get(artist.id)
+      if artist_position is None:
+        artist_position = len(artists)
+        artist_positions[artist.id] = artist_position
+        artists.append(artist)
+        artist_tracks.append([])
+      if artist_position not in positions:
+        positions.append(artist_position)
+        artist_tracks[artist_position].append(track_position)
+    track_artists.append(tuple(positions))
+
+  return ChartIndex(
+    version,
+    revision,
+    tuple(track_list),
+    tuple(artists),
+    track_positions,
+    artist_positions,
+    tuple(track_artists),
+    tuple(tuple(p) for p in artist_tracks),
+  )
+
+
+EMPTY_CHART_INDEX = build_chart_index([])
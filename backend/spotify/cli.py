@@ -1,6 +1,22 @@
+import asyncio
+import pathlib
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+
 import click
 
-from spotify import service, config, user, data, api
+from spotify import service, config, user, data, api, metadata, auth, history, \
+  playlist
+from spotify.http_client import HttpClient
+
+
+@dataclass()
+class ReplaceResult:
+  profile_id: str
+  ok: bool
+  elapsed: float
+  error: Optional[str] = None
 
 
 @click.group()
@@ -8,20 +24,194 @@ def main():
   pass
 
 
-@main.command()
-def replace_playlist():
+def _create_ranking_service(
+  http_client: HttpClient,
+  token_manager: auth.TokenManager,
+  track_store: metadata.TrackStore,
+  chart_key: data.ChartKey
+) -> service.RankingService:
+  api_client = api.ApiClient(http_client, token_manager)
+  ranking_clients = data.RankingClients(
+    http_client, config.get_chart_max_age(), config.get_data_dir(),
+    [chart_key])
+  return service.RankingService(api_client, ranking_clients, track_store)
+
+
+async def _replace_user_playlist(
+  profile_id: str,
+  client_credentials: api.ClientCredentials,
+  http_client: HttpClient,
+  ranking_service: service.RankingService,
+  token_manager: auth.TokenManager,
+  chart_key: data.ChartKey,
+  playlist_store: Optional[playlist.PlaylistStore] = None,
+) -> ReplaceResult:
+  started = time.perf_counter()
+  try:
+    user_data = user.get_user_data(profile_id)
+    if not user_data.token:
+      raise Exception('tokenがありません')
+    user_resource_api_client = api.UserResourceApiClient(
+      client_credentials, http_client, user_data.token)
+    api_service = service.UserService(
+      user_data, user_resource_api_client, ranking_service, token_manager,
+      playlist_store)
+    await api_service.replace_playlist(chart_key=chart_key)
+  except Exception as e:
+    return ReplaceResult(profile_id, False, time.perf_counter() - started,
+                         str(e) or repr(e))
+
+  return ReplaceResult(profile_id, True, time.perf_counter() - started)
+
+
+async def _replace_playlists(
+  profile_ids: List[str],
+  workers: int,
+  chart_key: data.ChartKey = data.DEFAULT_CHART_KEY
+) -> List[ReplaceResult]:
   client_credentials = config.get_client_credentials()
-  user_data = user.get_user_data()
-  assert user_data.token
-  user_resource_api_client = api.UserResourceApiClient(client_credentials,
-                                                       user_data.token)
-  api_client = api.ApiClient(client_credentials)
-  ranking_client = data.RankingClient()
-  ranking_service = service.RankingService(api_client, ranking_client)
-
-  api_service = service.UserService(
-    user_data, user_resource_api_client, ranking_service)
-  api_service.replace_playlist()
+  http_client = HttpClient(config.get_http_settings())
+  playlist_store = playlist.PlaylistStore(
+    config.get_data_dir() / 'playlists.sqlite3')
+  track_store = metadata.TrackStore(
+    config.get_data_dir() / 'tracks.sqlite3', config.get_track_ttl())
+  try:
+    # チャートと楽曲情報は全ユーザーで共有する
+    token_manager = auth.TokenManager(client_credentials, http_client,
+                                      config.get_token_refresh_margin())
+    ranking_service = _create_ranking_service(
+      http_client, token_manager, track_store, chart_key)
+    await ranking_service.get_index(chart_key)
+
+    semaphore = asyncio.Semaphore(workers)
+
+    async def run(profile_id: str) -> ReplaceResult:
+      async with semaphore:
+        return await _replace_user_playlist(
+          profile_id, client_credentials, http_client, ranking_service,
+          token_manager, chart_key, playlist_store)
+
+    return await asyncio.gather(*[run(p) for p in profile_ids])
+  finally:
+    await http_client.aclose()
+    playlist_store.close()
+    track_store.close()
+    # 更新したtokenを書き込んでから終了する
+    user.flush()
+
+
+def _print_results(results: List[ReplaceResult], elapsed: float):
+  for result in results:
+    status = 'ok' if result.ok else 'failed'
+    line = f"{result.profile_id}\t{status}\t{result.elapsed * 1000:.0f}ms"
+    if result.error:
+      line += f"\t{result.error}"
+    click.echo(line)
+
+  succeeded = sum(1 for r in results if r.ok)
+  latencies = sorted(r.elapsed for r in results)
+  summary = f"succeeded:{succeeded}\tfailed:{len(results) - succeeded}" \
+            f"\telapsed:{elapsed:.1f}s"
+  if latencies:
+    p50 = latencies[len(latencies) // 2]
+    summary += f"\tp50:{p50 * 1000:.0f}ms\tmax:{latencies[-1] * 1000:.0f}ms"
+  click.echo(summary)
+
+
+def chart_options(f):
+  f = click.option('--period', default=data.DEFAULT_CHART_KEY.period,
+                   show_default=True, type=click.Choice(data.PERIODS),
+                   help='Chart period.')(f)
+  return click.option('--region', default=data.DEFAULT_CHART_KEY.region,
+                      show_default=True, help='Chart region.')(f)
+
+
+@main.command()
+@click.argument('profile_id')
+@chart_options
+def replace_playlist(profile_id: str, region: str, period: str):
+  results = asyncio.run(_replace_playlists(
+    [profile_id], 1, data.ChartKey(region.lower(), period)))
+  if not results[0].ok:
+    raise click.ClickException(results[0].error)
+
+
+@main.command()
+@click.option('--all', 'all_users', is_flag=True,
+              help='Refresh every stored user.')
+@click.option('--users', multiple=True,
+              help='Profile ids to refresh (repeatable or comma separated).')
+@click.option('--workers', default=8, show_default=True,
+              help='Number of users processed concurrently.')
+@chart_options
+def replace_playlists(
+  all_users: bool,
+  users: List[str],
+  workers: int,
+  region: str,
+  period: str
+):
+  if all_users:
+    profile_ids = user.list_profile_ids()
+  else:
+    profile_ids = [p for u in users for p in u.split(',') if p]
+  if not profile_ids:
+    raise click.UsageError('Specify --all or --users')
+
+  started = time.perf_counter()
+  results = asyncio.run(_replace_playlists(
+    profile_ids, workers, data.ChartKey(region.lower(), period)))
+  _print_results(results, time.perf_counter() - started)
+  if not all(r.ok for r in results):
+    raise SystemExit(1)
+
+
+@main.command()
+@click.option('--source', default=str(user.USERDATA_DIR), show_default=True,
+              type=click.Path(exists=True, file_okay=False),
+              help='Directory of JSON user files to import.')
+def migrate_users(source: str):
+  store = user.SqliteUserStore(config.get_data_dir() / 'users.sqlite3')
+  try:
+    migrated = user.migrate_json_users(pathlib.Path(source), store)
+  finally:
+    store.close()
+  click.echo(f"migrated:{len(migrated)}")
+
+
+@main.command()
+@click.option('--source', default='ranking_refresh_time', show_default=True,
+              type=click.Path(exists=True, file_okay=False),
+              help='Directory written by scripts/ranking_refresh_time.py.')
+def import_history(source: str):
+  store = history.HistoryStore(config.get_data_dir() / 'history')
+  try:
+    imported = history.import_snapshots(pathlib.Path(source), store)
+  finally:
+    store.close()
+  click.echo(f"imported:{len(imported)}")
+
+
+@main.command()
+@click.option('--host', default='127.0.0.1', show_default=True)
+@click.option('--port', default=8001, show_default=True)
+@click.option('--latency', default=0.0, show_default=True,
+              help='Seconds added to every response.')
+@click.option('--jitter', default=0.0, show_default=True,
+              help='Random extra latency, up to this many seconds.')
+@click.option('--error-rate', default=0.0, show_default=True,
+              help='Fraction of requests answered with 500.')
+@click.option('--rate-limit-rate', default=0.0, show_default=True,
+              help='Fraction of requests answered with 429.')
+@click.option('--retry-after', default=1, show_default=True)
+@click.option('--chart-size', default=200, show_default=True)
+@click.option('--token-expires-in', default=3600, show_default=True)
+def fake_server(host: str, port: int, **kwargs):
+  import uvicorn
+  from spotify import fake
+
+  uvicorn.run(fake.create_app(fake.FakeSettings(**kwargs)), host=host,
+              port=port, log_level='warning')
 
 
 if __name__ == '__main__':
@@ -1,8 +1,14 @@
 import json
+import os
 import pathlib
+from typing import List
+
 from spotify import api
+from spotify.http_client import HttpSettings
+from spotify.scheduler import SchedulerSettings
 
 SECRET_PATH = pathlib.Path("secret.json")
+DATA_DIR = pathlib.Path(os.environ.get('SPOTIFY_DATA_DIR') or 'data/')
 
 
 def __get_secret_content() -> dict:
@@ -24,3 +30,117 @@ def get_client_credentials() -> api.ClientCredentials:
 def get_jwt_secret() -> str:
   secret = __get_secret_content()
   return secret['jwt_secret']
+
+
+def __get_env(name: str, default, type_=str):
+  value = os.environ.get(name)
+  if value is None or value == '':
+    return default
+  return type_(value)
+
+
+def get_http_settings() -> HttpSettings:
+  default = HttpSettings()
+  return HttpSettings(
+    timeout=__get_env('SPOTIFY_HTTP_TIMEOUT', default.timeout, float),
+    connect_timeout=__get_env('SPOTIFY_HTTP_CONNECT_TIMEOUT',
+                             default.connect_timeout, float),
+    max_connections=__get_env('SPOTIFY_HTTP_MAX_CONNECTIONS',
+                             default.max_connections, int),
+    max_keepalive_connections=__get_env('SPOTIFY_HTTP_MAX_KEEPALIVE',
+                                       default.max_keepalive_connections, int),
+    keepalive_expiry=__get_env('SPOTIFY_HTTP_KEEPALIVE_EXPIRY',
+                              default.keepalive_expiry, float),
+    rate_limit=__get_env('SPOTIFY_RATE_LIMIT', default.rate_limit, float),
+    rate_burst=__get_env('SPOTIFY_RATE_BURST', default.rate_burst, int),
+    max_retries=__get_env('SPOTIFY_HTTP_MAX_RETRIES', default.max_retries, int),
+    backoff_base=__get_env('SPOTIFY_HTTP_BACKOFF', default.backoff_base, float),
+    max_retry_after=__get_env('SPOTIFY_MAX_RETRY_AFTER',
+                              default.max_retry_after, float),
+  )
+
+
+def get_data_dir() -> pathlib.Path:
+  DATA_DIR.mkdir(parents=True, exist_ok=True)
+  return DATA_DIR
+
+
+def get_track_ttl() -> float:
+  return __get_env('SPOTIFY_TRACK_TTL', 24 * 60 * 60, float)
+
+
+def get_chart_max_age() -> float:
+  return __get_env('SPOTIFY_CHART_MAX_AGE', 60 * 60, float)
+
+
+def get_chart_regions() -> List[str]:
+  regions = __get_env('SPOTIFY_CHART_REGIONS', 'jp', str)
+  return [r.strip().lower() for r in regions.split(',') if r.strip()]
+
+
+def get_user_store_type() -> str:
+  # sqlite(デフォルト) または json
+  return __get_env('SPOTIFY_USER_STORE', 'sqlite')
+
+
+def get_user_write_delay() -> float:
+  # 0なら、保存するたびにすぐ書き込む
+  return __get_env('SPOTIFY_USER_WRITE_DELAY', 0.5, float)
+
+
+def get_user_cache_size() -> int:
+  return __get_env('SPOTIFY_USER_CACHE_SIZE', 1024, int)
+
+
+def get_playlists_cache_ttl() -> float:
+  return __get_env('SPOTIFY_PLAYLISTS_CACHE_TTL', 60, float)
+
+
+def get_token_refresh_margin() -> float:
+  return __get_env('SPOTIFY_TOKEN_REFRESH_MARGIN', 60, float)
+
+
+def get_session_ttl() -> float:
+  return __get_env('SPOTIFY_SESSION_TTL', 30 * 24 * 60 * 60, float)
+
+
+def get_hydrate_concurrency() -> int:
+  # チャートの曲情報を取得するときに、同時に送るリクエストの数
+  return __get_env('SPOTIFY_HYDRATE_CONCURRENCY', 4, int)
+
+
+def get_events_token_ttl() -> float:
+  # GET /eventsに接続するときだけ使うので短くてよい
+  return __get_env('SPOTIFY_EVENTS_TOKEN_TTL', 60, float)
+
+
+def get_events_heartbeat() -> float:
+  return __get_env('SPOTIFY_EVENTS_HEARTBEAT', 15, float)
+
+
+def get_profile_sample_rate() -> float:
+  # 0より大きければ、その割合のリクエストをcProfileで計測する
+  return __get_env('SPOTIFY_PROFILE_SAMPLE_RATE', 0.0, float)
+
+
+def get_profile_threshold() -> float:
+  return __get_env('SPOTIFY_PROFILE_THRESHOLD', 1.0, float)
+
+
+def get_profile_dir() -> pathlib.Path:
+  return __get_env('SPOTIFY_PROFILE_DIR', DATA_DIR / 'profiles', pathlib.Path)
+
+
+def get_scheduler_settings() -> SchedulerSettings:
+  # intervalが0なら、スケジューラーを動かさない
+  default = SchedulerSettings()
+  return SchedulerSettings(
+    interval=__get_env('SPOTIFY_SCHEDULER_INTERVAL', default.interval, float),
+    window=__get_env('SPOTIFY_SCHEDULER_WINDOW', default.window, float),
+    concurrency=__get_env('SPOTIFY_SCHEDULER_CONCURRENCY',
+                          default.concurrency, int),
+    max_attempts=__get_env('SPOTIFY_SCHEDULER_MAX_ATTEMPTS',
+                           default.max_attempts, int),
+    retry_delay=__get_env('SPOTIFY_SCHEDULER_RETRY_DELAY',
+                          default.retry_delay, float),
+  )
@@ -1,19 +1,53 @@
+import asyncio
+import codecs
+import contextlib
 import csv
+import hashlib
+import json
 import logging
+import os
 import pathlib
+import stat
+import tempfile
+import time
 from dataclasses import dataclass
-from typing import List, Dict
+from typing import List, Dict, Optional, Iterable, BinaryIO, Iterator, Tuple
 
-import requests
+from spotify import metrics
+from spotify.http_client import HttpClient
 
-URL = "https://spotifycharts.com/regional/jp/daily/latest/download"
-CSV_PATH = pathlib.Path('regional-jp-daily-latest.csv')
+CHARTS_URL = os.environ.get('SPOTIFY_CHARTS_URL') or \
+             "https://spotifycharts.com"
+PERIODS = ('daily', 'weekly')
 
 logger = logging.getLogger(__name__)
 
 
+@dataclass(frozen=True)
+class ChartKey:
+  region: str = 'jp'
+  period: str = 'daily'
+
+  @property
+  def url(self) -> str:
+    return f"{CHARTS_URL}/regional/{self.region}/{self.period}/latest/download"
+
+  @property
+  def file_name(self) -> str:
+    return f"regional-{self.region}-{self.period}-latest.csv"
+
+  def __str__(self):
+    return f"{self.region}/{self.period}"
+
+
+DEFAULT_CHART_KEY = ChartKey('jp', 'daily')
+CSV_PATH = pathlib.Path(DEFAULT_CHART_KEY.file_name)
+
+
+# レスポンスに使うだけの値なので、__slots__にして作成とメモリを軽くする
 @dataclass()
 class UserTrack:
+  __slots__ = ('id', 'name', 'artistIds', 'blocked')
   id: str
   name: str
   artistIds: List[str]
@@ -22,68 +56,332 @@ class UserTrack:
 
 @dataclass()
 class UserArtist:
+  __slots__ = ('id', 'name', 'blocked')
   id: str
   name: str
   blocked: bool
 
 
-@dataclass()
 class Song:
-  rank: int
-  title: str
-  artist: str
-  count: int
-  url: str
+  # チャートの1行。曲数×チャート数だけ作るので__slots__で小さくする
+  # id, uriはパース時に一度だけ作る
+  __slots__ = ('rank', 'title', 'artist', 'count', 'url', 'id', 'uri')
 
-  @property
-  def id(self) -> str:
-    return self.url[self.url.rfind("/") + 1:]
+  def __init__(self, rank: int, title: str, artist: str, count: int, url: str):
+    self.rank = rank
+    self.title = title
+    self.artist = artist
+    self.count = count
+    self.url = url
+    self.id = url[url.rfind("/") + 1:]
+    self.uri = f"spotify:track:{self.id}"
 
-  @property
-  def uri(self) -> str:
-    return f"spotify:track:{self.id}"
+  def __eq__(self, other):
+    if not isinstance(other, Song):
+      return NotImplemented
+    return (self.rank, self.title, self.artist, self.count, self.url) == \
+           (other.rank, other.title, other.artist, other.count, other.url)
 
+  def __repr__(self):
+    return f"Song(rank={self.rank!r}, title={self.title!r}," \
+           f" artist={self.artist!r}, count={self.count!r}, url={self.url!r})"
 
-class RankingClient:
-  song_list: List[Song] = []
 
-  def _refresh(self, force_refresh: bool):
-    if CSV_PATH.is_file():
-      text = CSV_PATH.read_text()
+class ChartFormatError(ValueError):
+  pass
+
+
+CHART_COLUMNS = ['Position', 'Track Name', 'Artist', 'Streams', 'URL']
+TRACK_URL_PREFIX = 'https://open.spotify.com/track/'
+CHUNK_SIZE = 64 * 1024
+
+
+class ChartParser:
+  # チャートのCSVを受け取った分から順にパースする
+  # 1行目は注意書き、2行目は列名
+
+  def __init__(self):
+    self.song_list: List[Song] = []
+    self.__decoder = codecs.getincrementaldecoder('utf-8')()
+    self.__buffer = ''
+    self.__line = 0
+
+  def __error(self, message: str) -> ChartFormatError:
+    return ChartFormatError(f"line {self.__line}: {message}")
+
+  def __parse_row(self, row: List[str]):
+    self.__line += 1
+    if self.__line == 1:
+      if len(row) != len(CHART_COLUMNS):
+        raise self.__error(f"unexpected note line: {row!r}")
+      return
+    if self.__line == 2:
+      if row != CHART_COLUMNS:
+        raise self.__error(f"unexpected columns: {row!r}")
+      return
+    if not row:
+      return
+    if len(row) != len(CHART_COLUMNS):
+      raise self.__error(f"expected {len(CHART_COLUMNS)} columns: {row!r}")
+    rank, title, artist, count, url = row
+    if not url.startswith(TRACK_URL_PREFIX):
+      raise self.__error(f"unexpected url: {url!r}")
+    try:
+      song = Song(int(rank), title, artist, int(count), url)
+    except ValueError as e:
+      raise self.__error(str(e)) from e
+    self.song_list.append(song)
+
+  def __parse_lines(self, final: bool):
+    if final:
+      text, self.__buffer = self.__buffer, ''
     else:
-      with requests.get(URL) as r:
-        logger.info(f"GET {URL}(status_code={r.status_code})")
-        text = r.text
-        CSV_PATH.write_text(text)
-
-    reader = csv.reader(text.split("\n"))
-    next(reader)
-    next(reader)
-    song_list = []
-    for row in reader:
-      if len(row) < 5:
-        continue
-      rank = int(row[0])
-      title = row[1]
-      artist = row[2]
-      count = int(row[3])
-      url = row[4]
-      song = Song(rank, title, artist, count, url)
-      song_list.append(song)
+      end = self.__buffer.rfind('\n') + 1
+      text = self.__buffer[:end]
+      # 引用符の中の改行で区切らないように、閉じるまで待つ
+      if not text or text.count('"') % 2:
+        return
+      self.__buffer = self.__buffer[end:]
+    for row in csv.reader(text.splitlines()):
+      self.__parse_row(row)
+
+  def feed(self, chunk: bytes):
+    self.__buffer += self.__decoder.decode(chunk)
+    self.__parse_lines(False)
+
+  def close(self) -> List[Song]:
+    self.__buffer += self.__decoder.decode(b'', True)
+    self.__parse_lines(True)
+    if self.__line < 2:
+      raise self.__error("missing header lines")
+    return self.song_list
+
+
+def parse_chart(text: str) -> List[Song]:
+  parser = ChartParser()
+  parser.feed(text.encode('utf-8'))
+  return parser.close()
+
+
+def file_md5(path: pathlib.Path) -> str:
+  md5 = hashlib.md5()
+  with path.open('rb') as f:
+    while chunk := f.read(CHUNK_SIZE):
+      md5.update(chunk)
+  return md5.hexdigest()
+
+
+def parse_chart_file(path: pathlib.Path) -> List[Song]:
+  parser = ChartParser()
+  with path.open('rb') as f:
+    while chunk := f.read(CHUNK_SIZE):
+      parser.feed(chunk)
+  return parser.close()
+
+
+@dataclass()
+class ChartMeta:
+  hash: Optional[str] = None
+  etag: Optional[str] = None
+  last_modified: Optional[str] = None
+  checked_at: float = 0
+
+
+def load_chart_meta(path: pathlib.Path) -> ChartMeta:
+  if not path.is_file():
+    return ChartMeta()
+  try:
+    return ChartMeta(**json.loads(path.read_text()))
+  except (ValueError, TypeError) as e:
+    logger.warning("Failed to load %s: %r", path, e)
+    return ChartMeta()
+
+
+# os.umaskは設定と同時にしか読めないので、スレッドが動き出す前に一度だけ読む
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def _file_mode(path: pathlib.Path) -> int:
+  # 置き換える前のファイルと同じ権限にする。なければ通常のopenと同じ
+  try:
+    return stat.S_IMODE(path.stat().st_mode)
+  except FileNotFoundError:
+    return 0o666 & ~_UMASK
+
+
+@contextlib.contextmanager
+def atomic_writer(path: pathlib.Path) -> Iterator[BinaryIO]:
+  # 途中で落ちても読み込み側が壊れたファイルを見ないように、rename で置き換える
+  # mkstempは0600で作るので、置き換える前に権限を合わせる
+  fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      yield f
+    os.chmod(tmp, _file_mode(path))
+    os.replace(tmp, path)
+  except BaseException:
+    os.unlink(tmp)
+    raise
+
+
+def write_atomic(path: pathlib.Path, content: bytes):
+  with atomic_writer(path) as f:
+    f.write(content)
+
+
+class RankingClient:
+
+  def __init__(self,
+    http_client: HttpClient,
+    max_age: float = 60 * 60,
+    path: pathlib.Path = CSV_PATH,
+    key: ChartKey = DEFAULT_CHART_KEY,
+  ):
+    self.key = key
+    self.song_list: List[Song] = []
+    self.version: Optional[str] = None
+    self.__artists_dict: Dict[str, List[Song]] = {}
+    self.__artists_dict_version: Optional[str] = None
+    self.__http_client = http_client
+    self.__max_age = max_age
+    self.__path = path
+    self.__meta_path = path.with_name(path.name + '.meta.json')
+    self.__meta = load_chart_meta(self.__meta_path)
+    # 最後にSpotifyに確認できた時刻(304を含む)
+    self.fetched_at = self.__meta.checked_at
+    self.__lock = asyncio.Lock()
+
+  def _is_stale(self) -> bool:
+    return time.time() - self.__meta.checked_at >= self.__max_age
+
+  def _save_meta(self):
+    self.__meta.checked_at = time.time()
+    write_atomic(self.__meta_path,
+                 json.dumps(self.__meta.__dict__).encode('utf-8'))
+
+  async def _download(self) -> Optional[Tuple[str, List[Song]]]:
+    headers = {}
+    if self.__path.is_file():
+      if self.__meta.etag:
+        headers['If-None-Match'] = self.__meta.etag
+      if self.__meta.last_modified:
+        headers['If-Modified-Since'] = self.__meta.last_modified
+
+    url = self.key.url
+    async with self.__http_client.stream(
+      'GET', url, headers=headers,
+      endpoint='/regional/{region}/{period}/latest/download'
+    ) as r:
+      logger.info(f"GET {url}(status_code={r.status_code})")
+      if r.status_code == 304:
+        return None
+      r.raise_for_status()
+
+      # ボディ全体をメモリに載せずに、保存とパースを同時に行う
+      # 形式が違う場合は保存済みのファイルを置き換えない
+      md5 = hashlib.md5()
+      parser = ChartParser()
+      with atomic_writer(self.__path) as f:
+        async for chunk in r.aiter_bytes():
+          f.write(chunk)
+          md5.update(chunk)
+          parser.feed(chunk)
+        song_list = parser.close()
+
+    self.__meta.etag = r.headers.get('ETag')
+    self.__meta.last_modified = r.headers.get('Last-Modified')
+    return md5.hexdigest(), song_list
+
+  async def _refresh(self, force_refresh: bool):
+    song_list = None
+    if force_refresh or self._is_stale() or not self.__path.is_file():
+      try:
+        if (downloaded := await self._download()) is not None:
+          self.__meta.hash, song_list = downloaded
+        self.fetched_at = time.time()
+      except Exception as e:
+        if not self.__path.is_file():
+          raise
+        # 失敗した場合もmax_ageの間はキャッシュを使い、再取得を繰り返さない
+        logger.warning("Failed to download chart, using cached file: %r", e)
+      self._save_meta()
+
+    if self.song_list and self.version == self.__meta.hash:
+      # ETagに対応していなくても、内容が同じなら作り直さない
+      return
+
+    if song_list is None:
+      song_list = parse_chart_file(self.__path)
+      if self.__meta.hash is None:
+        self.__meta.hash = file_md5(self.__path)
 
     self.song_list = song_list
+    self.version = self.__meta.hash
+    logger.info("Chart was updated(key=%s, version=%s)", self.key, self.version)
 
-  def get_song_list(self, force_refresh: bool = False) -> List[Song]:
-    if not self.song_list or force_refresh:
-      self._refresh(force_refresh)
+  async def get_song_list(self, force_refresh: bool = False) -> List[Song]:
+    refreshed = False
+    if not self.song_list or force_refresh or self._is_stale():
+      async with self.__lock:
+        # 待っている間に他のリクエストが更新しているかもしれない
+        if not self.song_list or force_refresh or self._is_stale():
+          started = time.perf_counter()
+          try:
+            await self._refresh(force_refresh)
+          finally:
+            metrics.CHART_REFRESH_DURATION.observe(
+              time.perf_counter() - started, str(self.key))
+          refreshed = True
+    metrics.cache_result('chart', not refreshed)
 
     return self.song_list
 
-  def get_artists_dict(self, force_refresh: bool = False) -> Dict[str, int]:
-    if not self.song_list or force_refresh:
-      self._refresh(force_refresh)
-    artists = {}
-    for song in self.song_list:
-      artists.setdefault(song.artist, []).append(song)
+  async def get_artists_dict(self,
+    force_refresh: bool = False
+  ) -> Dict[str, List[Song]]:
+    song_list = await self.get_song_list(force_refresh)
+    # チャートが変わったときだけ作り直す
+    if self.__artists_dict_version != self.version or not self.__artists_dict:
+      artists = {}
+      for song in song_list:
+        artists.setdefault(song.artist, []).append(song)
+      self.__artists_dict = artists
+      self.__artists_dict_version = self.version
+
+    return self.__artists_dict
+
+
+class RankingClients:
+  # (region, period)ごとにRankingClientを持つ
+
+  def __init__(self,
+    http_client: HttpClient,
+    max_age: float = 60 * 60,
+    directory: pathlib.Path = pathlib.Path('.'),
+    keys: Iterable[ChartKey] = (DEFAULT_CHART_KEY,),
+  ):
+    self.__http_client = http_client
+    self.__max_age = max_age
+    self.__directory = directory
+    self.keys = tuple(keys)
+    self.__clients: Dict[ChartKey, RankingClient] = {}
+
+  def get(self, key: ChartKey = DEFAULT_CHART_KEY) -> RankingClient:
+    if key not in self.keys:
+      raise KeyError(f"Unknown chart: {key}")
+    if (client := self.__clients.get(key)) is None:
+      client = RankingClient(self.__http_client, self.__max_age,
+                             self.__directory / key.file_name, key)
+      self.__clients[key] = client
+    return client
 
-    return artists
+  async def get_song_lists(self,
+    keys: Optional[Iterable[ChartKey]] = None,
+    force_refresh: bool = False
+  ) -> Dict[ChartKey, List[Song]]:
+    # 各チャートのダウンロードは並行して行う
+    keys = list(self.keys if keys is None else keys)
+    song_lists = await asyncio.gather(
+      *[self.get(key).get_song_list(force_refresh) for key in keys])
+    return dict(zip(keys, song_lists))
@@ -0,0 +1,127 @@
+import asyncio
+import json
+import logging
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, Optional, Set
+
+from spotify import data, metrics
+
+logger = logging.getLogger(__name__)
+
+# チャートの更新やプレイリストの更新結果を、Server-Sent Eventsでブラウザに送る
+# 購読はプロセス内のキューなので、複数のプロセスで動かすと別のプロセスの通知は届かない
+
+CHART = 'chart'
+PLAYLIST = 'playlist'
+
+# 届いていないイベントがこれより溜まったら、古いものから捨てる
+MAX_QUEUED_EVENTS = 32
+# プロキシなどに切断されないよう、何も送らない間は定期的にコメントを送る
+HEARTBEAT = b': ping\n\n'
+# 切断されたときに、ブラウザが再接続するまでの時間(ミリ秒)
+RETRY_MS = 3000
+
+CONNECTIONS = metrics.REGISTRY.register(metrics.Gauge(
+  'spotify_event_connections',
+  'Open Server-Sent Events connections.'))
+EVENTS = metrics.REGISTRY.register(metrics.Counter(
+  'spotify_events_total',
+  'Events sent to browsers by type and result.',
+  ('type', 'result')))
+
+
+@dataclass(frozen=True)
+class Event:
+  type: str
+  data: dict
+
+  def encode(self) -> bytes:
+    body = json.dumps(self.data, separators=(',', ':'), ensure_ascii=False)
+    return f"event: {self.type}\ndata: {body}\n\n".encode()
+
+
+class Subscription:
+
+  def __init__(self, profile_id: str, chart_key: data.ChartKey):
+    self.profile_id = profile_id
+    self.chart_key = chart_key
+    self.queue: asyncio.Queue = asyncio.Queue(MAX_QUEUED_EVENTS)
+
+  def put(self, event: Event):
+    if self.queue.full():
+      self.queue.get_nowait()
+      EVENTS.inc(event.type, 'dropped')
+    self.queue.put_nowait(event)
+
+
+class EventHub:
+  # イベントループのスレッドからだけ呼び出す
+
+  def __init__(self):
+    # profile_id -> 購読(タブ)
+    self.__subscriptions: Dict[str, Set[Subscription]] = {}
+
+  def subscribe(self,
+    profile_id: str,
+    chart_key: data.ChartKey = data.DEFAULT_CHART_KEY
+  ) -> Subscription:
+    subscription = Subscription(profile_id, chart_key)
+    self.__subscriptions.setdefault(profile_id, set()).add(subscription)
+    CONNECTIONS.set(self.count())
+    return subscription
+
+  def unsubscribe(self, subscription: Subscription):
+    subscriptions = self.__subscriptions.get(subscription.profile_id)
+    if subscriptions is not None:
+      subscriptions.discard(subscription)
+      if not subscriptions:
+        del self.__subscriptions[subscription.profile_id]
+    CONNECTIONS.set(self.count())
+
+  def count(self) -> int:
+    return sum(len(s) for s in self.__subscriptions.values())
+
+  def publish(self, profile_id: str, event: Event):
+    for subscription in self.__subscriptions.get(profile_id, ()):
+      subscription.put(event)
+
+  def publish_chart(self, chart_key: data.ChartKey, event: Event):
+    for subscriptions in self.__subscriptions.values():
+      for subscription in subscriptions:
+        if subscription.chart_key == chart_key:
+          subscription.put(event)
+
+
+def chart_event(chart_key: data.ChartKey, version: Optional[str]) -> Event:
+  return Event(CHART, dict(chart=str(chart_key), version=version))
+
+
+def playlist_event(chart_key: data.ChartKey,
+                   error: Optional[BaseException] = None) -> Event:
+  if error is None:
+    return Event(PLAYLIST, dict(chart=str(chart_key), status='done'))
+  return Event(PLAYLIST, dict(chart=str(chart_key), status='failed',
+                              error=str(error) or repr(error)))
+
+
+async def stream(
+  hub: EventHub,
+  subscription: Subscription,
+  initial: Optional[Event] = None,
+  heartbeat: float = 15,
+) -> AsyncIterator[bytes]:
+  # 接続中はキューを待ち、何も来なければheartbeat秒ごとにコメントを送る
+  try:
+    yield f"retry: {RETRY_MS}\n\n".encode()
+    if initial is not None:
+      yield initial.encode()
+    while True:
+      try:
+        event = await asyncio.wait_for(subscription.queue.get(), heartbeat)
+      except asyncio.TimeoutError:
+        yield HEARTBEAT
+        continue
+      EVENTS.inc(event.type, 'sent')
+      yield event.encode()
+  finally:
+    hub.unsubscribe(subscription)
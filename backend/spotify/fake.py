@@ -0,0 +1,343 @@
+import asyncio
+import hashlib
+import json
+import random
+import re
+import secrets
+import time
+import urllib.parse
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import JSONResponse, RedirectResponse, Response
+
+# 負荷試験用に、accounts/api/spotifychartsの必要な部分だけを真似るサーバー
+# SPOTIFY_ACCOUNTS_URL, SPOTIFY_API_URL, SPOTIFY_CHARTS_URLをこのサーバーに向ける
+
+NOTE = ",,Note that these figures are generated using a formula that" \
+       " protects against any artificial inflation of chart positions.,,"
+MAX_PLAYLIST_ITEMS = 100
+MAX_PLAYLISTS_PER_PAGE = 50
+
+ROUTE_PATTERNS = [
+  (re.compile(r'^/v1/playlists/[^/]+'), '/v1/playlists/{id}'),
+  (re.compile(r'^/regional/[^/]+/[^/]+'), '/regional/{region}/{period}'),
+]
+
+
+def route_name(method: str, path: str) -> str:
+  # 集計用に、パスに含まれるidをまとめる
+  for pattern, replacement in ROUTE_PATTERNS:
+    path = pattern.sub(replacement, path)
+  return f"{method} {path}"
+
+
+def error_response(status: int, message: str, **kwargs) -> JSONResponse:
+  return JSONResponse(dict(error=dict(status=status, message=message)),
+                      status_code=status, **kwargs)
+
+
+@dataclass()
+class FakeSettings:
+  # 各リクエストの遅延(秒)。latency + [0, jitter)
+  latency: float = 0.0
+  jitter: float = 0.0
+  # 500, 429を返す割合
+  error_rate: float = 0.0
+  rate_limit_rate: float = 0.0
+  retry_after: int = 1
+  chart_size: int = 200
+  artists: int = 80
+  token_expires_in: int = 3600
+  playlists: int = 3
+
+
+@dataclass()
+class FakePlaylist:
+  id: str
+  name: str
+  owner_id: str
+  description: str = ''
+  uris: List[str] = field(default_factory=list)
+  snapshot: int = 1
+
+  @property
+  def snapshot_id(self) -> str:
+    return f"{self.id}-{self.snapshot}"
+
+
+@dataclass()
+class FakeToken:
+  user_id: Optional[str]
+  expires_at: float
+
+
+class FakeSpotify:
+
+  def __init__(self, settings: FakeSettings):
+    self.settings = settings
+    self.tokens: Dict[str, FakeToken] = {}
+    self.refresh_tokens: Dict[str, str] = {}
+    self.playlists: Dict[str, Dict[str, FakePlaylist]] = {}
+    self.requests: Dict[str, int] = {}
+
+  def track_id(self, region: str, position: int) -> str:
+    # 地域ごとに少しずつずらして、チャート間で曲が重なるようにする
+    offset = int(hashlib.md5(region.encode()).hexdigest(), 16) % 50
+    return f"{position + offset:022d}"
+
+  def artist(self, track_id: str) -> dict:
+    number = int(track_id) % self.settings.artists
+    return dict(id=f"artist{number:016d}", name=f"Artist {number}")
+
+  def track(self, track_id: str) -> Optional[dict]:
+    if not track_id.isdigit():
+      return None
+    artists = [self.artist(track_id)]
+    if int(track_id) % 5 == 0:
+      artists.append(self.artist(str(int(track_id) // 5)))
+    return dict(id=track_id, name=f"Track {int(track_id)}",
+                popularity=int(track_id) % 100, artists=artists)
+
+  def chart(self, region: str) -> bytes:
+    lines = [NOTE, "Position,Track Name,Artist,Streams,URL"]
+    for i in range(self.settings.chart_size):
+      track_id = self.track_id(region, i)
+      artist = self.artist(track_id)['name']
+      lines.append(f"{i + 1},Track {int(track_id)},{artist},{100000 - i},"
+                   f"https://open.spotify.com/track/{track_id}")
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+  def issue(self, user_id: Optional[str]) -> dict:
+    access_token = secrets.token_hex(16)
+    self.tokens[access_token] = FakeToken(
+      user_id, time.time() + self.settings.token_expires_in)
+    body = dict(access_token=access_token, token_type='Bearer',
+                expires_in=self.settings.token_expires_in)
+    if user_id is not None:
+      refresh_token = secrets.token_hex(16)
+      self.refresh_tokens[refresh_token] = user_id
+      body.update(refresh_token=refresh_token,
+                  scope='playlist-modify-public playlist-read-private')
+    return body
+
+  def authenticate(self, request: Request) -> FakeToken:
+    authorization = request.headers.get('Authorization', '')
+    token = self.tokens.get(authorization.split(' ')[-1])
+    if token is None:
+      raise ApiException(401, "Invalid access token")
+    if token.expires_at <= time.time():
+      raise ApiException(401, "The access token expired")
+    return token
+
+  def user_playlists(self, user_id: str) -> Dict[str, FakePlaylist]:
+    if user_id not in self.playlists:
+      self.playlists[user_id] = {
+        f"{user_id}-p{i}": FakePlaylist(
+          f"{user_id}-p{i}", f"Playlist {i}", user_id)
+        for i in range(self.settings.playlists)
+      }
+    return self.playlists[user_id]
+
+  def get_playlist(self, request: Request, playlist_id: str) -> FakePlaylist:
+    user_id = self.authenticate(request).user_id
+    playlist = self.user_playlists(user_id or '').get(playlist_id)
+    if playlist is None:
+      raise ApiException(404, "Not found")
+    return playlist
+
+
+class ApiException(Exception):
+
+  def __init__(self, status: int, message: str):
+    self.status = status
+    self.message = message
+
+
+def playlist_to_dict(playlist: FakePlaylist) -> dict:
+  return dict(
+    id=playlist.id,
+    name=playlist.name,
+    public=True,
+    uri=f"spotify:playlist:{playlist.id}",
+    owner=dict(id=playlist.owner_id),
+    snapshot_id=playlist.snapshot_id,
+    tracks=dict(total=len(playlist.uris)),
+  )
+
+
+def create_app(settings: Optional[FakeSettings] = None) -> FastAPI:
+  spotify = FakeSpotify(settings or FakeSettings())
+  app = FastAPI()
+  app.state.spotify = spotify
+
+  @app.exception_handler(ApiException)
+  async def api_exception_handler(request: Request, e: ApiException):
+    return error_response(e.status, e.message)
+
+  @app.middleware('http')
+  async def inject_faults(request: Request, call_next):
+    if request.url.path.startswith('/_'):
+      return await call_next(request)
+    name = route_name(request.method, request.url.path)
+    spotify.requests[name] = spotify.requests.get(name, 0) + 1
+
+    s = spotify.settings
+    delay = s.latency + random.uniform(0, s.jitter)
+    if delay > 0:
+      await asyncio.sleep(delay)
+    r = random.random()
+    if r < s.rate_limit_rate:
+      return error_response(429, "API rate limit exceeded",
+                            headers={'Retry-After': str(s.retry_after)})
+    if r < s.rate_limit_rate + s.error_rate:
+      return error_response(500, "Server error")
+    return await call_next(request)
+
+  @app.get('/_stats')
+  async def stats():
+    return dict(requests=spotify.requests, users=len(spotify.playlists))
+
+  @app.get('/authorize')
+  async def authorize(redirect_uri: str, state: Optional[str] = None):
+    params = dict(code=f"user-{secrets.token_hex(4)}")
+    if state:
+      params['state'] = state
+    return RedirectResponse(
+      f"{redirect_uri}?{urllib.parse.urlencode(params)}", 302)
+
+  @app.post('/api/token')
+  async def token(request: Request):
+    form = urllib.parse.parse_qs((await request.body()).decode())
+    grant_type = form.get('grant_type', [''])[0]
+    if grant_type == 'client_credentials':
+      return spotify.issue(None)
+    if grant_type == 'authorization_code':
+      # codeをそのままユーザーidとして使う
+      return spotify.issue(form.get('code', [''])[0] or 'user')
+    if grant_type == 'refresh_token':
+      user_id = spotify.refresh_tokens.get(form.get('refresh_token', [''])[0])
+      if user_id is None:
+        return JSONResponse(dict(error='invalid_grant'), status_code=400)
+      body = spotify.issue(user_id)
+      del body['refresh_token']
+      return body
+    return JSONResponse(dict(error='unsupported_grant_type'), status_code=400)
+
+  @app.get('/v1/tracks')
+  async def tracks(request: Request, ids: str):
+    spotify.authenticate(request)
+    return dict(tracks=[spotify.track(i) for i in ids.split(',')])
+
+  @app.get('/v1/me')
+  async def me(request: Request):
+    user_id = spotify.authenticate(request).user_id
+    if user_id is None:
+      raise ApiException(401, "No user")
+    return dict(id=user_id, display_name=user_id,
+                uri=f"spotify:user:{user_id}", country='JP')
+
+  @app.get('/v1/me/playlists')
+  async def my_playlists(request: Request, limit: int = 20, offset: int = 0):
+    user_id = spotify.authenticate(request).user_id
+    if not 0 < limit <= MAX_PLAYLISTS_PER_PAGE:
+      raise ApiException(400, "Invalid limit")
+    playlists = list(spotify.user_playlists(user_id or '').values())
+    items = playlists[offset:offset + limit]
+    next_url = None
+    if offset + limit < len(playlists):
+      next_url = str(request.url.include_query_params(
+        limit=limit, offset=offset + limit))
+    return dict(items=[playlist_to_dict(p) for p in items], limit=limit,
+                offset=offset, total=len(playlists), next=next_url)
+
+  @app.get('/v1/playlists/{playlist_id}')
+  async def get_playlist(request: Request, playlist_id: str):
+    return playlist_to_dict(spotify.get_playlist(request, playlist_id))
+
+  @app.put('/v1/playlists/{playlist_id}')
+  async def change_details(request: Request, playlist_id: str):
+    playlist = spotify.get_playlist(request, playlist_id)
+    body = json.loads(await request.body() or b'{}')
+    playlist.name = body.get('name', playlist.name)
+    playlist.description = body.get('description', playlist.description)
+    # 実際のAPIと同じく、名前や説明の変更でもsnapshot_idが変わる
+    playlist.snapshot += 1
+    return dict(snapshot_id=playlist.snapshot_id)
+
+  @app.get('/v1/playlists/{playlist_id}/tracks')
+  async def get_items(request: Request, playlist_id: str,
+                      limit: int = 100, offset: int = 0):
+    playlist = spotify.get_playlist(request, playlist_id)
+    items = [dict(track=dict(uri=uri, id=uri.split(':')[-1]))
+             for uri in playlist.uris[offset:offset + limit]]
+    return dict(items=items, total=len(playlist.uris), limit=limit,
+                offset=offset, snapshot_id=playlist.snapshot_id)
+
+  @app.put('/v1/playlists/{playlist_id}/tracks')
+  async def replace_items(request: Request, playlist_id: str,
+                          uris: Optional[str] = None):
+    playlist = spotify.get_playlist(request, playlist_id)
+    body = json.loads(await request.body() or b'{}')
+    if isinstance(body, dict) and 'range_start' in body:
+      # 並べ替え
+      start = body['range_start']
+      length = body.get('range_length', 1)
+      insert_before = body['insert_before']
+      if not 0 <= start < len(playlist.uris) \
+          or not 0 <= insert_before <= len(playlist.uris):
+        raise ApiException(400, "Index out of bounds")
+      moved = playlist.uris[start:start + length]
+      uris = playlist.uris[:start] + [None] * len(moved) + \
+             playlist.uris[start + length:]
+      uris[insert_before:insert_before] = moved
+      playlist.uris = [uri for uri in uris if uri is not None]
+      playlist.snapshot += 1
+      return dict(snapshot_id=playlist.snapshot_id)
+
+    items = body.get('uris') if isinstance(body, dict) else None
+    if isinstance(items, str):
+      items = items.split(',')
+    if items is None:
+      items = uris.split(',') if uris else []
+    if len(items) > MAX_PLAYLIST_ITEMS:
+      raise ApiException(400, "Too many ids requested")
+    playlist.uris = [uri for uri in items if uri]
+    playlist.snapshot += 1
+    return JSONResponse(dict(snapshot_id=playlist.snapshot_id), 201)
+
+  @app.post('/v1/playlists/{playlist_id}/tracks')
+  async def add_items(request: Request, playlist_id: str):
+    playlist = spotify.get_playlist(request, playlist_id)
+    body = json.loads(await request.body() or b'{}')
+    items = body.get('uris', [])
+    if len(items) > MAX_PLAYLIST_ITEMS:
+      raise ApiException(400, "Too many ids requested")
+    position = body.get('position', len(playlist.uris))
+    playlist.uris[position:position] = items
+    playlist.snapshot += 1
+    return JSONResponse(dict(snapshot_id=playlist.snapshot_id), 201)
+
+  @app.delete('/v1/playlists/{playlist_id}/tracks')
+  async def remove_items(request: Request, playlist_id: str):
+    playlist = spotify.get_playlist(request, playlist_id)
+    body = json.loads(await request.body() or b'{}')
+    removed = {item['uri'] for item in body.get('tracks', [])}
+    if len(removed) > MAX_PLAYLIST_ITEMS:
+      raise ApiException(400, "Too many ids requested")
+    playlist.uris = [uri for uri in playlist.uris if uri not in removed]
+    playlist.snapshot += 1
+    return dict(snapshot_id=playlist.snapshot_id)
+
+  @app.get('/regional/{region}/{period}/latest/download')
+  async def chart(request: Request, region: str, period: str):
+    if period not in ('daily', 'weekly'):
+      raise HTTPException(status_code=404)
+    content = spotify.chart(region)
+    etag = f'"{hashlib.md5(content).hexdigest()}"'
+    if request.headers.get('If-None-Match') == etag:
+      return Response(status_code=304, headers={'ETag': etag})
+    return Response(content, media_type='text/csv', headers={'ETag': etag})
+
+  return app
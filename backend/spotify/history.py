@@ -0,0 +1,355 @@
+import array
+import bisect
+import datetime
+import logging
+import mmap
+import pathlib
+import re
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from spotify import JST, data
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime.date(1970, 1, 1)
+
+# 列ごとに1ファイル。1行 = あるスナップショットでの1曲
+COLUMNS = (
+  ('date', 'I'),  # 1970-01-01からの日数
+  ('rank', 'H'),
+  ('track', 'I'),  # tracks.tsvの行番号
+  ('streams', 'Q'),
+)
+
+TRACKS_FILE = 'tracks.tsv'
+ARTISTS_FILE = 'artists.tsv'
+SNAPSHOTS_FILE = 'snapshots.tsv'
+
+# scripts/ranking_refresh_time.pyが出力するログ
+# level:ERROR	time:2021-08-01 13:00:01,234	status_code:200	hash:<md5>
+LOG_FILE = 'ranking_refresh_time.log'
+LOG_PATTERN = re.compile(
+  r'time:(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}),\d+\t.*hash:([0-9a-f]{32})')
+HASH_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+@dataclass(frozen=True)
+class Snapshot:
+  date: datetime.date
+  hash: str
+  start: int
+  count: int
+
+
+@dataclass(frozen=True)
+class TrackInfo:
+  id: str
+  name: str
+  artist: str
+
+
+@dataclass(frozen=True)
+class RankPoint:
+  date: datetime.date
+  rank: int
+  streams: int
+
+
+@dataclass(frozen=True)
+class Mover:
+  track: TrackInfo
+  rank: int
+  previous_rank: int
+
+  @property
+  def change(self) -> int:
+    # 順位が上がったら正
+    return self.previous_rank - self.rank
+
+
+@dataclass(frozen=True)
+class Movers:
+  date: datetime.date
+  previous_date: datetime.date
+  up: List[Mover] = field(default_factory=list)
+  down: List[Mover] = field(default_factory=list)
+
+
+def _read_lines(path: pathlib.Path) -> List[str]:
+  if not path.is_file():
+    return []
+  with path.open(encoding='utf-8', newline='\n') as f:
+    # 書き込み途中の最終行は読まない
+    return [line[:-1] for line in f if line.endswith('\n')]
+
+
+def _clean(value: str) -> str:
+  return value.replace('\t', ' ').replace('\n', ' ')
+
+
+class HistoryStore:
+  # チャートの履歴を列ごとの固定長配列として追記していき、mmapで読む
+  # track/artistは辞書(tsv)の行番号で持つ
+  # snapshots.tsvに行を追記した時点で、そのスナップショットの書き込みが確定する
+
+  def __init__(self, directory: pathlib.Path):
+    self.directory = directory
+    self.directory.mkdir(parents=True, exist_ok=True)
+    self.__lock = threading.Lock()
+    self.__loaded_size = -1
+    self.__mapped_rows = -1
+    self.__mmaps: List[mmap.mmap] = []
+    self.__columns: Dict[str, memoryview] = {}
+    self.__load()
+
+  def __path(self, name: str) -> pathlib.Path:
+    return self.directory / name
+
+  def __load(self):
+    path = self.__path(SNAPSHOTS_FILE)
+    self.__loaded_size = path.stat().st_size if path.is_file() else 0
+
+    self.__artists = _read_lines(self.__path(ARTISTS_FILE))
+    self.__artist_codes = {a: i for i, a in enumerate(self.__artists)}
+    self.__tracks: List[Tuple[str, str, int]] = []
+    for line in _read_lines(self.__path(TRACKS_FILE)):
+      track_id, name, artist_code = line.split('\t')
+      self.__tracks.append((track_id, name, int(artist_code)))
+    self.__track_codes = {t[0]: i for i, t in enumerate(self.__tracks)}
+
+    self.__snapshots: Dict[datetime.date, Snapshot] = {}
+    self.__hashes = set()
+    self.__rows = 0
+    for line in _read_lines(path):
+      date, hash, start, count = line.split('\t')
+      snapshot = Snapshot(datetime.date.fromisoformat(date), hash,
+                          int(start), int(count))
+      # 同じ日に複数ある場合は後から追加したものを使う
+      self.__snapshots[snapshot.date] = snapshot
+      self.__hashes.add(hash)
+      self.__rows = max(self.__rows, snapshot.start + snapshot.count)
+    self.__dates = sorted(self.__snapshots)
+
+  def __reload_if_changed(self):
+    # 別プロセス(インポート)が追記していたら読み直す
+    path = self.__path(SNAPSHOTS_FILE)
+    size = path.stat().st_size if path.is_file() else 0
+    if size != self.__loaded_size:
+      self.__load()
+
+  def __unmap(self):
+    for view in self.__columns.values():
+      view.release()
+    for m in self.__mmaps:
+      m.close()
+    self.__columns = {}
+    self.__mmaps = []
+    self.__mapped_rows = -1
+
+  def __map(self):
+    if self.__mapped_rows == self.__rows:
+      return
+    self.__unmap()
+    for name, typecode in COLUMNS:
+      path = self.__path(f'{name}.bin')
+      if self.__rows == 0 or not path.is_file():
+        self.__columns[name] = memoryview(array.array(typecode))
+        continue
+      with path.open('rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      self.__mmaps.append(m)
+      size = self.__rows * array.array(typecode).itemsize
+      self.__columns[name] = memoryview(m)[:size].cast(typecode)
+    self.__mapped_rows = self.__rows
+
+  def __encode_artist(self, artist: str, lines: List[str]) -> int:
+    if (code := self.__artist_codes.get(artist)) is None:
+      code = self.__artist_codes[artist] = len(self.__artists)
+      self.__artists.append(artist)
+      lines.append(f'{artist}\n')
+    return code
+
+  def __encode_track(self,
+    song: data.Song,
+    artist_lines: List[str],
+    track_lines: List[str]
+  ) -> int:
+    if (code := self.__track_codes.get(song.id)) is None:
+      artist_code = self.__encode_artist(_clean(song.artist), artist_lines)
+      track = (song.id, _clean(song.title), artist_code)
+      code = self.__track_codes[song.id] = len(self.__tracks)
+      self.__tracks.append(track)
+      track_lines.append('\t'.join(map(str, track)) + '\n')
+    return code
+
+  def __append_lines(self, name: str, lines: List[str]):
+    if lines:
+      with self.__path(name).open('a', encoding='utf-8', newline='\n') as f:
+        f.writelines(lines)
+
+  def append(self,
+    date: datetime.date,
+    hash: str,
+    song_list: List[data.Song]
+  ) -> bool:
+    with self.__lock:
+      self.__reload_if_changed()
+      if hash in self.__hashes:
+        return False
+
+      artist_lines = []
+      track_lines = []
+      codes = [self.__encode_track(s, artist_lines, track_lines)
+               for s in song_list]
+      values = {
+        'date': [(date - EPOCH).days] * len(song_list),
+        'rank': [s.rank for s in song_list],
+        'track': codes,
+        'streams': [s.count for s in song_list],
+      }
+
+      self.__append_lines(ARTISTS_FILE, artist_lines)
+      self.__append_lines(TRACKS_FILE, track_lines)
+      start = self.__rows
+      for name, typecode in COLUMNS:
+        column = array.array(typecode, values[name])
+        with self.__path(f'{name}.bin').open('ab') as f:
+          # 確定していない(前回中断した)行は捨てる
+          f.truncate(start * column.itemsize)
+          f.write(column.tobytes())
+
+      snapshot = Snapshot(date, hash, start, len(song_list))
+      self.__append_lines(SNAPSHOTS_FILE, [
+        f'{date.isoformat()}\t{hash}\t{start}\t{len(song_list)}\n'])
+      self.__loaded_size = self.__path(SNAPSHOTS_FILE).stat().st_size
+      self.__snapshots[date] = snapshot
+      self.__hashes.add(hash)
+      self.__rows = start + len(song_list)
+      self.__dates = sorted(self.__snapshots)
+
+    logger.info("Chart history was appended(date=%s, hash=%s)", date, hash)
+    return True
+
+  def get_dates(self) -> List[datetime.date]:
+    with self.__lock:
+      self.__reload_if_changed()
+      return list(self.__dates)
+
+  def get_track(self, track_id: str) -> Optional[TrackInfo]:
+    with self.__lock:
+      self.__reload_if_changed()
+      if (code := self.__track_codes.get(track_id)) is None:
+        return None
+      return self.__track_info(code)
+
+  def __track_info(self, code: int) -> TrackInfo:
+    track_id, name, artist_code = self.__tracks[code]
+    return TrackInfo(track_id, name, self.__artists[artist_code])
+
+  def __slice(self, name: str, snapshot: Snapshot) -> List[int]:
+    return self.__columns[name][
+      snapshot.start:snapshot.start + snapshot.count].tolist()
+
+  def get_rank_trajectory(self,
+    track_id: str,
+    start: Optional[datetime.date] = None,
+    end: Optional[datetime.date] = None
+  ) -> List[RankPoint]:
+    with self.__lock:
+      self.__reload_if_changed()
+      if (code := self.__track_codes.get(track_id)) is None:
+        return []
+      self.__map()
+
+      lo = 0 if start is None else bisect.bisect_left(self.__dates, start)
+      hi = len(self.__dates) if end is None else \
+        bisect.bisect_right(self.__dates, end)
+      points = []
+      for date in self.__dates[lo:hi]:
+        snapshot = self.__snapshots[date]
+        try:
+          i = snapshot.start + self.__slice('track', snapshot).index(code)
+        except ValueError:
+          continue
+        points.append(RankPoint(date, self.__columns['rank'][i],
+                                self.__columns['streams'][i]))
+      return points
+
+  def get_top_movers(self,
+    date: Optional[datetime.date] = None,
+    previous_date: Optional[datetime.date] = None,
+    limit: int = 10
+  ) -> Optional[Movers]:
+    with self.__lock:
+      self.__reload_if_changed()
+      if date is None and self.__dates:
+        date = self.__dates[-1]
+      if previous_date is None:
+        i = bisect.bisect_left(self.__dates, date) if date else 0
+        previous_date = self.__dates[i - 1] if i > 0 else None
+      snapshot = self.__snapshots.get(date)
+      previous = self.__snapshots.get(previous_date)
+      if snapshot is None or previous is None:
+        return None
+      self.__map()
+
+      ranks = dict(zip(self.__slice('track', snapshot),
+                       self.__slice('rank', snapshot)))
+      previous_ranks = dict(zip(self.__slice('track', previous),
+                                self.__slice('rank', previous)))
+      changes = [(previous_ranks[code] - rank, code, rank)
+                 for code, rank in ranks.items() if code in previous_ranks]
+
+      def to_movers(items) -> List[Mover]:
+        return [Mover(self.__track_info(code), rank, rank + change)
+                for change, code, rank in items[:limit]]
+
+      up = sorted((c for c in changes if c[0] > 0), key=lambda c: (-c[0], c[2]))
+      down = sorted((c for c in changes if c[0] < 0), key=lambda c: (c[0], c[2]))
+      return Movers(date, previous_date, to_movers(up), to_movers(down))
+
+  def __len__(self):
+    return self.__rows
+
+  def close(self):
+    with self.__lock:
+      self.__unmap()
+
+
+def read_snapshot_times(directory: pathlib.Path) -> Dict[str, datetime.datetime]:
+  times = {}
+  path = directory / LOG_FILE
+  if not path.is_file():
+    return times
+  with path.open(encoding='utf-8', errors='replace') as f:
+    for line in f:
+      if m := LOG_PATTERN.search(line):
+        times.setdefault(m.group(2), datetime.datetime.strptime(
+          m.group(1), '%Y-%m-%d %H:%M:%S').replace(tzinfo=JST))
+  return times
+
+
+def import_snapshots(directory: pathlib.Path, store: HistoryStore) -> List[str]:
+  # <md5>.csvの取得日時はログから、なければファイルの更新日時から決める
+  times = read_snapshot_times(directory)
+  snapshots = []
+  for path in directory.glob('*.csv'):
+    if not HASH_PATTERN.match(path.stem):
+      continue
+    time = times.get(path.stem) or datetime.datetime.fromtimestamp(
+      path.stat().st_mtime, JST)
+    snapshots.append((time, path))
+
+  imported = []
+  for time, path in sorted(snapshots):
+    try:
+      song_list = data.parse_chart_file(path)
+    except data.ChartFormatError as e:
+      logger.error("Skipped %s: %r", path.name, e)
+      continue
+    if store.append(time.date(), path.stem, song_list):
+      imported.append(path.stem)
+
+  return imported
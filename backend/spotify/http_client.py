@@ -0,0 +1,164 @@
+import asyncio
+import contextlib
+import logging
+import random
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, Optional
+
+import httpx
+
+from spotify import metrics
+from spotify.ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+RETRY_STATUS_CODES = frozenset([500, 502, 503, 504])
+
+
+@dataclass()
+class HttpSettings:
+  timeout: float = 10.0
+  connect_timeout: float = 5.0
+  max_connections: int = 20
+  max_keepalive_connections: int = 10
+  keepalive_expiry: float = 30.0
+  # ホストごとの1秒あたりのリクエスト数(0以下で無制限)
+  rate_limit: float = 10.0
+  rate_burst: int = 20
+  max_retries: int = 3
+  backoff_base: float = 0.5
+  # Retry-Afterがこれより長い場合は待たずにエラーにする
+  max_retry_after: float = 60.0
+
+
+def parse_retry_after(r: httpx.Response) -> Optional[float]:
+  value = r.headers.get('Retry-After')
+  if value is None:
+    return None
+  try:
+    return max(0.0, float(value))
+  except ValueError:
+    return None
+
+
+class HttpClient:
+  # 全クライアントで共有するkeep-aliveのコネクションプール
+
+  def __init__(self,
+    settings: Optional[HttpSettings] = None,
+    transport: Optional[httpx.AsyncBaseTransport] = None
+  ):
+    self.settings = settings or HttpSettings()
+    self.__client = httpx.AsyncClient(
+      timeout=httpx.Timeout(self.settings.timeout,
+                            connect=self.settings.connect_timeout),
+      limits=httpx.Limits(
+        max_connections=self.settings.max_connections,
+        max_keepalive_connections=self.settings.max_keepalive_connections,
+        keepalive_expiry=self.settings.keepalive_expiry,
+      ),
+      transport=transport,
+    )
+    self.__rate_limiters: Dict[str, TokenBucket] = {}
+
+  def get_rate_limiter(self, host: str) -> TokenBucket:
+    if host not in self.__rate_limiters:
+      self.__rate_limiters[host] = TokenBucket(self.settings.rate_limit,
+                                               self.settings.rate_burst)
+    return self.__rate_limiters[host]
+
+  def _backoff(self, attempt: int) -> float:
+    # full jitter
+    return random.uniform(0, self.settings.backoff_base * 2 ** attempt)
+
+  async def _send(self,
+    method: str,
+    url: str,
+    stream: bool = False,
+    endpoint: Optional[str] = None,
+    retry: bool = True,
+    **kwargs
+  ) -> httpx.Response:
+    parsed = httpx.URL(url)
+    # メトリクスのラベル。idを含むパスは呼び出し元がテンプレートを渡す
+    endpoint = endpoint or parsed.path
+    rate_limiter = self.get_rate_limiter(parsed.host)
+    # PUTでも冪等でないもの(並べ替えなど)は、呼び出し元がretry=Falseを渡す
+    retryable = retry and method.upper() in IDEMPOTENT_METHODS
+    attempt = 0
+    while True:
+      await rate_limiter.acquire()
+      started = time.perf_counter()
+      try:
+        r = await self.__client.send(
+          self.__client.build_request(method, url, **kwargs), stream=stream)
+      except httpx.TransportError as e:
+        metrics.UPSTREAM_REQUESTS.inc(parsed.host, endpoint, method, 'error')
+        if not retryable or attempt >= self.settings.max_retries:
+          raise
+        delay = self._backoff(attempt)
+        logger.warning("%s %s failed(%r), retrying in %.2fs",
+                       method, url, e, delay)
+      else:
+        metrics.UPSTREAM_REQUEST_DURATION.observe(
+          time.perf_counter() - started, parsed.host, endpoint, method)
+        metrics.UPSTREAM_REQUESTS.inc(parsed.host, endpoint, method,
+                                      str(r.status_code))
+        logger.debug("%s %s(status_code=%d)", method, url, r.status_code)
+        if attempt >= self.settings.max_retries:
+          return r
+        if r.status_code == 429:
+          # 429は処理されていないので、POSTでもRetry-Afterの後に再送してよい
+          retry_after = parse_retry_after(r)
+          if retry_after is None:
+            retry_after = self._backoff(attempt)
+          if retry_after > self.settings.max_retry_after:
+            return r
+          rate_limiter.pause(retry_after)
+          delay = random.uniform(0, self.settings.backoff_base)
+          logger.warning("%s %s was rate limited, retrying after %.2fs",
+                         method, url, retry_after)
+        elif retryable and r.status_code in RETRY_STATUS_CODES:
+          delay = self._backoff(attempt)
+          logger.warning("%s %s(status_code=%d), retrying in %.2fs",
+                         method, url, r.status_code, delay)
+        else:
+          return r
+        # 再送する前に、読んでいないボディを捨ててコネクションを返す
+        await r.aclose()
+
+      attempt += 1
+      await asyncio.sleep(delay)
+
+  async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+    return await self._send(method, url, **kwargs)
+
+  @contextlib.asynccontextmanager
+  async def stream(self,
+    method: str,
+    url: str,
+    **kwargs
+  ) -> AsyncIterator[httpx.Response]:
+    # ボディを読まずにレスポンスを返す。ボディはaiter_bytes()で少しずつ読む
+    r = await self._send(method, url, stream=True, **kwargs)
+    try:
+      yield r
+    finally:
+      await r.aclose()
+
+  async def get(self, url: str, **kwargs) -> httpx.Response:
+    return await self.request('GET', url, **kwargs)
+
+  async def post(self, url: str, **kwargs) -> httpx.Response:
+    return await self.request('POST', url, **kwargs)
+
+  async def put(self, url: str, **kwargs) -> httpx.Response:
+    return await self.request('PUT', url, **kwargs)
+
+  async def delete(self, url: str, **kwargs) -> httpx.Response:
+    return await self.request('DELETE', url, **kwargs)
+
+  async def aclose(self):
+    await self.__client.aclose()
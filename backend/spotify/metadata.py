@@ -0,0 +1,102 @@
+import logging
+import pathlib
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Union
+
+from spotify import api, metrics
+
+logger = logging.getLogger(__name__)
+
+# SQLiteのプレースホルダ数の上限(999)を超えないように分割する
+QUERY_CHUNK_SIZE = 500
+
+SCHEMA = """
+PRAGMA journal_mode=WAL;
+CREATE TABLE IF NOT EXISTS tracks (
+  id TEXT PRIMARY KEY,
+  name TEXT NOT NULL,
+  popularity INTEGER NOT NULL,
+  artist_ids TEXT NOT NULL,
+  fetched_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS artists (
+  id TEXT PRIMARY KEY,
+  name TEXT NOT NULL,
+  fetched_at REAL NOT NULL
+);
+"""
+
+
+def _chunks(ids: List[str]) -> Iterable[List[str]]:
+  for i in range(0, len(ids), QUERY_CHUNK_SIZE):
+    yield ids[i:i + QUERY_CHUNK_SIZE]
+
+
+class TrackStore:
+  # track/artistのメタデータをidをキーに永続化する
+  # max_ageを過ぎたレコード(popularityが古い)は取得し直す
+
+  def __init__(self, path: Union[str, pathlib.Path], max_age: float):
+    self.max_age = max_age
+    self.__lock = threading.Lock()
+    self.__conn = sqlite3.connect(str(path), check_same_thread=False)
+    self.__conn.executescript(SCHEMA)
+
+  def get_tracks(self, ids: List[str]) -> Dict[str, api.Track]:
+    threshold = time.time() - self.max_age
+    rows = []
+    with self.__lock:
+      for chunk in _chunks(list(set(ids))):
+        placeholders = ','.join('?' * len(chunk))
+        rows.extend(self.__conn.execute(
+          f"SELECT id, name, popularity, artist_ids FROM tracks"
+          f" WHERE fetched_at >= ? AND id IN ({placeholders})",
+          [threshold, *chunk]
+        ).fetchall())
+      artist_ids = list({a for row in rows for a in row[3].split(',') if a})
+      artists = {}
+      for chunk in _chunks(artist_ids):
+        placeholders = ','.join('?' * len(chunk))
+        for id, name in self.__conn.execute(
+          f"SELECT id, name FROM artists WHERE id IN ({placeholders})", chunk
+        ):
+          artists[id] = api.Artist(id, name)
+
+    tracks = {}
+    for id, name, popularity, joined_artist_ids in rows:
+      track_artists = [artists.get(a) for a in joined_artist_ids.split(',') if a]
+      if None in track_artists:
+        continue
+      tracks[id] = api.Track(id, name, popularity, track_artists)
+
+    metrics.CACHE_REQUESTS.inc('tracks', metrics.HIT, value=len(tracks))
+    metrics.CACHE_REQUESTS.inc('tracks', metrics.MISS,
+                               value=len(set(ids)) - len(tracks))
+    return tracks
+
+  def put_tracks(self, tracks: List[api.Track]):
+    if not tracks:
+      return
+
+    now = time.time()
+    track_rows = []
+    artist_rows = {}
+    for track in tracks:
+      track_rows.append((track.id, track.name, track.popularity,
+                         ','.join(a.id for a in track.artists), now))
+      for artist in track.artists:
+        artist_rows[artist.id] = (artist.id, artist.name, now)
+
+    with self.__lock, self.__conn:
+      self.__conn.executemany(
+        "INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?)", track_rows)
+      self.__conn.executemany(
+        "INSERT OR REPLACE INTO artists VALUES (?, ?, ?)",
+        list(artist_rows.values()))
+    logger.info("Stored %d tracks", len(track_rows))
+
+  def close(self):
+    with self.__lock:
+      self.__conn.close()
@@ -0,0 +1,228 @@
+import abc
+import bisect
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Prometheusのテキスト形式で出力する最小限のメトリクス
+# 記録はdictの参照と加算だけにして、ホットパスに負荷をかけない
+
+LabelValues = Tuple[str, ...]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+HIT = 'hit'
+MISS = 'miss'
+
+
+def _escape(value: str) -> str:
+  return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(names: Tuple[str, ...], values: LabelValues,
+                   extra: str = '') -> str:
+  pairs = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+  if extra:
+    pairs.append(extra)
+  return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+  if value == float('inf'):
+    return '+Inf'
+  if float(value).is_integer():
+    return str(int(value))
+  return repr(float(value))
+
+
+class Metric(abc.ABC):
+  type = 'untyped'
+
+  def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+    self.name = name
+    self.help = help
+    self.labels = labels
+
+  @abc.abstractmethod
+  def samples(self) -> List[str]:
+    pass
+
+  def render(self) -> str:
+    lines = [f'# HELP {self.name} {self.help}',
+             f'# TYPE {self.name} {self.type}']
+    return '\n'.join(lines + self.samples())
+
+
+class Counter(Metric):
+  type = 'counter'
+
+  def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+    super().__init__(name, help, labels)
+    self.values: Dict[LabelValues, float] = {}
+
+  def inc(self, *labels: str, value: float = 1):
+    self.values[labels] = self.values.get(labels, 0) + value
+
+  def get(self, *labels: str) -> float:
+    return self.values.get(labels, 0)
+
+  def samples(self) -> List[str]:
+    return [f'{self.name}{_format_labels(self.labels, k)} {_format_value(v)}'
+            for k, v in sorted(self.values.items())]
+
+
+class Gauge(Metric):
+  type = 'gauge'
+
+  def __init__(self,
+    name: str,
+    help: str,
+    labels: Tuple[str, ...] = (),
+    collect: Optional[Callable[[], Dict[LabelValues, float]]] = None
+  ):
+    super().__init__(name, help, labels)
+    self.values: Dict[LabelValues, float] = {}
+    # 出力するときに値を計算する(経過時間など)
+    self.collect = collect
+
+  def set(self, value: float, *labels: str):
+    self.values[labels] = value
+
+  def samples(self) -> List[str]:
+    values = self.collect() if self.collect else self.values
+    return [f'{self.name}{_format_labels(self.labels, k)} {_format_value(v)}'
+            for k, v in sorted(values.items())]
+
+
+class Histogram(Metric):
+  type = 'histogram'
+
+  def __init__(self,
+    name: str,
+    help: str,
+    labels: Tuple[str, ...] = (),
+    buckets: Tuple[float, ...] = DEFAULT_BUCKETS
+  ):
+    super().__init__(name, help, labels)
+    self.buckets = tuple(sorted(buckets))
+    # ラベルごとに [バケットごとの件数..., +Infの件数], 合計
+    self.counts: Dict[LabelValues, List[int]] = {}
+    self.sums: Dict[LabelValues, float] = {}
+
+  def observe(self, value: float, *labels: str):
+    counts = self.counts.get(labels)
+    if counts is None:
+      counts = self.counts[labels] = [0] * (len(self.buckets) + 1)
+      self.sums[labels] = 0.0
+    counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.sums[labels] += value
+
+  def count(self, *labels: str) -> int:
+    return sum(self.counts.get(labels, ()))
+
+  def samples(self) -> List[str]:
+    lines = []
+    for labels, counts in sorted(self.counts.items()):
+      total = 0
+      for bound, count in zip(self.buckets + (float('inf'),), counts):
+        total += count
+        le = f'le="{_format_value(bound)}"'
+        lines.append(f'{self.name}_bucket'
+                     f'{_format_labels(self.labels, labels, le)} {total}')
+      label_text = _format_labels(self.labels, labels)
+      lines.append(f'{self.name}_sum{label_text} {self.sums[labels]!r}')
+      lines.append(f'{self.name}_count{label_text} {total}')
+    return lines
+
+
+class Registry:
+
+  def __init__(self):
+    self.metrics: Dict[str, Metric] = {}
+
+  def register(self, metric: Metric) -> Metric:
+    self.metrics[metric.name] = metric
+    return metric
+
+  def render(self) -> str:
+    return '\n'.join(m.render() for m in self.metrics.values()) + '\n'
+
+
+REGISTRY = Registry()
+
+HTTP_REQUEST_DURATION = REGISTRY.register(Histogram(
+  'spotify_http_request_duration_seconds',
+  'Time spent handling requests to this app.',
+  ('method', 'route', 'status')))
+UPSTREAM_REQUESTS = REGISTRY.register(Counter(
+  'spotify_upstream_requests_total',
+  'Requests sent to Spotify, including retries.',
+  ('host', 'endpoint', 'method', 'status')))
+UPSTREAM_REQUEST_DURATION = REGISTRY.register(Histogram(
+  'spotify_upstream_request_duration_seconds',
+  'Time until Spotify responded, per attempt.',
+  ('host', 'endpoint', 'method')))
+CHART_REFRESH_DURATION = REGISTRY.register(Histogram(
+  'spotify_chart_refresh_duration_seconds',
+  'Time spent checking, downloading and parsing a chart.',
+  ('chart',)))
+USER_STORE_DURATION = REGISTRY.register(Histogram(
+  'spotify_user_store_duration_seconds',
+  'Time spent reading and writing the user store.',
+  ('store', 'operation'),
+  buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)))
+CACHE_REQUESTS = REGISTRY.register(Counter(
+  'spotify_cache_requests_total',
+  'Cache lookups by result (hit or miss).',
+  ('cache', 'result')))
+
+
+def cache_result(cache: str, hit: bool):
+  CACHE_REQUESTS.inc(cache, HIT if hit else MISS)
+
+
+_route_paths: Dict[object, str] = {}
+
+
+def route_path(scope: dict) -> str:
+  # 集計用に、idを含まないルートのパスを返す
+  if (route := scope.get('route')) is not None:
+    return route.path
+  endpoint = scope.get('endpoint')
+  if endpoint is None:
+    return 'unmatched'
+  if (path := _route_paths.get(endpoint)) is None:
+    path = 'unmatched'
+    for route in getattr(scope.get('app'), 'routes', ()):
+      if getattr(route, 'endpoint', None) is endpoint:
+        path = route.path
+        break
+    _route_paths[endpoint] = path
+  return path
+
+
+class MetricsMiddleware:
+  # ルートごとの処理時間を記録するASGIミドルウェア
+
+  def __init__(self, app):
+    self.app = app
+
+  async def __call__(self, scope, receive, send):
+    if scope['type'] != 'http':
+      return await self.app(scope, receive, send)
+
+    started = time.perf_counter()
+    status = 500
+
+    async def send_wrapper(message):
+      nonlocal status
+      if message['type'] == 'http.response.start':
+        status = message['status']
+      await send(message)
+
+    try:
+      await self.app(scope, receive, send_wrapper)
+    finally:
+      HTTP_REQUEST_DURATION.observe(time.perf_counter() - started,
+                                    scope['method'], route_path(scope),
+                                    str(status))
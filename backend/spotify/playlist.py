@@ -0,0 +1,165 @@
+import json
+import pathlib
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import List, Optional, Union
+
+# 最後に書き込んだプレイリストの内容を覚えておき、変更があった分だけを送る
+
+# POST/DELETE /v1/playlists/{id}/tracks で一度に指定できるアイテムの上限
+MAX_ITEMS_PER_REQUEST = 100
+# これより多くの操作が必要なら、まとめて置き換える
+MAX_OPERATIONS = 4
+
+SCHEMA = """
+PRAGMA journal_mode=WAL;
+CREATE TABLE IF NOT EXISTS playlists (
+  profile_id TEXT NOT NULL,
+  playlist_id TEXT NOT NULL,
+  snapshot_id TEXT,
+  uris TEXT NOT NULL,
+  updated_at REAL NOT NULL,
+  PRIMARY KEY (profile_id, playlist_id)
+);
+"""
+
+
+@dataclass(frozen=True)
+class PlaylistState:
+  uris: List[str]
+  snapshot_id: Optional[str]
+
+
+@dataclass(frozen=True)
+class RemoveItems:
+  uris: List[str]
+
+
+@dataclass(frozen=True)
+class AddItems:
+  uris: List[str]
+  position: int
+
+
+@dataclass(frozen=True)
+class MoveItem:
+  # Spotifyと同じく、insert_beforeは移動する前の位置で数える
+  range_start: int
+  insert_before: int
+
+
+Operation = Union[RemoveItems, AddItems, MoveItem]
+
+
+def _longest_increasing(values: List[int]) -> List[int]:
+  # 最長増加部分列の添字を返す
+  tails: List[int] = []
+  previous = [-1] * len(values)
+  for i, value in enumerate(values):
+    lo, hi = 0, len(tails)
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if values[tails[mid]] < value:
+        lo = mid + 1
+      else:
+        hi = mid
+    if lo > 0:
+      previous[i] = tails[lo - 1]
+    if lo == len(tails):
+      tails.append(i)
+    else:
+      tails[lo] = i
+
+  result = []
+  i = tails[-1] if tails else -1
+  while i >= 0:
+    result.append(i)
+    i = previous[i]
+  return result[::-1]
+
+
+def diff_playlist(
+  current: List[str],
+  target: List[str]
+) -> Optional[List[Operation]]:
+  # currentをtargetにするための操作を返す
+  # DELETEは同じ曲をすべて消すので、重複がある場合はNone(置き換える)
+  if len(set(current)) != len(current) or len(set(target)) != len(target):
+    return None
+
+  current_set = set(current)
+  target_order = {uri: i for i, uri in enumerate(target)}
+  operations: List[Operation] = []
+
+  removed = [uri for uri in current if uri not in target_order]
+  for i in range(0, len(removed), MAX_ITEMS_PER_REQUEST):
+    operations.append(RemoveItems(removed[i:i + MAX_ITEMS_PER_REQUEST]))
+
+  # 残った曲のうち、順序が合っている最長の列は動かさず、それ以外を1曲ずつ移動する
+  items = [uri for uri in current if uri in target_order]
+  placed = {items[i] for i in
+            _longest_increasing([target_order[uri] for uri in items])}
+  for uri in sorted(set(items) - placed, key=target_order.get):
+    start = items.index(uri)
+    insert_before = 0
+    for i, other in enumerate(items):
+      if other in placed and target_order[other] < target_order[uri]:
+        insert_before = i + 1
+    operations.append(MoveItem(start, insert_before))
+    items.pop(start)
+    items.insert(insert_before if insert_before <= start else insert_before - 1,
+                 uri)
+    placed.add(uri)
+
+  # 新しい曲は、連続しているものをまとめて追加する
+  i = 0
+  while i < len(target):
+    if target[i] in current_set:
+      i += 1
+      continue
+    end = i
+    while end < len(target) and target[end] not in current_set \
+        and end - i < MAX_ITEMS_PER_REQUEST:
+      end += 1
+    operations.append(AddItems(target[i:end], i))
+    i = end
+
+  return operations
+
+
+class PlaylistStore:
+  # ユーザー・プレイリストごとに、最後に書き込んだURIとsnapshot_idを持つ
+
+  def __init__(self, path: Union[str, pathlib.Path]):
+    self.__lock = threading.Lock()
+    self.__conn = sqlite3.connect(str(path), check_same_thread=False)
+    self.__conn.executescript(SCHEMA)
+
+  def get(self, profile_id: str, playlist_id: str) -> Optional[PlaylistState]:
+    with self.__lock:
+      row = self.__conn.execute(
+        "SELECT uris, snapshot_id FROM playlists"
+        " WHERE profile_id = ? AND playlist_id = ?",
+        (profile_id, playlist_id)).fetchone()
+    if row is None:
+      return None
+    return PlaylistState(json.loads(row[0]), row[1])
+
+  def put(self, profile_id: str, playlist_id: str, state: PlaylistState):
+    with self.__lock, self.__conn:
+      self.__conn.execute(
+        "INSERT OR REPLACE INTO playlists VALUES (?, ?, ?, ?, ?)",
+        (profile_id, playlist_id, state.snapshot_id, json.dumps(state.uris),
+         time.time()))
+
+  def delete(self, profile_id: str, playlist_id: str):
+    with self.__lock, self.__conn:
+      self.__conn.execute(
+        "DELETE FROM playlists WHERE profile_id = ? AND playlist_id = ?",
+        (profile_id, playlist_id))
+
+  def close(self):
+    with self.__lock:
+      self.__conn.close()
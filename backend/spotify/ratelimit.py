@@ -0,0 +1,50 @@
+import asyncio
+import time
+from typing import Optional
+
+
+class TokenBucket:
+  # rate: 1秒あたりに補充するトークン数, burst: 最大保持数
+  # 429を受けたらpauseでRetry-Afterの間すべての呼び出しを止める
+
+  def __init__(self, rate: float, burst: int):
+    self.rate = rate
+    self.burst = burst
+    self.__tokens = float(burst)
+    self.__updated = time.monotonic()
+    self.__paused_until = 0.0
+    self.__lock: Optional[asyncio.Lock] = None
+
+  def _refill(self, now: float):
+    elapsed = now - self.__updated
+    self.__updated = now
+    self.__tokens = min(float(self.burst), self.__tokens + elapsed * self.rate)
+
+  async def acquire(self):
+    if self.rate <= 0:
+      return
+    if self.__lock is None:
+      self.__lock = asyncio.Lock()
+
+    # lockを持ったまま待つことで、待っている順にトークンを渡す
+    async with self.__lock:
+      while True:
+        now = time.monotonic()
+        if now < self.__paused_until:
+          await asyncio.sleep(self.__paused_until - now)
+          continue
+        self._refill(now)
+        if self.__tokens >= 1:
+          self.__tokens -= 1
+          return
+        await asyncio.sleep((1 - self.__tokens) / self.rate)
+
+  def pause(self, seconds: float):
+    now = time.monotonic()
+    self.__paused_until = max(self.__paused_until, now + seconds)
+    self._refill(now)
+    self.__tokens = 0.0
+
+  @property
+  def paused_for(self) -> float:
+    return max(0.0, self.__paused_until - time.monotonic())
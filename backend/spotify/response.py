@@ -0,0 +1,116 @@
+import dataclasses
+import gzip
+import json
+from typing import Dict, List, Optional
+
+from spotify import data, user, chart, api, metrics, cache
+
+# orjsonとbrotliはあれば使う(pip install spotify-sandbox[fast])
+try:
+  import orjson
+except ImportError:
+  orjson = None
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+GZIP = 'gzip'
+BROTLI = 'br'
+
+# これより小さいレスポンスは圧縮しない
+MIN_COMPRESS_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def build_tracks_and_artists(
+  index: chart.ChartIndex,
+  user_data: user.UserData
+) -> bytes:
+  blocking_tracks = user_data.blocking_tracks
+  blocking_artists = user_data.blocking_artists
+  artists = index.artists
+  user_tracks = [
+    data.UserTrack(track.id, track.name, [artists[i].id for i in positions],
+                   track.id in blocking_tracks)
+    for track, positions in zip(index.tracks, index.track_artists)
+  ]
+  user_artists = [
+    data.UserArtist(artist.id, artist.name, artist.id in blocking_artists)
+    for artist in artists
+  ]
+
+  return dumps(dict(tracks=user_tracks, artists=user_artists))
+
+
+def build_playlists(playlists: List[api.Playlist]) -> bytes:
+  return dumps(playlists)
+
+
+def _default(o):
+  # json.dumpsで変換できない値(dataclass)をdictにする
+  if dataclasses.is_dataclass(o):
+    if (slots := getattr(o, '__slots__', None)) is not None:
+      return {name: getattr(o, name) for name in slots}
+    return dataclasses.asdict(o)
+  raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+def dumps(content) -> bytes:
+  # dataclassはそのまま渡してよい(asdictで複製しない)
+  if orjson is not None:
+    return orjson.dumps(content)
+  return json.dumps(content, ensure_ascii=False, separators=(',', ':'),
+                    default=_default).encode('utf-8')
+
+
+def parse_accept_encoding(header: Optional[str]) -> Dict[str, float]:
+  # encoding -> q
+  encodings: Dict[str, float] = {}
+  for item in (header or '').split(','):
+    name, *params = [s.strip() for s in item.split(';')]
+    if not name:
+      continue
+    q = 1.0
+    for param in params:
+      if param.startswith('q='):
+        try:
+          q = float(param[2:])
+        except ValueError:
+          q = 0.0
+    encodings[name.lower()] = q
+  return encodings
+
+
+def negotiate_encoding(header: Optional[str], size: int) -> Optional[str]:
+  # qが同じなら、よく縮むbrを選ぶ
+  if size < MIN_COMPRESS_SIZE:
+    return None
+  accepted = parse_accept_encoding(header)
+  wildcard = accepted.get('*', 0.0)
+  candidates = [BROTLI, GZIP] if brotli is not None else [GZIP]
+  best, best_q = None, 0.0
+  for encoding in candidates:
+    q = accepted.get(encoding, wildcard)
+    if q > best_q:
+      best, best_q = encoding, q
+  return best
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+  if encoding == BROTLI:
+    return brotli.compress(body, quality=BROTLI_QUALITY)
+  if encoding == GZIP:
+    # mtimeを固定し、同じbodyからは同じバイト列を作る
+    return gzip.compress(body, GZIP_LEVEL, mtime=0)
+  raise ValueError(f"Unsupported encoding: {encoding}")
+
+
+def get_encoded(cached: cache.CachedResponse, encoding: str) -> bytes:
+  # 圧縮したbodyはCachedResponseに持たせ、同じレスポンスでは圧縮し直さない
+  encoded = cached.encoded.get(encoding)
+  metrics.cache_result(f'compressed_{encoding}', encoded is not None)
+  if encoded is None:
+    encoded = cached.encoded[encoding] = compress(cached.body, encoding)
+  return encoded
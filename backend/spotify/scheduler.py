@@ -0,0 +1,292 @@
+import asyncio
+import logging
+import pathlib
+import random
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, List, Optional, Union, TYPE_CHECKING
+
+from spotify import data, metrics
+
+if TYPE_CHECKING:
+  from spotify import service
+
+logger = logging.getLogger(__name__)
+
+# チャートが更新されたら、自動更新を有効にしているユーザーのプレイリストを更新する
+# 進捗はSQLiteに記録し、再起動しても途中から続ける
+# (複数のプロセスで動かすと、それぞれが更新してしまう)
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+# 新しいチャートが来たので、古いチャートでは更新しない
+SKIPPED = 'skipped'
+
+SCHEMA = """
+PRAGMA journal_mode=WAL;
+CREATE TABLE IF NOT EXISTS runs (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  chart TEXT NOT NULL,
+  version TEXT NOT NULL,
+  created_at REAL NOT NULL,
+  finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+  run_id INTEGER NOT NULL,
+  profile_id TEXT NOT NULL,
+  status TEXT NOT NULL,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  next_at REAL NOT NULL,
+  error TEXT,
+  PRIMARY KEY (run_id, profile_id)
+);
+"""
+
+REFRESH_JOBS = metrics.REGISTRY.register(metrics.Counter(
+  'spotify_scheduled_refresh_total',
+  'Scheduled playlist refresh attempts by result.',
+  ('chart', 'result')))
+
+
+@dataclass()
+class Run:
+  id: int
+  chart: str
+  version: str
+  finished: bool
+
+
+@dataclass()
+class Job:
+  run_id: int
+  profile_id: str
+  status: str
+  attempts: int
+  next_at: float
+  error: Optional[str] = None
+
+
+class JobStore:
+
+  def __init__(self, path: Union[str, pathlib.Path]):
+    self.__lock = threading.Lock()
+    self.__conn = sqlite3.connect(str(path), check_same_thread=False)
+    self.__conn.executescript(SCHEMA)
+
+  def get_latest_run(self, chart: str) -> Optional[Run]:
+    with self.__lock:
+      row = self.__conn.execute(
+        "SELECT id, version, finished_at FROM runs WHERE chart = ?"
+        " ORDER BY id DESC LIMIT 1", (chart,)).fetchone()
+    if row is None:
+      return None
+    return Run(row[0], chart, row[1], row[2] is not None)
+
+  def create_run(self,
+    chart: str,
+    version: str,
+    jobs: List[Job]
+  ) -> Run:
+    now = time.time()
+    with self.__lock, self.__conn:
+      self.__conn.execute(
+        "UPDATE jobs SET status = ? WHERE status = ? AND run_id IN"
+        " (SELECT id FROM runs WHERE chart = ?)", (SKIPPED, PENDING, chart))
+      self.__conn.execute(
+        "UPDATE runs SET finished_at = ?"
+        " WHERE chart = ? AND finished_at IS NULL", (now, chart))
+      run_id = self.__conn.execute(
+        "INSERT INTO runs (chart, version, created_at) VALUES (?, ?, ?)",
+        (chart, version, now)).lastrowid
+      self.__conn.executemany(
+        "INSERT INTO jobs (run_id, profile_id, status, attempts, next_at)"
+        " VALUES (?, ?, ?, ?, ?)",
+        [(run_id, j.profile_id, PENDING, 0, j.next_at) for j in jobs])
+    return Run(run_id, chart, version, False)
+
+  def get_jobs(self, run_id: int, status: Optional[str] = None) -> List[Job]:
+    sql = "SELECT run_id, profile_id, status, attempts, next_at, error" \
+          " FROM jobs WHERE run_id = ?"
+    params = [run_id]
+    if status is not None:
+      sql += " AND status = ?"
+      params.append(status)
+    with self.__lock:
+      rows = self.__conn.execute(sql + " ORDER BY next_at", params).fetchall()
+    return [Job(*row) for row in rows]
+
+  def update_job(self, job: Job):
+    with self.__lock, self.__conn:
+      self.__conn.execute(
+        "UPDATE jobs SET status = ?, attempts = ?, next_at = ?, error = ?"
+        " WHERE run_id = ? AND profile_id = ?",
+        (job.status, job.attempts, job.next_at, job.error, job.run_id,
+         job.profile_id))
+
+  def finish_run(self, run_id: int):
+    with self.__lock, self.__conn:
+      self.__conn.execute("UPDATE runs SET finished_at = ? WHERE id = ?",
+                          (time.time(), run_id))
+
+  def close(self):
+    with self.__lock:
+      self.__conn.close()
+
+
+@dataclass()
+class SchedulerSettings:
+  # チャートを確認する間隔(秒)
+  interval: float = 600
+  # 全ユーザーの更新をこの時間(秒)に分散させる
+  window: float = 1800
+  concurrency: int = 4
+  max_attempts: int = 3
+  retry_delay: float = 60
+
+
+class RefreshScheduler:
+
+  def __init__(self,
+    ranking_service: 'service.RankingService',
+    job_store: JobStore,
+    list_users: Callable[[], Awaitable[List[str]]],
+    refresh_user: Callable[[str], Awaitable[None]],
+    chart_key: data.ChartKey = data.DEFAULT_CHART_KEY,
+    settings: Optional[SchedulerSettings] = None,
+  ):
+    self.ranking_service = ranking_service
+    self.job_store = job_store
+    self.list_users = list_users
+    self.refresh_user = refresh_user
+    self.chart_key = chart_key
+    self.settings = settings or SchedulerSettings()
+    # 今処理すべき回。新しい回ができたら、古い回の処理は止める
+    self.__current_run_id: Optional[int] = None
+    # イベントループの中で作る
+    self.__changed: Optional[asyncio.Event] = None
+
+  async def run_forever(self):
+    # チャートの確認は、更新を処理している間も続ける
+    # (新しいチャートが来たら、古い回の残りは処理せずに新しい回を始める)
+    task: Optional[asyncio.Task] = None
+    task_run_id: Optional[int] = None
+    try:
+      while True:
+        try:
+          run = await self.check()
+          if run is not None and (task is None or task.done()
+                                  or task_run_id != run.id):
+            task, task_run_id = asyncio.create_task(self.process(run)), run.id
+            task.add_done_callback(self.__log_task_error)
+        except asyncio.CancelledError:
+          raise
+        except Exception:
+          logger.exception("Scheduled refresh failed")
+        await asyncio.sleep(self.settings.interval)
+    finally:
+      if task is not None:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+  @staticmethod
+  def __log_task_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+      logger.error("Scheduled refresh failed", exc_info=task.exception())
+
+  async def poll(self) -> Optional[Run]:
+    # チャートを確認し、処理する回があれば最後まで処理する
+    run = await self.check()
+    if run is not None:
+      await self.process(run)
+    return run
+
+  async def check(self) -> Optional[Run]:
+    # チャートを一度だけ取得・更新し、変わっていれば新しい回を作る
+    # 終わっていない回があればそれを返す(続きから処理する)
+    chart = str(self.chart_key)
+    version = (await self.ranking_service.get_index(self.chart_key)).version
+    if version is None:
+      return None
+
+    run = self.job_store.get_latest_run(chart)
+    if run is None or run.version != version:
+      now = time.time()
+      jobs = [Job(0, profile_id, PENDING, 0,
+                  now + random.uniform(0, self.settings.window))
+              for profile_id in await self.list_users()]
+      run = self.job_store.create_run(chart, version, jobs)
+      logger.info("Chart %s was updated(version=%s), refreshing %d playlists",
+                  chart, version, len(jobs))
+    elif run.finished:
+      return None
+
+    if self.__current_run_id != run.id:
+      self.__current_run_id = run.id
+      # 古い回の処理が待っていれば起こす
+      if self.__changed is not None:
+        self.__changed.set()
+        self.__changed = None
+    return run
+
+  async def __wait_until(self, run: Run, at: float) -> bool:
+    # at まで待つ。その間に新しい回が始まったらFalseを返す
+    while self.__current_run_id == run.id \
+        and (delay := at - time.time()) > 0:
+      if self.__changed is None:
+        self.__changed = asyncio.Event()
+      try:
+        await asyncio.wait_for(self.__changed.wait(), delay)
+      except asyncio.TimeoutError:
+        pass
+    return self.__current_run_id == run.id
+
+  async def process(self, run: Run):
+    semaphore = asyncio.Semaphore(self.settings.concurrency)
+    tasks = set()
+    try:
+      while jobs := self.job_store.get_jobs(run.id, PENDING):
+        for job in jobs:
+          if not await self.__wait_until(run, job.next_at):
+            logger.info("Scheduled refresh of %s(version=%s) was superseded",
+                        run.chart, run.version)
+            return
+          await semaphore.acquire()
+          task = asyncio.create_task(self.__run_job(run, job, semaphore))
+          tasks.add(task)
+          task.add_done_callback(tasks.discard)
+        # 失敗して再試行を待つジョブは、次の周回で処理する
+        await asyncio.gather(*tasks)
+    finally:
+      # 始めた更新は、古い回のものでも最後まで終わらせる
+      await asyncio.gather(*tasks, return_exceptions=True)
+
+    self.job_store.finish_run(run.id)
+    failed = self.job_store.get_jobs(run.id, FAILED)
+    logger.info("Scheduled refresh of %s(version=%s) finished(failed=%d)",
+                run.chart, run.version, len(failed))
+
+  async def __run_job(self, run: Run, job: Job, semaphore: asyncio.Semaphore):
+    try:
+      await self.refresh_user(job.profile_id)
+    except Exception as e:
+      job.attempts += 1
+      job.error = str(e) or repr(e)
+      if job.attempts >= self.settings.max_attempts:
+        job.status = FAILED
+      else:
+        job.next_at = time.time() + random.uniform(0.5, 1.5) * \
+                      self.settings.retry_delay * 2 ** (job.attempts - 1)
+      logger.warning("Scheduled refresh failed(profile_id=%s, attempts=%d): %s",
+                     job.profile_id, job.attempts, job.error)
+      REFRESH_JOBS.inc(run.chart, 'error')
+    else:
+      job.attempts += 1
+      job.status = DONE
+      job.error = None
+      REFRESH_JOBS.inc(run.chart, 'ok')
+    finally:
+      semaphore.release()
+    self.job_store.update_job(job)
@@ -1,37 +1,226 @@
-from dataclasses import dataclass
-from typing import List
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional, Sequence, Dict
 
-from spotify import data, api
+from spotify import data, api, metadata, chart, metrics, tracing
+
+logger = logging.getLogger(__name__)
+
+# 取得に失敗したバッチは、この時間(秒)から倍々に間隔を空けて取り直す
+FAILURE_RETRY_DELAY = 30
+MAX_FAILURE_RETRY_DELAY = 600
+
+
+@dataclass()
+class HydrationFailure:
+  index: int
+  ids: List[str]
+  error: BaseException
+
+
+@dataclass()
+class HydrationResult:
+  tracks: List[api.Track] = field(default_factory=list)
+  failures: List[HydrationFailure] = field(default_factory=list)
+
+
+def split_batches(ids: List[str], size: int) -> List[List[str]]:
+  return [ids[i:i + size] for i in range(0, len(ids), size)]
+
+
+@dataclass()
+class ChartState:
+  index: chart.ChartIndex = chart.EMPTY_CHART_INDEX
+  failures: List[HydrationFailure] = field(default_factory=list)
+  # 失敗したバッチを取り直す時刻(time.monotonic)と、続けて失敗した回数
+  retry_at: float = 0.0
+  attempts: int = 0
+  # 取得に失敗したチャートのバージョン
+  # (全部失敗したときは、indexより新しいバージョンになる)
+  failed_version: Optional[str] = None
 
 
 @dataclass()
 class RankingService:
   __api_client: api.ApiClient
-  __ranking_client: data.RankingClient
-  __tracks = []
-  __artists = []
-
-  def _refresh(self):
-    self.__tracks = []
-    song_list = self.__ranking_client.get_song_list()
-    ids = [song.id for song in song_list]
-    for i in range(4):
-      self.__tracks.extend(
-        self.__api_client.get_several_tracks(ids[i * 50:(i + 1) * 50]))
-    self.__artists = []
-    for track in self.__tracks:
-      for artist in track.artists:
-        if artist not in self.__artists:
-          self.__artists.append(artist)
-
-  def get_tracks(self) -> List[api.Track]:
-    if not self.__tracks:
-      self._refresh()
-
-    return self.__tracks
-
-  def get_artists(self) -> List[api.Artist]:
-    if not self.__tracks:
-      self._refresh()
-
-    return self.__artists
+  __ranking_clients: data.RankingClients
+  __track_store: Optional[metadata.TrackStore] = None
+  __concurrency: int = 4
+  # チャートのバージョンが変わったときに呼ばれる(SSEでの通知など)
+  # 失敗したバッチを取り直しただけでは呼ばない
+  __on_update: Optional[
+    Callable[[data.ChartKey, chart.ChartIndex], None]] = None
+  __retry_delay: float = FAILURE_RETRY_DELAY
+  __charts: Dict[data.ChartKey, ChartState] = field(
+    default_factory=dict, init=False)
+  __revision: int = field(default=0, init=False)
+  __lock: Optional[asyncio.Lock] = field(default=None, init=False)
+
+  async def _hydrate(self, ids: List[str]) -> HydrationResult:
+    cached = {}
+    if self.__track_store is not None:
+      cached = self.__track_store.get_tracks(ids)
+    missing = [id for id in dict.fromkeys(ids) if id not in cached]
+    logger.info("Hydrating %d tracks(cached=%d, missing=%d)",
+                len(ids), len(ids) - len(missing), len(missing))
+
+    fetched = await self._fetch(missing)
+    if self.__track_store is not None:
+      self.__track_store.put_tracks(fetched.tracks)
+
+    tracks = {**cached, **{t.id: t for t in fetched.tracks}}
+    return HydrationResult([tracks[id] for id in ids if id in tracks],
+                           fetched.failures)
+
+  async def _fetch(self, ids: List[str]) -> HydrationResult:
+    semaphore = asyncio.Semaphore(self.__concurrency)
+    batches = split_batches(ids, api.MAX_SEVERAL_TRACKS)
+
+    async def fetch(batch: List[str]) -> List[api.Track]:
+      async with semaphore:
+        return await self.__api_client.get_several_tracks(batch)
+
+    results = await asyncio.gather(*[fetch(b) for b in batches],
+                                   return_exceptions=True)
+
+    # gatherは引数の順に結果を返すので、チャートの順位は保たれる
+    result = HydrationResult()
+    for i, (batch, tracks) in enumerate(zip(batches, results)):
+      if isinstance(tracks, BaseException):
+        logger.warning("Failed to fetch batch %d/%d(%d tracks): %r",
+                       i + 1, len(batches), len(batch), tracks)
+        result.failures.append(HydrationFailure(i, batch, tracks))
+        continue
+      result.tracks.extend(tracks)
+
+    return result
+
+  def __state(self, key: data.ChartKey) -> ChartState:
+    if (state := self.__charts.get(key)) is None:
+      state = self.__charts[key] = ChartState()
+    return state
+
+  def __is_hydrated(self, key: data.ChartKey) -> bool:
+    # チャートが変わっておらず、失敗したバッチを取り直す時刻でもなければ取り直さない
+    # (それまでは取得できた曲だけのインデックスを返す)
+    # 新しいチャートの曲が1曲も取得できなかったときも、それまでは以前のインデックスを返す
+    state = self.__state(key)
+    version = self.__ranking_clients.get(key).version
+    if len(state.index) == 0:
+      return False
+    if state.failures and state.failed_version == version:
+      return time.monotonic() < state.retry_at
+    return state.index.version == version and not state.failures
+
+  async def _refresh(self, keys: List[data.ChartKey]):
+    with tracing.span('chart'):
+      await self.__ranking_clients.get_song_lists(keys)
+    hydrated = all(self.__is_hydrated(key) for key in keys)
+    metrics.cache_result('chart_index', hydrated)
+    if hydrated:
+      return
+
+    if self.__lock is None:
+      self.__lock = asyncio.Lock()
+    async with self.__lock:
+      stale = [key for key in keys if not self.__is_hydrated(key)]
+      if stale:
+        with tracing.span('hydrate'):
+          await self.__hydrate_charts(stale)
+
+  async def __hydrate_charts(self, keys: List[data.ChartKey]):
+    # 同じ曲は複数の地域のチャートに入るので、まとめて一度だけ取得する
+    # チャートが変わっていなければ、失敗したバッチの曲だけを取り直す
+    clients = [self.__ranking_clients.get(key) for key in keys]
+    chart_ids = [[song.id for song in c.song_list] for c in clients]
+    known: Dict[str, api.Track] = {}
+    fetch_ids: List[str] = []
+    for key, client, ids in zip(keys, clients, chart_ids):
+      state = self.__state(key)
+      if len(state.index) > 0 and state.index.version == client.version:
+        known.update((t.id, t) for t in state.index.tracks)
+        fetch_ids.extend(id for f in state.failures for id in f.ids)
+      else:
+        fetch_ids.extend(ids)
+    result = await self._hydrate(fetch_ids)
+    tracks = {**known, **{t.id: t for t in result.tracks}}
+
+    for key, client, ids in zip(keys, clients, chart_ids):
+      id_set = set(ids)
+      failures = [f for f in result.failures if id_set.intersection(f.ids)]
+      chart_tracks = [tracks[id] for id in ids if id in tracks]
+      state = self.__state(key)
+      if failures and not chart_tracks:
+        # 1曲も取得できなければ、以前のインデックスを使い続ける
+        # 以前のインデックスもなければ、返せるものがないのでエラーにする
+        if len(state.index) > 0:
+          logger.error("Failed to hydrate chart %s, serving version %s: %r",
+                       key, state.index.version, failures[0].error)
+          self.__set_failures(state, client.version, failures)
+          continue
+        if len(keys) == 1:
+          raise failures[0].error
+        logger.error("Failed to hydrate chart %s: %r", key, failures[0].error)
+        continue
+
+      self.__set_failures(state, client.version, failures)
+
+      previous = state.index
+      if previous.version == client.version \
+          and [t.id for t in previous.tracks] == [t.id for t in chart_tracks]:
+        # 取り直しても曲が増えなければ、インデックス(revision)はそのまま
+        continue
+      self.__revision += 1
+      state.index = chart.build_chart_index(
+        chart_tracks, client.version, self.__revision)
+      if self.__on_update is not None and previous.version != client.version:
+        self.__on_update(key, state.index)
+
+  def __set_failures(self,
+    state: ChartState,
+    version: Optional[str],
+    failures: List[HydrationFailure]
+  ):
+    state.failures = failures
+    if not failures:
+      state.attempts = 0
+      return
+    if state.failed_version != version:
+      state.attempts = 0
+    state.failed_version = version
+    state.attempts += 1
+    state.retry_at = time.monotonic() + min(
+      self.__retry_delay * 2 ** (state.attempts - 1), MAX_FAILURE_RETRY_DELAY)
+
+  async def refresh_all(self, keys: Optional[List[data.ChartKey]] = None):
+    await self._refresh(list(self.__ranking_clients.keys if keys is None
+                             else keys))
+
+  async def get_index(self,
+    key: data.ChartKey = data.DEFAULT_CHART_KEY
+  ) -> chart.ChartIndex:
+    await self._refresh([key])
+
+    return self.__state(key).index
+
+  async def get_tracks(self,
+    key: data.ChartKey = data.DEFAULT_CHART_KEY
+  ) -> Sequence[api.Track]:
+    return (await self.get_index(key)).tracks
+
+  async def get_artists(self,
+    key: data.ChartKey = data.DEFAULT_CHART_KEY
+  ) -> Sequence[api.Artist]:
+    return (await self.get_index(key)).artists
+
+  def get_version(self,
+    key: data.ChartKey = data.DEFAULT_CHART_KEY
+  ) -> Optional[str]:
+    return self.__state(key).index.version
+
+  def get_hydration_failures(self,
+    key: data.ChartKey = data.DEFAULT_CHART_KEY
+  ) -> List[HydrationFailure]:
+    return self.__state(key).failures
@@ -1,86 +1,169 @@
 import logging
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional, List
+from typing import Optional, List, Callable, Awaitable, TypeVar
 
-from spotify import JST, user, api, service
+from spotify import JST, user, api, service, auth, data, chart, tracing, \
+  playlist, cache
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar('T')
+
+PLAYLIST_SIZE = 100
+
+
+def select_playlist_uris(
+  index: chart.ChartIndex,
+  user_data: user.UserData,
+  limit: int = PLAYLIST_SIZE
+) -> List[str]:
+  blocked = index.blocked_positions(user_data.blocking_tracks,
+                                    user_data.blocking_artists)
+
+  uris = []
+  for i, track in enumerate(index.tracks):
+    if i in blocked:
+      continue
+
+    uris.append(track.uri)
+    if len(uris) == limit:
+      break
+  return uris
+
 
 @dataclass()
 class UserService:
   __user_data: user.UserData
   __api_client: api.UserResourceApiClient
   __ranking_service: service.RankingService
+  __token_manager: auth.TokenManager
+  __playlist_store: Optional[playlist.PlaylistStore] = None
+  # profile_id -> プレイリストの一覧
+  __playlists_cache: Optional[cache.TtlCache] = None
 
-  def __refresh_token(self):
+  async def __call(self, fn: Callable[..., Awaitable[T]], *args, **kwargs) -> T:
+    # 期限が近いtokenは呼び出す前に更新しておく
     try:
-      token = self.__api_client.refresh_token()
+      with tracing.span('token'):
+        token = await self.__token_manager.get_user_token(self.__user_data)
+      self.__api_client.set_token(token)
+      try:
+        return await fn(*args, **kwargs)
+      except api.AccessTokenExpiredError:
+        with tracing.span('token'):
+          token = await self.__token_manager.refresh_user_token(
+            self.__user_data, token)
+        self.__api_client.set_token(token)
+        return await fn(*args, **kwargs)
     except api.AuthorizationError:
-      # refreshに失敗する場合は、user_dataからtokenを削除する
-      self.__user_data.token = None
-      self.__user_data.save()
       raise Exception("Failed to refresh token")
-    else:
-      self.__user_data.token = token
-      self.__user_data.save()
 
-  def get_profile(self) -> api.Profile:
+  async def get_profile(self) -> api.Profile:
     if profile := self.__user_data.profile:
       return profile
 
-    try:
-      profile = self.__api_client.get_current_user_profile()
-    except api.AccessTokenExpiredError:
-      self.__refresh_token()
-      profile = self.__api_client.get_current_user_profile()
+    profile = await self.__call(self.__api_client.get_current_user_profile)
 
     self.__user_data.profile = profile
     self.__user_data.save()
 
     return profile
 
-  def get_playlists(self) -> List[api.Playlist]:
-    try:
-      return self.__api_client.get_current_user_playlists()
-    except api.AccessTokenExpiredError:
-      self.__refresh_token()
-      return self.__api_client.get_current_user_playlists()
+  def __profile_id(self) -> Optional[str]:
+    return self.__user_data.profile.id if self.__user_data.profile else None
+
+  async def get_playlists(self) -> List[api.Playlist]:
+    profile_id = self.__profile_id()
+    if self.__playlists_cache is not None and profile_id:
+      if (playlists := self.__playlists_cache.get(profile_id)) is not None:
+        return playlists
+
+    playlists = await self.__call(self.__api_client.get_current_user_playlists)
+    if self.__playlists_cache is not None and profile_id:
+      self.__playlists_cache.put(profile_id, playlists)
+    return playlists
 
-  def replace_playlist(self, playlist_id: Optional[str] = None):
+  async def replace_playlist(self,
+    playlist_id: Optional[str] = None,
+    chart_key: data.ChartKey = data.DEFAULT_CHART_KEY
+  ):
     if playlist_id is None:
       if not (playlist_id := self.__user_data.reload_playlist_id):
         raise Exception("user data not contains reload_playlist_id")
 
     now = datetime.now(JST)
-    blocking_tracks = set(self.__user_data.blocking_tracks)
-    blocking_artists = set(self.__user_data.blocking_artists)
-    tracks = self.__ranking_service.get_tracks()
-
-    uris = []
-    for track in tracks:
-      blocked = False
-
-      for artist in track.artists:
-        if artist.id in blocking_artists:
-          blocked = True
-      if track.id in blocking_tracks:
-        blocked = True
-      if blocked:
-        continue
-
-      uris.append(track.uri)
-      if len(uris) == 100:
-        break
-    try:
-      self.__api_client.replace_playlist_items(playlist_id, uris)
-    except api.AccessTokenExpiredError:
-      self.__refresh_token()
-      self.__api_client.replace_playlist_items(playlist_id, uris)
+    index = await self.__ranking_service.get_index(chart_key)
+    with tracing.span('select'):
+      uris = select_playlist_uris(index, self.__user_data)
+
+    profile_id = self.__profile_id()
+    state = None
+    if self.__playlist_store is not None and profile_id:
+      state = self.__playlist_store.get(profile_id, playlist_id)
+    if state is not None:
+      # 他のアプリなどで変更されていたら、覚えている内容は使えない
+      snapshot_id = await self.__call(
+        self.__api_client.get_playlist_snapshot_id, playlist_id)
+      if snapshot_id != state.snapshot_id:
+        state = None
+      elif state.uris == uris:
+        logger.info("playlist items were not changed(playlist_id=%s)",
+                    playlist_id)
+        return
 
+    try:
+      snapshot_id = await self.__write_playlist(playlist_id, uris, state, now)
+    finally:
+      # snapshot_idが変わるので、一覧を取り直す
+      if self.__playlists_cache is not None and profile_id:
+        self.__playlists_cache.pop(profile_id)
+
+    if self.__playlist_store is not None and profile_id:
+      self.__playlist_store.put(profile_id, playlist_id,
+                                playlist.PlaylistState(uris, snapshot_id))
+
+  async def __write_playlist(self,
+    playlist_id: str,
+    uris: List[str],
+    state: Optional[playlist.PlaylistState],
+    now: datetime
+  ) -> Optional[str]:
+    # 説明の変更でもsnapshot_idが変わるので、アイテムより先に更新する
     description = f"{now.strftime('%Y-%m-%d %H:%M:%S')}更新"
-    self.__api_client.change_playlist_details(
-      playlist_id, description=description)
-
+    await self.__call(self.__api_client.change_playlist_details,
+                      playlist_id, description=description)
+
+    operations = None
+    if state is not None:
+      operations = playlist.diff_playlist(state.uris, uris)
+    if operations is not None and \
+        len(operations) <= playlist.MAX_OPERATIONS:
+      snapshot_id = await self.__update_items(playlist_id, operations)
+      logger.info("playlist items were updated(playlist_id=%s, operations=%d)",
+                  playlist_id, len(operations))
+      return snapshot_id
+
+    snapshot_id = await self.__call(self.__api_client.replace_playlist_items,
+                                    playlist_id, uris)
     logger.info("playlist items were replaced(playlist_id=%s)", playlist_id)
+    return snapshot_id
+
+  async def __update_items(self,
+    playlist_id: str,
+    operations: List[playlist.Operation]
+  ) -> Optional[str]:
+    snapshot_id = None
+    for operation in operations:
+      if isinstance(operation, playlist.RemoveItems):
+        snapshot_id = await self.__call(
+          self.__api_client.remove_playlist_items, playlist_id, operation.uris)
+      elif isinstance(operation, playlist.MoveItem):
+        snapshot_id = await self.__call(
+          self.__api_client.reorder_playlist_items, playlist_id,
+          operation.range_start, operation.insert_before)
+      else:
+        snapshot_id = await self.__call(
+          self.__api_client.add_playlist_items, playlist_id, operation.uris,
+          operation.position)
+    return snapshot_id
@@ -0,0 +1,113 @@
+import logging
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Dict
+
+import jwt
+
+from spotify import user
+from spotify.cache import TtlCache
+
+logger = logging.getLogger(__name__)
+
+JWT_ALG = "HS256"
+# GET /eventsにだけ使えるトークンのaud
+EVENTS_AUDIENCE = "events"
+
+
+class SessionError(Exception):
+  pass
+
+
+@dataclass(frozen=True)
+class Session:
+  profile_id: str
+  session_id: str
+  expires_at: float
+
+  @property
+  def user_data(self) -> user.UserData:
+    # UserStoreのキャッシュから取るので、ディスクは読まない
+    return user.get_user_data(self.profile_id)
+
+
+class SessionManager:
+  # 検証済みのJWTをキャッシュし、同じセッションからの呼び出しで毎回decodeしない
+
+  def __init__(self,
+    secret: str,
+    ttl: float = 30 * 24 * 60 * 60,
+    cache_size: int = 10000,
+    cache_ttl: float = 10 * 60,
+  ):
+    self.__secret = secret
+    self.ttl = ttl
+    self.__verified = TtlCache(cache_size, cache_ttl, 'session')
+    # session_id -> exp
+    self.__revoked: Dict[str, float] = {}
+
+  def issue(self, profile_id: str) -> str:
+    now = int(time.time())
+    return jwt.encode(
+      dict(sub=profile_id, iat=now, exp=now + int(self.ttl),
+           jti=uuid.uuid4().hex),
+      self.__secret,
+      JWT_ALG
+    )
+
+  def verify(self, token: str) -> Session:
+    if (session := self.__verified.get(token)) is not None:
+      if session.expires_at > time.time():
+        return session
+      self.__verified.pop(token)
+
+    try:
+      claims = jwt.decode(token, self.__secret, [JWT_ALG],
+                          options=dict(require=['exp', 'sub', 'jti']))
+    except jwt.PyJWTError as e:
+      raise SessionError(str(e)) from e
+
+    session = Session(claims['sub'], claims['jti'], claims['exp'])
+    if session.session_id in self.__revoked:
+      raise SessionError("Session was revoked")
+
+    self.__verified.put(token, session, session.expires_at - time.time())
+    return session
+
+  def issue_events_token(self, current: Session, ttl: float = 60) -> str:
+    # EventSourceはヘッダーを付けられずクエリで渡すので、アクセスログや履歴に
+    # 残ってもよいように、SSEにだけ使える短い期限のトークンを別に発行する
+    now = int(time.time())
+    return jwt.encode(
+      dict(sub=current.profile_id, aud=EVENTS_AUDIENCE, iat=now,
+           exp=min(now + int(ttl), int(current.expires_at)),
+           sid=current.session_id),
+      self.__secret,
+      JWT_ALG
+    )
+
+  def verify_events_token(self, token: str) -> Session:
+    # セッションのJWTはaudがないので、ここでは通らない(逆も同じ)
+    try:
+      claims = jwt.decode(token, self.__secret, [JWT_ALG],
+                          audience=EVENTS_AUDIENCE,
+                          options=dict(require=['exp', 'sub', 'sid', 'aud']))
+    except jwt.PyJWTError as e:
+      raise SessionError(str(e)) from e
+
+    if claims['sid'] in self.__revoked:
+      raise SessionError("Session was revoked")
+    return Session(claims['sub'], claims['sid'], claims['exp'])
+
+  def revoke(self, token: str):
+    session = self.verify(token)
+    self.__verified.pop(token)
+    self.__revoked[session.session_id] = session.expires_at
+    self._prune_revoked()
+
+  def _prune_revoked(self):
+    now = time.time()
+    for session_id, expires_at in list(self.__revoked.items()):
+      if expires_at <= now:
+        del self.__revoked[session_id]
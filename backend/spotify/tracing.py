@@ -0,0 +1,156 @@
+import cProfile
+import contextlib
+import datetime
+import logging
+import pathlib
+import random
+import re
+import time
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+from spotify import metrics
+
+logger = logging.getLogger(__name__)
+
+# リクエストごとに、どの処理に時間がかかったかを記録する
+# spanはcontextvarsで今のリクエストに紐づくので、関数の引数で渡さなくてよい
+
+
+class Trace:
+
+  def __init__(self):
+    self.started = time.perf_counter()
+    # name -> [合計時間, 回数]
+    self.spans: Dict[str, List[float]] = {}
+
+  def add(self, name: str, elapsed: float):
+    if (span := self.spans.get(name)) is None:
+      self.spans[name] = [elapsed, 1]
+    else:
+      span[0] += elapsed
+      span[1] += 1
+
+  def elapsed(self) -> float:
+    return time.perf_counter() - self.started
+
+  def server_timing(self, total: float) -> str:
+    # 並行して実行されたspanは合計するので、totalより長くなることもある
+    entries = [f'{name};dur={span[0] * 1000:.1f}'
+               for name, span in self.spans.items()]
+    entries.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(entries)
+
+  def log_fields(self) -> str:
+    return '\t'.join(f'span.{name}:{span[0] * 1000:.1f}'
+                     for name, span in self.spans.items())
+
+
+_current: ContextVar[Optional[Trace]] = ContextVar('trace', default=None)
+
+
+def current_trace() -> Optional[Trace]:
+  return _current.get()
+
+
+@contextlib.contextmanager
+def span(name: str):
+  # Server-Timingの名前に使うので、英数字と_だけにする
+  if (trace := _current.get()) is None:
+    yield
+    return
+  started = time.perf_counter()
+  try:
+    yield
+  finally:
+    trace.add(name, time.perf_counter() - started)
+
+
+class Profiler:
+  # 一部のリクエストをcProfileで計測し、遅かったものだけファイルに保存する
+  # プロファイラはスレッド全体にかかるので、同時に計測するのは1リクエストだけ
+  # (その間に並行して動いた他のリクエストの処理も含まれる)
+
+  def __init__(self,
+    directory: pathlib.Path,
+    threshold: float = 1.0,
+    sample_rate: float = 0.0
+  ):
+    self.directory = directory
+    self.threshold = threshold
+    self.sample_rate = sample_rate
+    self.__active = False
+
+  def start(self) -> Optional[cProfile.Profile]:
+    if self.__active or random.random() >= self.sample_rate:
+      return None
+    profile = cProfile.Profile()
+    try:
+      profile.enable()
+    except ValueError:
+      # 別のプロファイラが動いている
+      return None
+    self.__active = True
+    return profile
+
+  def stop(self,
+    profile: cProfile.Profile,
+    name: str,
+    elapsed: float
+  ) -> Optional[pathlib.Path]:
+    profile.disable()
+    self.__active = False
+    if elapsed < self.threshold:
+      return None
+
+    self.directory.mkdir(parents=True, exist_ok=True)
+    now = datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    name = re.sub(r'[^0-9A-Za-z]+', '_', name).strip('_') or 'root'
+    path = self.directory / f"{now}-{name}-{int(elapsed * 1000)}ms.prof"
+    profile.dump_stats(path)
+    return path
+
+
+class TracingMiddleware:
+  # Server-Timingヘッダーとリクエストごとのログを出力するASGIミドルウェア
+
+  def __init__(self, app, profiler: Optional[Profiler] = None):
+    self.app = app
+    self.profiler = profiler
+
+  async def __call__(self, scope, receive, send):
+    if scope['type'] != 'http':
+      return await self.app(scope, receive, send)
+
+    trace = Trace()
+    token = _current.set(trace)
+    profile = self.profiler.start() if self.profiler else None
+    status = 500
+
+    async def send_wrapper(message):
+      nonlocal status
+      if message['type'] == 'http.response.start':
+        status = message['status']
+        headers = list(message.get('headers', []))
+        headers.append((b'server-timing',
+                        trace.server_timing(trace.elapsed()).encode()))
+        message = {**message, 'headers': headers}
+      await send(message)
+
+    try:
+      await self.app(scope, receive, send_wrapper)
+    finally:
+      _current.reset(token)
+      elapsed = trace.elapsed()
+      route = metrics.route_path(scope)
+      fields = (f"method:{scope['method']}\tpath:{scope['path']}"
+                f"\troute:{route}\tstatus:{status}"
+                f"\tduration:{elapsed * 1000:.1f}")
+      if trace.spans:
+        fields += f"\t{trace.log_fields()}"
+      if profile is not None:
+        path = self.profiler.stop(profile, f"{scope['method']} {route}",
+                                  elapsed)
+        if path is not None:
+          fields += f"\tprofile:{path}"
+      logger.info(fields)
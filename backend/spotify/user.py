@@ -1,37 +1,55 @@
+import abc
+import dataclasses
 import json
 import logging
 import pathlib
-from typing import Optional, List
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional, List, Dict, Set, Union
 
-from spotify import api
+from spotify import api, config, metrics
+from spotify.data import write_atomic
 
 logger = logging.getLogger(__name__)
 
 USERDATA_DIR = pathlib.Path('tmp/')
-if not USERDATA_DIR.is_dir():
-  USERDATA_DIR.mkdir()
 
+TRACK = 'track'
+ARTIST = 'artist'
 
+
+class UserDataError(Exception):
+  pass
+
+
+@dataclass()
 class UserData:
   token: Optional[api.AuthorizationCodeFlowToken] = None
   profile: Optional[api.Profile] = None
-  blocking_tracks: List[str] = []
-  blocking_artists: List[str] = []
+  blocking_tracks: Set[str] = field(default_factory=set)
+  blocking_artists: Set[str] = field(default_factory=set)
   reload_playlist_id: Optional[str] = None
+  # ブロックリストを変更するたびに増やす(レスポンスキャッシュのキー)
+  blocking_version: int = 0
+  # チャートが更新されたら、プレイリストを自動で更新する
+  auto_refresh: bool = False
 
   def to_dict(self) -> dict:
     return dict(
       token=self.token.__dict__.copy() if self.token else None,
       profile=self.profile.__dict__.copy() if self.profile else None,
-      blocking_tracks=self.blocking_tracks,
-      blocking_artists=self.blocking_artists,
+      blocking_tracks=sorted(self.blocking_tracks),
+      blocking_artists=sorted(self.blocking_artists),
       reload_playlist_id=self.reload_playlist_id,
+      blocking_version=self.blocking_version,
+      auto_refresh=self.auto_refresh,
     )
 
   def save(self):
-    path = USERDATA_DIR / self.profile.id
-    with path.open('w') as f:
-      f.write(json.dumps(self.to_dict()))
+    get_store().save(self)
 
 
 def create_user_data_from_dict(o: dict) -> UserData:
@@ -40,23 +58,577 @@ def create_user_data_from_dict(o: dict) -> UserData:
     user_data.token = api.create_token_from_dict(token)
   if profile := o.get('profile'):
     user_data.profile = api.create_profile_from_dict(profile)
-  user_data.blocking_tracks = o.get('blocking_tracks', [])
-  user_data.blocking_artists = o.get('blocking_artists', [])
+  user_data.blocking_tracks = set(o.get('blocking_tracks', []))
+  user_data.blocking_artists = set(o.get('blocking_artists', []))
   user_data.reload_playlist_id = o.get('reload_playlist_id')
+  user_data.blocking_version = o.get('blocking_version', 0)
+  user_data.auto_refresh = o.get('auto_refresh', False)
 
   return user_data
 
 
+# saveでは書かない項目
+BLOCKING_KEYS = ('blocking_tracks', 'blocking_artists', 'blocking_version')
+EMPTY_BLOCKING = dict(blocking_tracks=[], blocking_artists=[],
+                      blocking_version=0)
+
+
+def apply_blocking(
+  user_data: UserData,
+  tracks: Dict[str, bool],
+  artists: Dict[str, bool]
+) -> bool:
+  changed = False
+  for blocking, changes in ((user_data.blocking_tracks, tracks),
+                            (user_data.blocking_artists, artists)):
+    for item_id, blocked in changes.items():
+      if blocked and item_id not in blocking:
+        blocking.add(item_id)
+        changed = True
+      elif not blocked and item_id in blocking:
+        blocking.discard(item_id)
+        changed = True
+  if changed:
+    user_data.blocking_version += 1
+  return changed
+
+
+def is_auto_refresh_target(user_data: UserData) -> bool:
+  return bool(user_data.auto_refresh and user_data.reload_playlist_id
+              and user_data.token)
+
+
+class UserStore(abc.ABC):
+
+  @abc.abstractmethod
+  def get(self, profile_id: str) -> Optional[UserData]:
+    pass
+
+  @abc.abstractmethod
+  def save(self, user_data: UserData):
+    # ブロックリスト(blocking_*)は書かない。書くのはupdate_blockingだけ
+    # (読み込んだ後にブロックリストが変わったUserDataで、変更を戻さないように)
+    pass
+
+  @abc.abstractmethod
+  def list_profile_ids(self) -> List[str]:
+    pass
+
+  @abc.abstractmethod
+  def list_auto_refresh_profile_ids(self) -> List[str]:
+    # 自動更新を有効にしていて、更新できる(プレイリストとtokenがある)ユーザー
+    pass
+
+  @abc.abstractmethod
+  def update_blocking(self,
+    profile_id: str,
+    tracks: Dict[str, bool],
+    artists: Dict[str, bool]
+  ) -> Optional[UserData]:
+    # ブロックリストだけを更新し、更新後のUserDataを返す
+    pass
+
+  def flush(self):
+    # 書き込み待ちのUserDataを書き込む
+    pass
+
+  def close(self):
+    pass
+
+
+class JsonUserStore(UserStore):
+  # ユーザーごとにJSONファイルを1つ持つ(以前の形式)
+
+  def __init__(self, directory: pathlib.Path = USERDATA_DIR):
+    self.directory = directory
+    self.directory.mkdir(parents=True, exist_ok=True)
+
+  def __read(self, path: pathlib.Path) -> Optional[dict]:
+    if not path.is_file():
+      return None
+    try:
+      with path.open() as f:
+        return json.load(f)
+    except ValueError as e:
+      raise UserDataError(f"Failed to load {path}: {e!r}") from e
+
+  def __write(self, user_data: UserData, blocking_from: Optional[dict] = None):
+    o = user_data.to_dict()
+    if blocking_from is not None:
+      for key in BLOCKING_KEYS:
+        o[key] = blocking_from.get(key, o[key])
+    path = self.directory / user_data.profile.id
+    write_atomic(path, json.dumps(o).encode('utf-8'))
+
+  def get(self, profile_id: str) -> Optional[UserData]:
+    path = self.directory / profile_id
+    if (o := self.__read(path)) is None:
+      return None
+
+    try:
+      user_data = create_user_data_from_dict(o)
+    except (ValueError, KeyError, TypeError) as e:
+      raise UserDataError(f"Failed to load {path}: {e!r}") from e
+    logger.info("USER_DATA was loaded from file")
+    return user_data
+
+  def save(self, user_data: UserData):
+    # ブロックリストはファイルにあるものを残す(新しいファイルなら空にする)
+    current = self.__read(self.directory / user_data.profile.id)
+    self.__write(user_data, current if current is not None else EMPTY_BLOCKING)
+
+  def list_profile_ids(self) -> List[str]:
+    return sorted(p.name for p in self.directory.iterdir()
+                  if p.is_file() and not p.name.startswith('.'))
+
+  def list_auto_refresh_profile_ids(self) -> List[str]:
+    # 索引がないので、全員のファイルを読む
+    profile_ids = []
+    for profile_id in self.list_profile_ids():
+      try:
+        user_data = self.get(profile_id)
+      except UserDataError as e:
+        logger.error("Skipped %s: %s", profile_id, e)
+        continue
+      if user_data is not None and is_auto_refresh_target(user_data):
+        profile_ids.append(profile_id)
+    return profile_ids
+
+  def update_blocking(self,
+    profile_id: str,
+    tracks: Dict[str, bool],
+    artists: Dict[str, bool]
+  ) -> Optional[UserData]:
+    user_data = self.get(profile_id)
+    if user_data is None:
+      return None
+    if apply_blocking(user_data, tracks, artists):
+      self.__write(user_data)
+    return user_data
+
+
+SCHEMA = """
+PRAGMA journal_mode=WAL;
+CREATE TABLE IF NOT EXISTS users (
+  profile_id TEXT PRIMARY KEY,
+  token TEXT,
+  profile TEXT,
+  reload_playlist_id TEXT,
+  blocking_version INTEGER NOT NULL DEFAULT 0,
+  auto_refresh INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS blocking (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  profile_id TEXT NOT NULL,
+  kind TEXT NOT NULL,
+  item_id TEXT NOT NULL,
+  UNIQUE (profile_id, kind, item_id)
+);
+"""
+
+
+class SqliteUserStore(UserStore):
+
+  def __init__(self, path: Union[str, pathlib.Path]):
+    self.__lock = threading.Lock()
+    self.__conn = sqlite3.connect(str(path), check_same_thread=False)
+    self.__conn.executescript(SCHEMA)
+    # 以前のスキーマで作られたファイルに列を足す
+    columns = {row[1] for row in
+               self.__conn.execute("PRAGMA table_info(users)").fetchall()}
+    if 'auto_refresh' not in columns:
+      self.__conn.execute("ALTER TABLE users ADD COLUMN"
+                          " auto_refresh INTEGER NOT NULL DEFAULT 0")
+
+  def get(self, profile_id: str) -> Optional[UserData]:
+    with self.__lock:
+      row = self.__conn.execute(
+        "SELECT token, profile, reload_playlist_id, blocking_version,"
+        " auto_refresh FROM users WHERE profile_id = ?",
+        (profile_id,)).fetchone()
+      if row is None:
+        return None
+      blocking = self.__conn.execute(
+        "SELECT kind, item_id FROM blocking WHERE profile_id = ?",
+        (profile_id,)).fetchall()
+
+    token, profile, reload_playlist_id, blocking_version, auto_refresh = row
+    user_data = UserData()
+    if token:
+      user_data.token = api.create_token_from_dict(json.loads(token))
+    if profile:
+      user_data.profile = api.create_profile_from_dict(json.loads(profile))
+    user_data.reload_playlist_id = reload_playlist_id
+    user_data.blocking_version = blocking_version
+    user_data.auto_refresh = bool(auto_refresh)
+    user_data.blocking_tracks = {i for k, i in blocking if k == TRACK}
+    user_data.blocking_artists = {i for k, i in blocking if k == ARTIST}
+    return user_data
+
+  def __upsert(self, user_data: UserData):
+    # blockingとblocking_versionはupdate_blockingとimport_user_dataだけが書く
+    profile_id = user_data.profile.id
+    d = user_data.to_dict()
+    token = json.dumps(d['token']) if d['token'] else None
+    profile = json.dumps(d['profile']) if d['profile'] else None
+    self.__conn.execute(
+      "INSERT INTO users (profile_id, token, profile, reload_playlist_id,"
+      " auto_refresh) VALUES (?, ?, ?, ?, ?)"
+      " ON CONFLICT (profile_id) DO UPDATE SET token = excluded.token,"
+      " profile = excluded.profile,"
+      " reload_playlist_id = excluded.reload_playlist_id,"
+      " auto_refresh = excluded.auto_refresh",
+      (profile_id, token, profile, user_data.reload_playlist_id,
+       int(user_data.auto_refresh)))
+
+  def save(self, user_data: UserData):
+    with self.__lock, self.__conn:
+      self.__upsert(user_data)
+
+  def import_user_data(self, user_data: UserData):
+    # 移行用。ブロックリストも含めて、user_dataの内容で置き換える
+    profile_id = user_data.profile.id
+    with self.__lock, self.__conn:
+      self.__upsert(user_data)
+      self.__conn.execute(
+        "UPDATE users SET blocking_version = ? WHERE profile_id = ?",
+        (user_data.blocking_version, profile_id))
+      self.__conn.execute("DELETE FROM blocking WHERE profile_id = ?",
+                          (profile_id,))
+      self.__conn.executemany(
+        "INSERT OR IGNORE INTO blocking (profile_id, kind, item_id)"
+        " VALUES (?, ?, ?)",
+        [(profile_id, TRACK, i) for i in user_data.blocking_tracks] +
+        [(profile_id, ARTIST, i) for i in user_data.blocking_artists])
+
+  def list_profile_ids(self) -> List[str]:
+    with self.__lock:
+      rows = self.__conn.execute(
+        "SELECT profile_id FROM users ORDER BY profile_id").fetchall()
+    return [row[0] for row in rows]
+
+  def list_auto_refresh_profile_ids(self) -> List[str]:
+    with self.__lock:
+      rows = self.__conn.execute(
+        "SELECT profile_id FROM users WHERE auto_refresh = 1"
+        " AND reload_playlist_id IS NOT NULL AND reload_playlist_id != ''"
+        " AND token IS NOT NULL ORDER BY profile_id").fetchall()
+    return [row[0] for row in rows]
+
+  def update_blocking(self,
+    profile_id: str,
+    tracks: Dict[str, bool],
+    artists: Dict[str, bool]
+  ) -> Optional[UserData]:
+    changes = [(TRACK, i, b) for i, b in tracks.items()] + \
+              [(ARTIST, i, b) for i, b in artists.items()]
+    added = [(profile_id, kind, i) for kind, i, b in changes if b]
+    removed = [(profile_id, kind, i) for kind, i, b in changes if not b]
+    # まとめて1つのトランザクションで書き込む
+    with self.__lock, self.__conn:
+      if self.__conn.execute("SELECT 1 FROM users WHERE profile_id = ?",
+                             (profile_id,)).fetchone() is None:
+        return None
+      changed = self.__conn.executemany(
+        "INSERT OR IGNORE INTO blocking (profile_id, kind, item_id)"
+        " VALUES (?, ?, ?)", added).rowcount
+      changed += self.__conn.executemany(
+        "DELETE FROM blocking WHERE profile_id = ? AND kind = ? AND item_id = ?",
+        removed).rowcount
+      if changed:
+        self.__conn.execute(
+          "UPDATE users SET blocking_version = blocking_version + 1"
+          " WHERE profile_id = ?", (profile_id,))
+    return self.get(profile_id)
+
+  def close(self):
+    with self.__lock:
+      self.__conn.close()
+
+
+class CachedUserStore(UserStore):
+  # よく使うユーザーのUserDataをメモリに持ち、ディスクを読まないようにする
+
+  def __init__(self, store: UserStore, max_size: int = 1024):
+    self.store = store
+    self.max_size = max_size
+    self.__entries: 'OrderedDict[str, UserData]' = OrderedDict()
+    self.__store_name = type(store).__name__
+
+  def __observe(self, operation: str, started: float):
+    metrics.USER_STORE_DURATION.observe(time.perf_counter() - started,
+                                        self.__store_name, operation)
+
+  def __put(self, profile_id: str, user_data: UserData):
+    self.__entries[profile_id] = user_data
+    self.__entries.move_to_end(profile_id)
+    while len(self.__entries) > self.max_size:
+      self.__entries.popitem(last=False)
+
+  def get(self, profile_id: str) -> Optional[UserData]:
+    if (user_data := self.__entries.get(profile_id)) is not None:
+      metrics.cache_result('user', True)
+      self.__entries.move_to_end(profile_id)
+      return user_data
+
+    metrics.cache_result('user', False)
+    started = time.perf_counter()
+    user_data = self.store.get(profile_id)
+    self.__observe('get', started)
+    if user_data is not None:
+      self.__put(profile_id, user_data)
+    return user_data
+
+  def save(self, user_data: UserData):
+    started = time.perf_counter()
+    self.store.save(user_data)
+    self.__observe('save', started)
+    profile_id = user_data.profile.id
+    if self.__entries.get(profile_id) is user_data:
+      self.__entries.move_to_end(profile_id)
+    else:
+      # キャッシュにないUserDataは、ブロックリストが古いかもしれないので入れない
+      # (次のgetでストアから読み直す)
+      self.__entries.pop(profile_id, None)
+
+  def list_profile_ids(self) -> List[str]:
+    return self.store.list_profile_ids()
+
+  def list_auto_refresh_profile_ids(self) -> List[str]:
+    # キャッシュを通さない(全員を読み込んでLRUを追い出さないように)
+    return self.store.list_auto_refresh_profile_ids()
+
+  def update_blocking(self,
+    profile_id: str,
+    tracks: Dict[str, bool],
+    artists: Dict[str, bool]
+  ) -> Optional[UserData]:
+    started = time.perf_counter()
+    user_data = self.store.update_blocking(profile_id, tracks, artists)
+    self.__observe('update_blocking', started)
+    if user_data is None:
+      self.__entries.pop(profile_id, None)
+      return None
+    if (cached := self.__entries.get(profile_id)) is not None:
+      # 参照を持っている呼び出し元にも反映されるように、同じオブジェクトを更新する
+      cached.blocking_tracks = user_data.blocking_tracks
+      cached.blocking_artists = user_data.blocking_artists
+      cached.blocking_version = user_data.blocking_version
+      user_data = cached
+    self.__put(profile_id, user_data)
+    return user_data
+
+  def invalidate(self, profile_id: str):
+    self.__entries.pop(profile_id, None)
+
+  def flush(self):
+    self.store.flush()
+
+  def close(self):
+    self.store.close()
+
+
+def copy_user_data(user_data: UserData) -> UserData:
+  # tokenやprofileは更新のたびに別のオブジェクトになるので、浅いコピーでよい
+  return dataclasses.replace(user_data,
+                             blocking_tracks=set(user_data.blocking_tracks),
+                             blocking_artists=set(user_data.blocking_artists))
+
+
+class WriteBehindUserStore(UserStore):
+  # saveでは書き込み待ちにするだけで、delay秒の間の保存をまとめて別スレッドで書き込む
+  # リクエストの処理はディスクへの書き込みを待たない
+
+  def __init__(self, store: UserStore, delay: float = 0.5):
+    self.store = store
+    self.delay = delay
+    self.__condition = threading.Condition()
+    # 書き込み待ちと、書き込み中のUserData
+    self.__dirty: Dict[str, UserData] = {}
+    self.__writing: Dict[str, UserData] = {}
+    self.__flush_lock = threading.Lock()
+    self.__closed = False
+    self.__store_name = type(store).__name__
+    self.__thread = threading.Thread(target=self.__run, name='user-writer',
+                                     daemon=True)
+    self.__thread.start()
+
+  def __run(self):
+    while True:
+      with self.__condition:
+        while not self.__dirty and not self.__closed:
+          self.__condition.wait()
+        # 続けて呼ばれる保存(token更新の後のprofile更新など)をまとめる
+        # closeされたら待たずに抜ける(残りはcloseが書き込む)
+        deadline = time.monotonic() + self.delay
+        while not self.__closed \
+            and (remaining := deadline - time.monotonic()) > 0:
+          self.__condition.wait(remaining)
+        if self.__closed:
+          return
+      self.__flush()
+
+  def __flush(self, profile_id: Optional[str] = None) -> List[str]:
+    # 書き込めなかったprofile_idを返す
+    failed = []
+    with self.__flush_lock:
+      with self.__condition:
+        if profile_id is None:
+          pending, self.__dirty = self.__dirty, {}
+        elif profile_id in self.__dirty:
+          pending = {profile_id: self.__dirty.pop(profile_id)}
+        else:
+          return failed
+        self.__writing.update(pending)
+
+      for key, user_data in pending.items():
+        started = time.perf_counter()
+        try:
+          self.store.save(user_data)
+        except Exception:
+          logger.exception("Failed to save user data(profile_id=%s)", key)
+          failed.append(key)
+        metrics.USER_STORE_DURATION.observe(time.perf_counter() - started,
+                                            self.__store_name, 'flush')
+        with self.__condition:
+          self.__writing.pop(key, None)
+          # 捨てずに書き込み待ちに戻し、次のflushで書き直す
+          # (その間に新しく保存されていれば、そちらを書く)
+          if key in failed and key not in self.__dirty:
+            self.__dirty[key] = user_data
+            self.__condition.notify()
+    return failed
+
+  def get(self, profile_id: str) -> Optional[UserData]:
+    with self.__condition:
+      pending = self.__dirty.get(profile_id) or \
+                self.__writing.get(profile_id)
+    user_data = self.store.get(profile_id)
+    if pending is None:
+      return user_data
+    # 書き込み待ちの内容を返す。ただしブロックリストはsaveでは書かないので、ストアのもの
+    pending = copy_user_data(pending)
+    if user_data is not None:
+      pending.blocking_tracks = user_data.blocking_tracks
+      pending.blocking_artists = user_data.blocking_artists
+      pending.blocking_version = user_data.blocking_version
+    return pending
+
+  def save(self, user_data: UserData):
+    # 書き込みの途中で呼び出し元が変更しても混ざらないように、コピーを保存する
+    snapshot = copy_user_data(user_data)
+    with self.__condition:
+      if self.__closed:
+        raise UserDataError("Store was closed")
+      self.__dirty[user_data.profile.id] = snapshot
+      self.__condition.notify()
+
+  def list_profile_ids(self) -> List[str]:
+    self.__flush()
+    return self.store.list_profile_ids()
+
+  def list_auto_refresh_profile_ids(self) -> List[str]:
+    # 書き込みを待たず、書き込み待ちの内容で補正する
+    profile_ids = set(self.store.list_auto_refresh_profile_ids())
+    with self.__condition:
+      pending = {**self.__writing, **self.__dirty}
+    for profile_id, user_data in pending.items():
+      if is_auto_refresh_target(user_data):
+        profile_ids.add(profile_id)
+      else:
+        profile_ids.discard(profile_id)
+    return sorted(profile_ids)
+
+  def update_blocking(self,
+    profile_id: str,
+    tracks: Dict[str, bool],
+    artists: Dict[str, bool]
+  ) -> Optional[UserData]:
+    # まだ書き込んでいないユーザーも見つかるように、先に書き込んでおく
+    if self.__flush(profile_id):
+      raise UserDataError(f"Failed to save user data(profile_id={profile_id})")
+    return self.store.update_blocking(profile_id, tracks, artists)
+
+  def flush(self):
+    self.__flush()
+
+  def close(self):
+    with self.__condition:
+      self.__closed = True
+      self.__condition.notify_all()
+    self.__thread.join()
+    self.__flush()
+    self.store.close()
+
+
+def create_user_store() -> UserStore:
+  if config.get_user_store_type() == 'json':
+    store = JsonUserStore(USERDATA_DIR)
+  else:
+    store = SqliteUserStore(config.get_data_dir() / 'users.sqlite3')
+  if (delay := config.get_user_write_delay()) > 0:
+    store = WriteBehindUserStore(store, delay)
+  return CachedUserStore(store, config.get_user_cache_size())
+
+
+__store: Optional[UserStore] = None
+
+
+def get_store() -> UserStore:
+  global __store
+  if __store is None:
+    __store = create_user_store()
+  return __store
+
+
+def set_store(store: Optional[UserStore]):
+  global __store
+  __store = store
+
+
 def get_user_data(profile_id: str) -> UserData:
-  path = USERDATA_DIR / profile_id
-  if not path.is_file():
+  user_data = get_store().get(profile_id)
+  if user_data is None:
     return UserData()
+  return user_data
+
+
+def update_blocking(
+  profile_id: str,
+  tracks: Optional[Dict[str, bool]] = None,
+  artists: Optional[Dict[str, bool]] = None
+) -> Optional[UserData]:
+  return get_store().update_blocking(profile_id, tracks or {}, artists or {})
+
+
+def list_profile_ids() -> List[str]:
+  return get_store().list_profile_ids()
+
 
-  with path.open() as f:
+def list_auto_refresh_profile_ids() -> List[str]:
+  return get_store().list_auto_refresh_profile_ids()
+
+
+def flush():
+  get_store().flush()
+
+
+def migrate_json_users(
+  directory: pathlib.Path,
+  store: SqliteUserStore
+) -> List[str]:
+  source = JsonUserStore(directory)
+  migrated = []
+  for profile_id in source.list_profile_ids():
     try:
-      d = json.load(f)
-      user_data = create_user_data_from_dict(d)
-      logger.info("USER_DATA was loaded from file")
-      return user_data
-    except:
-      return UserData()
+      user_data = source.get(profile_id)
+    except UserDataError as e:
+      logger.error("Skipped %s: %s", profile_id, e)
+      continue
+    if user_data is None or user_data.profile is None:
+      logger.warning("Skipped %s: no profile", profile_id)
+      continue
+    store.import_user_data(user_data)
+    migrated.append(profile_id)
+
+  return migrated
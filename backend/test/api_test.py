@@ -1,11 +1,21 @@
+import asyncio
 import unittest
 
-from spotify import api, config, data
+import httpx
 
+from spotify import api, auth, config, data
+from spotify.http_client import HttpClient, HttpSettings
 
-class ApiTest(unittest.TestCase):
 
-  def test_invalid_secrets(self):
+class ApiTest(unittest.IsolatedAsyncioTestCase):
+
+  async def asyncSetUp(self):
+    self.http_client = HttpClient()
+
+  async def asyncTearDown(self):
+    await self.http_client.aclose()
+
+  async def test_invalid_secrets(self):
     credentials = api.ClientCredentials('test_id', 'test_secret')
     token = api.AuthorizationCodeFlowToken(
       'test',
@@ -15,20 +25,130 @@ class ApiTest(unittest.TestCase):
       "test"
     )
 
-    client = api.UserResourceApiClient(credentials, token)
-    client.get_current_user_playlists()
+    client = api.UserResourceApiClient(credentials, self.http_client, token)
+    await client.get_current_user_playlists()
 
-  def test_get_several_tracks(self):
-    ranking = data.RankingClient()
-    song = ranking.get_song_list()[0]
+  async def test_get_several_tracks(self):
+    ranking = data.RankingClient(self.http_client)
+    song = (await ranking.get_song_list())[0]
     credentials = config.get_client_credentials()
 
-    client = api.ApiClient(credentials)
-    tracks = client.get_several_tracks([song.id])
+    client = api.ApiClient(
+      self.http_client, auth.TokenManager(credentials, self.http_client))
+    tracks = await client.get_several_tracks([song.id])
     self.assertTrue(tracks)
     track = tracks[0]
     print(track.id, track.name)
 
 
+class ApiClientTest(unittest.IsolatedAsyncioTestCase):
+
+  def handler(self, request: httpx.Request) -> httpx.Response:
+    self.requests.append(request)
+    if request.url.path == '/api/token':
+      return httpx.Response(200, json=dict(
+        access_token='access', token_type='Bearer', expires_in=3600))
+    if request.url.path == '/v1/tracks':
+      ids = request.url.params['ids'].split(',')
+      return httpx.Response(200, json=dict(tracks=[dict(
+        id=i, name=f"name-{i}", popularity=50,
+        artists=[dict(id=f"artist-{i}", name=f"artist-{i}")],
+      ) for i in ids]))
+    return httpx.Response(404)
+
+  async def asyncSetUp(self):
+    self.requests = []
+    self.http_client = HttpClient(
+      transport=httpx.MockTransport(self.handler))
+    credentials = api.ClientCredentials('test_id', 'test_secret')
+    self.client = api.ApiClient(
+      self.http_client, auth.TokenManager(credentials, self.http_client))
+
+  async def asyncTearDown(self):
+    await self.http_client.aclose()
+
+  async def test_get_several_tracks(self):
+    tracks = await self.client.get_several_tracks(['a', 'b'])
+    self.assertEqual(['a', 'b'], [t.id for t in tracks])
+    self.assertEqual('spotify:artist:artist-a', tracks[0].artists[0].uri)
+
+    await self.client.get_several_tracks(['c'])
+    # tokenは一度だけ取得する
+    paths = [r.url.path for r in self.requests]
+    self.assertEqual(['/api/token', '/v1/tracks', '/v1/tracks'], paths)
+    self.assertEqual('Bearer access',
+                     self.requests[-1].headers['Authorization'])
+
+
+class UserResourceApiClientTest(unittest.IsolatedAsyncioTestCase):
+
+  def handler(self, request: httpx.Request) -> httpx.Response:
+    self.requests.append(request)
+    if self.responses:
+      return self.responses.pop(0)
+    return httpx.Response(200, json=dict(snapshot_id='s2'))
+
+  async def asyncSetUp(self):
+    self.requests = []
+    self.responses = []
+    self.http_client = HttpClient(
+      HttpSettings(max_retries=2, backoff_base=0.001),
+      transport=httpx.MockTransport(self.handler))
+    credentials = api.ClientCredentials('test_id', 'test_secret')
+    token = api.AuthorizationCodeFlowToken(
+      'access', 'Bearer', 'playlist-modify-private', 3600, 'refresh')
+    self.client = api.UserResourceApiClient(
+      credentials, self.http_client, token)
+
+  async def asyncTearDown(self):
+    await self.http_client.aclose()
+
+  async def test_reorder_not_retried(self):
+    # 最初の並べ替えが反映されていれば、再送すると別の曲が動いてしまう
+    self.responses = [httpx.Response(503)]
+    with self.assertRaises(api.ApiError):
+      await self.client.reorder_playlist_items('p1', 3, 0)
+    self.assertEqual(1, len(self.requests))
+    self.assertEqual('PUT', self.requests[0].method)
+
+  async def test_replace_retried(self):
+    self.responses = [httpx.Response(503)]
+    snapshot_id = await self.client.replace_playlist_items('p1', ['uri'])
+    self.assertEqual('s2', snapshot_id)
+    self.assertEqual(2, len(self.requests))
+
+
+  async def test_limit_concurrent_playlist_pages(self):
+    in_flight = []
+    total = 20 * api.MAX_PLAYLISTS_PER_PAGE
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+      in_flight.append(1)
+      self.max_in_flight = max(self.max_in_flight, len(in_flight))
+      await asyncio.sleep(0.001)
+      in_flight.pop()
+      offset = int(request.url.params['offset'])
+      limit = int(request.url.params['limit'])
+      return httpx.Response(200, json=dict(total=total, items=[dict(
+        id=f'p{i}', name='name', public=False, uri='uri',
+        owner=dict(id='a'), snapshot_id='s',
+      ) for i in range(offset, min(offset + limit, total))]))
+
+    self.max_in_flight = 0
+    http_client = HttpClient(HttpSettings(rate_limit=0),
+                             transport=httpx.MockTransport(handler))
+    credentials = api.ClientCredentials('test_id', 'test_secret')
+    token = api.AuthorizationCodeFlowToken(
+      'access', 'Bearer', 'playlist-read-private', 3600, 'refresh')
+    client = api.UserResourceApiClient(credentials, http_client, token)
+    try:
+      playlists = await client.get_current_user_playlists(concurrency=3)
+    finally:
+      await http_client.aclose()
+    self.assertEqual([f'p{i}' for i in range(total)],
+                     [p.id for p in playlists])
+    self.assertEqual(3, self.max_in_flight)
+
+
 if __name__ == '__main__':
   unittest.main()
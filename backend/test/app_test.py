@@ -0,0 +1,187 @@
+import json
+import pathlib
+import tempfile
+import unittest
+from typing import Optional
+from unittest import mock
+
+from fastapi.testclient import TestClient
+
+from spotify import api, chart, config, user
+from spotify import response as response_module
+
+
+app = None
+directory: Optional[tempfile.TemporaryDirectory] = None
+
+
+def setUpModule():
+  # secret.jsonとデータの置き場所を一時ディレクトリにしてappを読み込む
+  global app, directory
+  directory = tempfile.TemporaryDirectory()
+  path = pathlib.Path(directory.name)
+  secret = path / 'secret.json'
+  secret.write_text(json.dumps(dict(
+    client_id='id', client_secret='secret', jwt_secret='secret' * 6)))
+  with mock.patch.object(config, 'SECRET_PATH', secret), \
+      mock.patch.object(config, 'DATA_DIR', path / 'data'):
+    from spotify import app
+
+
+def tearDownModule():
+  directory.cleanup()
+
+
+class AppTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.app = app
+    user.set_store(user.CachedUserStore(user.SqliteUserStore(':memory:')))
+    user_data = user.UserData()
+    user_data.profile = api.Profile('a', 'name', 'uri', 'JP')
+    user_data.save()
+    self.client = TestClient(app.app)
+    self.headers = {
+      'Authorization': f"Bearer {app.session_manager.issue('a')}"}
+
+  def tearDown(self):
+    user.get_store().close()
+    user.set_store(None)
+
+
+class BlockingRouteTest(AppTestCase):
+
+  def post(self, body: dict, headers=None):
+    return self.client.post('/blocking', json=body,
+                            headers=headers or self.headers)
+
+  def test_post_blocking(self):
+    self.app.response_cache.put('a', 1, b'{}')
+    response = self.post(dict(tracks={'t1': True, 't2': True},
+                              artists={'a1': True}))
+    self.assertEqual(200, response.status_code)
+    self.assertEqual(dict(blockingVersion=1), response.json())
+    self.assertEqual({'t1', 't2'}, user.get_user_data('a').blocking_tracks)
+    # ミュートが変わったので、キャッシュしたレスポンスは使わない
+    self.assertIsNone(self.app.response_cache.get('a', 1))
+
+    response = self.post(dict(tracks={'t1': False}))
+    self.assertEqual(dict(blockingVersion=2), response.json())
+    self.assertEqual({'t2'}, user.get_user_data('a').blocking_tracks)
+
+  def test_too_many_changes(self):
+    limit = self.app.MAX_BLOCKING_CHANGES
+    tracks = {f't{i}': True for i in range(limit)}
+    response = self.post(dict(tracks=tracks, artists={'a1': True}))
+    self.assertEqual(400, response.status_code)
+    self.assertEqual(set(), user.get_user_data('a').blocking_tracks)
+
+    response = self.post(dict(tracks=tracks))
+    self.assertEqual(200, response.status_code)
+    self.assertEqual(limit, len(user.get_user_data('a').blocking_tracks))
+
+  def test_unknown_user(self):
+    headers = {
+      'Authorization': f"Bearer {self.app.session_manager.issue('b')}"}
+    response = self.post(dict(tracks={'t1': True}), headers)
+    self.assertEqual(404, response.status_code)
+
+
+class CachedResponseRouteTest(AppTestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.app.response_cache.invalidate('a')
+    tracks = [api.Track(f't{i}', f'track-{i}', 50,
+                        [api.Artist(f'a{i}', f'artist-{i}')])
+              for i in range(50)]
+    index = chart.build_chart_index(tracks, 'v1', 1)
+    ranking_service = mock.patch.object(
+      self.app, 'ranking_service',
+      mock.Mock(get_index=mock.AsyncMock(return_value=index)))
+    playlists = [api.Playlist(f'p{i}', f'playlist-{i}', False, 'uri', 'a',
+                              f's{i}') for i in range(20)]
+    api_service = mock.patch.object(
+      self.app, 'get_api_service',
+      lambda profile_id: mock.Mock(
+        get_playlists=mock.AsyncMock(return_value=playlists)))
+    for patcher in (ranking_service, api_service):
+      patcher.start()
+      self.addCleanup(patcher.stop)
+
+  def get(self, path: str, **headers):
+    return self.client.get(path, headers={**self.headers, **headers})
+
+  def test_not_modified(self):
+    for path in ['/tracks_and_artists', '/playlists']:
+      with self.subTest(path=path):
+        response = self.get(path, **{'Accept-Encoding': 'identity'})
+        self.assertEqual(200, response.status_code)
+        etag = response.headers['ETag']
+        self.assertTrue(etag)
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertNotIn('Content-Encoding', response.headers)
+
+        response = self.get(path, **{'Accept-Encoding': 'identity',
+                                     'If-None-Match': etag})
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(b'', response.content)
+        self.assertEqual(etag, response.headers['ETag'])
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+
+        response = self.get(path, **{'Accept-Encoding': 'identity',
+                                     'If-None-Match': '"other"'})
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.content)
+
+  def test_etag_per_encoding(self):
+    encodings = ['identity', response_module.GZIP]
+    if response_module.brotli is not None:
+      encodings.append(response_module.BROTLI)
+    etags = {}
+    for encoding in encodings:
+      response = self.get('/tracks_and_artists',
+                          **{'Accept-Encoding': encoding})
+      self.assertEqual(200, response.status_code)
+      if encoding != 'identity':
+        self.assertEqual(encoding, response.headers['Content-Encoding'])
+      etags[encoding] = response.headers['ETag']
+      # 別の表現のETagでは304にしない
+      other = [e for e in etags.values() if e != etags[encoding]]
+      for etag in other:
+        response = self.get('/tracks_and_artists',
+                            **{'Accept-Encoding': encoding,
+                               'If-None-Match': etag})
+        self.assertEqual(200, response.status_code)
+    self.assertEqual(len(encodings), len(set(etags.values())))
+
+    response = self.get('/tracks_and_artists', **{
+      'Accept-Encoding': response_module.GZIP,
+      'If-None-Match': etags[response_module.GZIP]})
+    self.assertEqual(304, response.status_code)
+
+
+class HistoryRouteTest(AppTestCase):
+
+  def setUp(self):
+    super().setUp()
+    history_store = mock.patch.object(
+      self.app, 'history_store',
+      mock.Mock(get_track=mock.Mock(return_value=None),
+                get_top_movers=mock.Mock(return_value=None)))
+    history_store.start()
+    self.addCleanup(history_store.stop)
+
+  def test_require_session(self):
+    for path in ['/history/tracks/t1', '/history/movers']:
+      with self.subTest(path=path):
+        self.assertEqual(400, self.client.get(path).status_code)
+        response = self.client.get(
+          path, headers={'Authorization': 'Bearer invalid'})
+        self.assertEqual(403, response.status_code)
+        response = self.client.get(path, headers=self.headers)
+        self.assertEqual(404, response.status_code)
+
+
+if __name__ == '__main__':
+  unittest.main()
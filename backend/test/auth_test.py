@@ -0,0 +1,86 @@
+import asyncio
+import time
+import unittest
+
+import httpx
+
+from spotify import api, auth, user
+from spotify.http_client import HttpClient
+
+
+class TokenManagerTest(unittest.IsolatedAsyncioTestCase):
+
+  def handler(self, request: httpx.Request) -> httpx.Response:
+    self.requests.append(request)
+    if b'grant_type=refresh_token' in request.content:
+      if self.revoked:
+        return httpx.Response(400, json=dict(error='invalid_grant'))
+      return httpx.Response(200, json=dict(
+        access_token=f"user-{len(self.requests)}", token_type='Bearer',
+        scope='scope', expires_in=3600))
+    return httpx.Response(200, json=dict(
+      access_token=f"client-{len(self.requests)}", token_type='Bearer',
+      expires_in=self.expires_in))
+
+  async def asyncSetUp(self):
+    self.requests = []
+    self.revoked = False
+    self.expires_in = 3600
+    self.http_client = HttpClient(transport=httpx.MockTransport(self.handler))
+    self.token_manager = auth.TokenManager(
+      api.ClientCredentials('id', 'secret'), self.http_client, margin=60)
+    user.set_store(user.SqliteUserStore(':memory:'))
+
+    self.user_data = user.UserData()
+    self.user_data.profile = api.Profile('a', 'name', 'uri', 'JP')
+    self.user_data.token = api.AuthorizationCodeFlowToken(
+      'old', 'Bearer', 'scope', 3600, 'refresh', time.time() + 30)
+    self.user_data.save()
+
+  async def asyncTearDown(self):
+    await self.http_client.aclose()
+    user.get_store().close()
+    user.set_store(None)
+
+  async def test_client_token(self):
+    tokens = await asyncio.gather(
+      *[self.token_manager.get_client_token() for _ in range(5)])
+    self.assertEqual(1, len(self.requests))
+    self.assertEqual({'client-1'}, {t.access_token for t in tokens})
+
+    await self.token_manager.get_client_token()
+    self.assertEqual(1, len(self.requests))
+
+  async def test_refresh_client_token_before_expiry(self):
+    self.expires_in = 30
+    await self.token_manager.get_client_token()
+    token = await self.token_manager.get_client_token()
+    self.assertEqual(2, len(self.requests))
+    self.assertEqual('client-2', token.access_token)
+
+  async def test_user_token_single_flight(self):
+    tokens = await asyncio.gather(
+      *[self.token_manager.get_user_token(self.user_data) for _ in range(5)])
+    self.assertEqual(1, len(self.requests))
+    self.assertEqual({'user-1'}, {t.access_token for t in tokens})
+    self.assertEqual('refresh', tokens[0].refresh_token)
+
+    stored = user.get_store().get('a')
+    self.assertEqual('user-1', stored.token.access_token)
+    self.assertFalse(stored.token.expires_within(60))
+
+  async def test_refresh_after_concurrent_refresh(self):
+    stale = self.user_data.token
+    await self.token_manager.refresh_user_token(self.user_data, stale)
+    await self.token_manager.refresh_user_token(self.user_data, stale)
+    self.assertEqual(1, len(self.requests))
+
+  async def test_revoked(self):
+    self.revoked = True
+    with self.assertRaises(api.AuthorizationError):
+      await self.token_manager.get_user_token(self.user_data)
+    self.assertIsNone(user.get_store().get('a').token)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+
+from spotify import cache
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+  def test_get_put(self):
+    response_cache = cache.ResponseCache()
+    self.assertIsNone(response_cache.get('user', ('v1', 0)))
+
+    entry = response_cache.put('user', ('v1', 0), b'{}')
+    self.assertIs(entry, response_cache.get('user', ('v1', 0)))
+    self.assertIsNone(response_cache.get('user', ('v1', 1)))
+    self.assertIsNone(response_cache.get('other', ('v1', 0)))
+
+    response_cache.invalidate('user')
+    self.assertIsNone(response_cache.get('user', ('v1', 0)))
+
+  def test_etag(self):
+    response_cache = cache.ResponseCache()
+    a = response_cache.put('a', 1, b'{"a":1}')
+    b = response_cache.put('b', 1, b'{"a":1}')
+    c = response_cache.put('c', 1, b'{"a":2}')
+    self.assertEqual(a.etag, b.etag)
+    self.assertNotEqual(a.etag, c.etag)
+    self.assertEqual([a.etag, '"x"'],
+                     cache.parse_if_none_match(f'W/{a.etag}, "x"'))
+
+  def test_max_size(self):
+    response_cache = cache.ResponseCache(max_size=2)
+    response_cache.put('a', 1, b'')
+    response_cache.put('b', 1, b'')
+    response_cache.get('a', 1)
+    response_cache.put('c', 1, b'')
+    self.assertEqual(2, len(response_cache))
+    self.assertIsNone(response_cache.get('b', 1))
+    self.assertIsNotNone(response_cache.get('a', 1))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+
+from spotify import api, chart
+
+A = api.Artist('a', 'A')
+B = api.Artist('b', 'B')
+C = api.Artist('c', 'C')
+
+
+class ChartIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    self.index = chart.build_chart_index([
+      api.Track('1', 'one', 0, [A]),
+      api.Track('2', 'two', 0, [B, A]),
+      api.Track('3', 'three', 0, [C]),
+      api.Track('4', 'four', 0, [B]),
+    ], 'v1', 3)
+
+  def test_build(self):
+    self.assertEqual(4, len(self.index))
+    self.assertEqual((A, B, C), self.index.artists)
+    self.assertEqual(((0,), (1, 0), (2,), (1,)), self.index.track_artists)
+    self.assertEqual(((0, 1), (1, 3), (2,)), self.index.artist_tracks)
+    self.assertEqual(2, self.index.track_positions['3'])
+    self.assertEqual('two', self.index.get_track('2').name)
+    self.assertEqual(['2', '4'],
+                     [t.id for t in self.index.get_tracks_by_artist('b')])
+
+  def test_blocked_positions(self):
+    self.assertEqual({0, 1, 2},
+                     self.index.blocked_positions(['3', 'x'], ['a', 'y']))
+    self.assertEqual(set(), self.index.blocked_positions([], []))
+
+
+if __name__ == '__main__':
+  unittest.main()
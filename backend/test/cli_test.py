@@ -0,0 +1,96 @@
+import json
+import pathlib
+import tempfile
+import unittest
+from unittest import mock
+
+import httpx
+from click.testing import CliRunner
+
+from spotify import api, cli, config, data, fake, metadata, user
+from spotify.http_client import HttpClient, HttpSettings
+
+URL = 'http://fake'
+
+
+class ReplacePlaylistsCommandTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    path = pathlib.Path(self.directory.name)
+    secret = path / 'secret.json'
+    secret.write_text(json.dumps(dict(client_id='id', client_secret='secret')))
+    self.app = fake.create_app(fake.FakeSettings(chart_size=20))
+
+    def create_http_client(settings: HttpSettings) -> HttpClient:
+      return HttpClient(HttpSettings(rate_limit=0, backoff_base=0),
+                        transport=httpx.ASGITransport(app=self.app))
+
+    # 偽のSpotifyに向け、データは一時ディレクトリに置く
+    self.patches = [
+      mock.patch.object(api, 'ACCOUNTS_URL', URL),
+      mock.patch.object(api, 'API_URL', URL),
+      mock.patch.object(data, 'CHARTS_URL', URL),
+      mock.patch.object(config, 'SECRET_PATH', secret),
+      mock.patch.object(config, 'DATA_DIR', path / 'data'),
+      mock.patch.object(cli, 'HttpClient', create_http_client),
+    ]
+    for patch in self.patches:
+      patch.start()
+
+    user.set_store(user.SqliteUserStore(':memory:'))
+    spotify = self.app.state.spotify
+    for profile_id in ['u1', 'u2', 'u3']:
+      user_data = user.UserData()
+      user_data.profile = api.Profile(profile_id, profile_id, 'uri', 'JP')
+      user_data.token = api.create_token_from_dict(spotify.issue(profile_id))
+      user_data.reload_playlist_id = f'{profile_id}-p0'
+      user_data.save()
+    # プレイリストが見つからないユーザー
+    user_data = user.get_user_data('u3')
+    user_data.reload_playlist_id = 'missing'
+    user_data.save()
+
+  def tearDown(self):
+    user.get_store().close()
+    user.set_store(None)
+    for patch in reversed(self.patches):
+      patch.stop()
+    self.directory.cleanup()
+
+  def playlist_uris(self, profile_id: str):
+    playlists = self.app.state.spotify.playlists[profile_id]
+    return playlists[f'{profile_id}-p0'].uris
+
+  def test_replace_users(self):
+    closed = []
+    close = metadata.TrackStore.close
+
+    def track_store_close(store: metadata.TrackStore):
+      closed.append(store)
+      close(store)
+
+    with mock.patch.object(metadata.TrackStore, 'close', track_store_close):
+      result = CliRunner().invoke(
+        cli.main, ['replace-playlists', '--users', 'u1,u2', '--workers', '2'])
+    self.assertEqual(0, result.exit_code, result.output)
+    self.assertIn('succeeded:2\tfailed:0', result.output)
+    self.assertEqual(20, len(self.playlist_uris('u1')))
+    self.assertEqual(self.playlist_uris('u1'), self.playlist_uris('u2'))
+    self.assertEqual(1, len(closed))
+
+  def test_replace_all(self):
+    result = CliRunner().invoke(cli.main, ['replace-playlists', '--all'])
+    self.assertEqual(1, result.exit_code, result.output)
+    lines = result.output.splitlines()
+    self.assertEqual([('u1', 'ok'), ('u2', 'ok'), ('u3', 'failed')],
+                     [tuple(line.split('\t')[:2]) for line in lines[:3]])
+    self.assertIn('succeeded:2\tfailed:1', lines[-1])
+
+  def test_require_users(self):
+    result = CliRunner().invoke(cli.main, ['replace-playlists'])
+    self.assertEqual(2, result.exit_code)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,176 @@
+import os
+import pathlib
+import stat
+import tempfile
+import unittest
+
+import httpx
+
+from spotify import data
+from spotify.http_client import HttpClient
+
+CSV = """,,Note that these figures are generated using a formula that protects against any artificial inflation of chart positions.,,
+Position,Track Name,Artist,Streams,URL
+1,Song A,Artist A,1000,https://open.spotify.com/track/aaa
+2,Song B,Artist B,900,https://open.spotify.com/track/bbb
+"""
+
+
+class RankingClientTest(unittest.IsolatedAsyncioTestCase):
+
+  def handler(self, request: httpx.Request) -> httpx.Response:
+    self.requests.append(request)
+    headers = {}
+    if self.etag:
+      if request.headers.get('If-None-Match') == self.etag:
+        return httpx.Response(304)
+      headers['ETag'] = self.etag
+    return httpx.Response(200, text=self.csv, headers=headers)
+
+  async def asyncSetUp(self):
+    self.requests = []
+    self.csv = CSV
+    self.etag = '"v1"'
+    self.tmp = tempfile.TemporaryDirectory()
+    self.path = pathlib.Path(self.tmp.name) / 'chart.csv'
+    self.http_client = HttpClient(
+      transport=httpx.MockTransport(self.handler))
+
+  async def asyncTearDown(self):
+    await self.http_client.aclose()
+    self.tmp.cleanup()
+
+  async def test_fresh_chart_is_not_downloaded_again(self):
+    client = data.RankingClient(self.http_client, 3600, self.path)
+    song_list = await client.get_song_list()
+    self.assertEqual(['aaa', 'bbb'], [s.id for s in song_list])
+    self.assertEqual(CSV, self.path.read_text())
+
+    await client.get_song_list()
+    # 別プロセスでもmetaファイルからmax_ageを判断する
+    await data.RankingClient(self.http_client, 3600, self.path).get_song_list()
+    self.assertEqual(1, len(self.requests))
+
+  async def test_conditional_request(self):
+    client = data.RankingClient(self.http_client, 0, self.path)
+    await client.get_song_list()
+    version = client.version
+
+    await client.get_song_list()
+    self.assertEqual('"v1"', self.requests[-1].headers['If-None-Match'])
+    self.assertEqual(version, client.version)
+
+    self.csv = CSV.replace('Song A', 'Song C')
+    self.etag = '"v2"'
+    song_list = await client.get_song_list()
+    self.assertEqual('Song C', song_list[0].title)
+    self.assertNotEqual(version, client.version)
+
+  async def test_content_hash_without_etag(self):
+    self.etag = None
+    client = data.RankingClient(self.http_client, 0, self.path)
+    await client.get_song_list()
+    version = client.version
+    song_list = client.song_list
+
+    await client.get_song_list()
+    self.assertEqual(2, len(self.requests))
+    self.assertIs(song_list, client.song_list)
+    self.assertEqual(version, client.version)
+
+  async def test_force_refresh(self):
+    client = data.RankingClient(self.http_client, 3600, self.path)
+    await client.get_song_list()
+    await client.get_song_list(force_refresh=True)
+    self.assertEqual(2, len(self.requests))
+
+  async def test_use_cached_file_on_error(self):
+    client = data.RankingClient(self.http_client, 0, self.path)
+    await client.get_song_list()
+
+    await self.http_client.aclose()
+    self.handler = lambda request: httpx.Response(500)
+    self.http_client = HttpClient(transport=httpx.MockTransport(self.handler))
+    client = data.RankingClient(self.http_client, 0, self.path)
+    song_list = await client.get_song_list()
+    self.assertEqual(['aaa', 'bbb'], [s.id for s in song_list])
+
+  async def test_download_each_chart(self):
+    us_weekly = data.ChartKey('us', 'weekly')
+    clients = data.RankingClients(
+      self.http_client, 3600, pathlib.Path(self.tmp.name),
+      [data.DEFAULT_CHART_KEY, us_weekly])
+    song_lists = await clients.get_song_lists()
+    self.assertEqual({data.DEFAULT_CHART_KEY, us_weekly}, set(song_lists))
+    self.assertEqual(
+      {data.DEFAULT_CHART_KEY.url, us_weekly.url},
+      {str(r.url) for r in self.requests})
+    self.assertTrue(
+      (pathlib.Path(self.tmp.name) / us_weekly.file_name).is_file())
+
+    with self.assertRaises(KeyError):
+      clients.get(data.ChartKey('gb', 'daily'))
+
+  async def test_keep_cached_file_on_invalid_chart(self):
+    client = data.RankingClient(self.http_client, 0, self.path)
+    await client.get_song_list()
+
+    self.csv = "<html></html>"
+    self.etag = '"v2"'
+    song_list = await client.get_song_list(force_refresh=True)
+    self.assertEqual(['aaa', 'bbb'], [s.id for s in song_list])
+    self.assertEqual(CSV, self.path.read_text())
+
+
+class ChartParserTest(unittest.TestCase):
+
+  def test_parse_in_chunks(self):
+    text = CSV + '3,"Song, ""C""",アーティスト,800,' \
+                 'https://open.spotify.com/track/ccc\n'
+    parser = data.ChartParser()
+    encoded = text.encode('utf-8')
+    for i in range(len(encoded)):
+      parser.feed(encoded[i:i + 1])
+    song_list = parser.close()
+
+    self.assertEqual(data.parse_chart(text), song_list)
+    self.assertEqual(['aaa', 'bbb', 'ccc'], [s.id for s in song_list])
+    self.assertEqual('Song, "C"', song_list[2].title)
+    self.assertEqual('アーティスト', song_list[2].artist)
+    self.assertEqual('spotify:track:ccc', song_list[2].uri)
+
+  def test_invalid_layout(self):
+    lines = CSV.splitlines(keepends=True)
+    for text in ['', lines[0], lines[0] + 'Rank,Title\n' + lines[2],
+                 lines[0] + lines[1] + '1,Song A,Artist A,1000\n',
+                 lines[0] + lines[1] + 'x,Song A,Artist A,1,' + lines[2][-35:],
+                 lines[0] + lines[1] + '1,A,A,1,https://example.com\n']:
+      with self.subTest(text=text), self.assertRaises(data.ChartFormatError):
+        data.parse_chart(text)
+
+
+if __name__ == '__main__':
+  unittest.main()
+
+
+class WriteAtomicTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.path = pathlib.Path(self.tmp.name) / 'chart.csv'
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def test_keep_mode(self):
+    self.path.write_bytes(b'old')
+    self.path.chmod(0o640)
+    data.write_atomic(self.path, b'new')
+    self.assertEqual(b'new', self.path.read_bytes())
+    self.assertEqual(0o640, stat.S_IMODE(self.path.stat().st_mode))
+
+  def test_new_file_mode(self):
+    data.write_atomic(self.path, b'new')
+    self.assertEqual(0o666 & ~data._UMASK,
+                     stat.S_IMODE(self.path.stat().st_mode))
+    self.assertEqual(['chart.csv'], os.listdir(self.tmp.name))
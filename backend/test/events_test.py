@@ -0,0 +1,72 @@
+import asyncio
+import json
+import unittest
+from typing import List
+
+from spotify import data, events
+
+US_DAILY = data.ChartKey('us', 'daily')
+
+
+def parse(chunk: bytes) -> dict:
+  fields = dict(line.split(': ', 1)
+                for line in chunk.decode().splitlines() if line)
+  return dict(event=fields['event'], data=json.loads(fields['data']))
+
+
+class EventHubTest(unittest.IsolatedAsyncioTestCase):
+
+  async def test_publish_to_user(self):
+    hub = events.EventHub()
+    a1 = hub.subscribe('a')
+    a2 = hub.subscribe('a')
+    b = hub.subscribe('b')
+    self.assertEqual(3, hub.count())
+
+    hub.publish('a', events.playlist_event(data.DEFAULT_CHART_KEY))
+    self.assertEqual(1, a1.queue.qsize())
+    self.assertEqual(1, a2.queue.qsize())
+    self.assertTrue(b.queue.empty())
+
+    hub.unsubscribe(a1)
+    hub.unsubscribe(a2)
+    hub.publish('a', events.playlist_event(data.DEFAULT_CHART_KEY))
+    self.assertEqual(1, hub.count())
+
+  async def test_publish_chart(self):
+    hub = events.EventHub()
+    jp = hub.subscribe('a')
+    us = hub.subscribe('b', US_DAILY)
+    hub.publish_chart(US_DAILY, events.chart_event(US_DAILY, 'v2'))
+    self.assertTrue(jp.queue.empty())
+    self.assertEqual(dict(chart='us/daily', version='v2'),
+                     us.queue.get_nowait().data)
+
+  async def test_drop_oldest_events(self):
+    hub = events.EventHub()
+    subscription = hub.subscribe('a')
+    for i in range(events.MAX_QUEUED_EVENTS + 5):
+      hub.publish('a', events.chart_event(data.DEFAULT_CHART_KEY, str(i)))
+    self.assertEqual(events.MAX_QUEUED_EVENTS, subscription.queue.qsize())
+    self.assertEqual('5', subscription.queue.get_nowait().data['version'])
+
+  async def test_stream(self):
+    hub = events.EventHub()
+    subscription = hub.subscribe('a')
+    initial = events.chart_event(data.DEFAULT_CHART_KEY, 'v1')
+    stream = events.stream(hub, subscription, initial, heartbeat=0.01)
+    chunks: List[bytes] = [await stream.__anext__() for _ in range(3)]
+    self.assertEqual(b'retry: 3000\n\n', chunks[0])
+    self.assertEqual(dict(event='chart', data=dict(
+      chart='jp/daily', version='v1')), parse(chunks[1]))
+    self.assertEqual(events.HEARTBEAT, chunks[2])
+
+    hub.publish('a', events.playlist_event(data.DEFAULT_CHART_KEY,
+                                           RuntimeError('boom')))
+    self.assertEqual(dict(event='playlist', data=dict(
+      chart='jp/daily', status='failed', error='boom')),
+      parse(await asyncio.wait_for(stream.__anext__(), 1)))
+
+    # 切断されたら購読をやめる
+    await stream.aclose()
+    self.assertEqual(0, hub.count())
@@ -0,0 +1,82 @@
+import unittest
+
+import httpx
+
+from spotify import api, auth, fake
+from spotify.http_client import HttpClient, HttpSettings
+
+URL = 'http://fake'
+
+
+class FakeSpotifyTest(unittest.IsolatedAsyncioTestCase):
+
+  async def asyncSetUp(self):
+    self.urls = api.ACCOUNTS_URL, api.API_URL
+    api.ACCOUNTS_URL = api.API_URL = URL
+    self.settings = fake.FakeSettings(chart_size=3)
+    self.app = fake.create_app(self.settings)
+    self.http_client = HttpClient(
+      HttpSettings(rate_limit=0, backoff_base=0),
+      transport=httpx.ASGITransport(app=self.app))
+    self.credentials = api.ClientCredentials('id', 'secret')
+
+  async def asyncTearDown(self):
+    api.ACCOUNTS_URL, api.API_URL = self.urls
+    await self.http_client.aclose()
+
+  async def test_client_flow(self):
+    client = api.ApiClient(
+      self.http_client, auth.TokenManager(self.credentials, self.http_client))
+    tracks = await client.get_several_tracks(['0000000001', 'unknown'])
+    self.assertEqual(['0000000001'], [t.id for t in tracks])
+
+  async def test_user_flow(self):
+    token = await api.fetch_token(self.http_client, 'u1', self.credentials,
+                                  'http://app/callback')
+    client = api.UserResourceApiClient(self.credentials, self.http_client,
+                                       token)
+    self.assertEqual('u1', (await client.get_current_user_profile()).id)
+
+    playlists = await client.get_current_user_playlists()
+    self.assertEqual(self.settings.playlists, len(playlists))
+    snapshot_id = await client.replace_playlist_items(
+      playlists[0].id, ['spotify:track:1', 'spotify:track:2'])
+    self.assertEqual(f"{playlists[0].id}-2", snapshot_id)
+    # 説明の変更でもsnapshot_idが変わる
+    await client.change_playlist_details(playlists[0].id, description='d')
+    self.assertEqual(f"{playlists[0].id}-3",
+                     await client.get_playlist_snapshot_id(playlists[0].id))
+
+    await client.refresh_token()
+    self.assertEqual('u1', (await client.get_current_user_profile()).id)
+
+  async def test_get_all_playlist_pages(self):
+    self.settings.playlists = 120
+    token = await api.fetch_token(self.http_client, 'u1', self.credentials,
+                                  'http://app/callback')
+    client = api.UserResourceApiClient(self.credentials, self.http_client,
+                                       token)
+
+    playlists = await client.get_current_user_playlists()
+    self.assertEqual([f"u1-p{i}" for i in range(120)],
+                     [p.id for p in playlists])
+    self.assertEqual('u1-p0-1', playlists[0].snapshot_id)
+    self.assertEqual(3, self.app.state.spotify.requests['GET /v1/me/playlists'])
+
+  async def test_retry_injected_rate_limit(self):
+    self.settings.rate_limit_rate = 1
+    self.settings.retry_after = 0
+    r = await self.http_client.get(f"{URL}/regional/jp/daily/latest/download")
+    self.assertEqual(429, r.status_code)
+    self.assertEqual(
+      self.http_client.settings.max_retries + 1,
+      self.app.state.spotify.requests['GET /regional/{region}/{period}'
+                                      '/latest/download'])
+
+    self.settings.rate_limit_rate = 0
+    r = await self.http_client.get(f"{URL}/regional/jp/daily/latest/download")
+    self.assertEqual(3 + 2, len(r.text.splitlines()))
+
+
+if __name__ == '__main__':
+  unittest.main()
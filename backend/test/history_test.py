@@ -0,0 +1,107 @@
+import datetime
+import os
+import pathlib
+import tempfile
+import unittest
+
+from spotify import JST, data, history
+
+D1 = datetime.date(2021, 8, 1)
+D2 = datetime.date(2021, 8, 2)
+D3 = datetime.date(2021, 8, 3)
+
+HEADER = ",,Note that these figures are generated using a formula that" \
+         " protects against any artificial inflation of chart positions.,,\n" \
+         "Position,Track Name,Artist,Streams,URL\n"
+
+
+def song(rank: int, id: str, streams: int = 100) -> data.Song:
+  return data.Song(rank, f"title-{id}", f"artist-{id}", streams,
+                   f"https://open.spotify.com/track/{id}")
+
+
+def csv(*ids: str) -> str:
+  return HEADER + ''.join(
+    f"{i + 1},title-{id},artist-{id},{1000 - i},"
+    f"https://open.spotify.com/track/{id}\n" for i, id in enumerate(ids))
+
+
+class HistoryStoreTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.directory = pathlib.Path(self.tmp.name)
+    self.store = history.HistoryStore(self.directory / 'history')
+
+  def tearDown(self):
+    self.store.close()
+    self.tmp.cleanup()
+
+  def test_rank_trajectory(self):
+    self.store.append(D1, 'h1', [song(1, 'a', 300), song(2, 'b', 200)])
+    self.store.append(D2, 'h2', [song(1, 'b', 310), song(2, 'c', 210)])
+    self.store.append(D3, 'h3', [song(1, 'b', 320), song(2, 'a', 220)])
+    self.assertFalse(self.store.append(D3, 'h3', []))
+
+    self.assertEqual(
+      [history.RankPoint(D1, 1, 300), history.RankPoint(D3, 2, 220)],
+      self.store.get_rank_trajectory('a'))
+    self.assertEqual([history.RankPoint(D2, 1, 310)],
+                     self.store.get_rank_trajectory('b', D2, D2))
+    self.assertEqual([], self.store.get_rank_trajectory('x'))
+    self.assertEqual(history.TrackInfo('c', 'title-c', 'artist-c'),
+                     self.store.get_track('c'))
+
+  def test_top_movers(self):
+    self.store.append(D1, 'h1', [song(1, 'a'), song(2, 'b'), song(3, 'c')])
+    self.store.append(D2, 'h2', [song(1, 'c'), song(2, 'a'), song(3, 'd')])
+
+    movers = self.store.get_top_movers()
+    self.assertEqual((D2, D1), (movers.date, movers.previous_date))
+    self.assertEqual([('c', 2)], [(m.track.id, m.change) for m in movers.up])
+    self.assertEqual([('a', -1)],
+                     [(m.track.id, m.change) for m in movers.down])
+    self.assertIsNone(self.store.get_top_movers(D1))
+
+  def test_reopen_and_discard_uncommitted_rows(self):
+    self.store.append(D1, 'h1', [song(1, 'a'), song(2, 'b')])
+    # 列だけ書かれてsnapshots.tsvに記録されなかった行
+    with (self.directory / 'history' / 'rank.bin').open('ab') as f:
+      f.write(b'\0\0')
+
+    store = history.HistoryStore(self.directory / 'history')
+    self.assertEqual(2, len(store))
+    store.append(D2, 'h2', [song(1, 'b')])
+    self.assertEqual([history.RankPoint(D2, 1, 100)],
+                     store.get_rank_trajectory('b', D2))
+    store.close()
+
+    # 別のインスタンスが追記した内容も読む
+    self.assertEqual([D1, D2], self.store.get_dates())
+    self.assertEqual(2, len(self.store.get_rank_trajectory('b')))
+
+  def test_import_snapshots(self):
+    source = self.directory / 'ranking_refresh_time'
+    source.mkdir()
+    first = 'a' * 32
+    second = 'b' * 32
+    (source / f'{first}.csv').write_text(csv('x', 'y'))
+    (source / f'{second}.csv').write_text(csv('y', 'x'))
+    (source / 'ignored.csv').write_text(csv('z'))
+    (source / history.LOG_FILE).write_text(
+      f"level:ERROR\ttime:2021-08-02 13:00:01,234"
+      f"\tstatus_code:200\thash:{second}\n")
+    # ログにないファイルは更新日時を使う
+    mtime = datetime.datetime(2021, 8, 1, 13, tzinfo=JST).timestamp()
+    os.utime(source / f'{first}.csv', (mtime, mtime))
+
+    self.assertEqual([first, second],
+                     history.import_snapshots(source, self.store))
+    self.assertEqual([], history.import_snapshots(source, self.store))
+    self.assertEqual([D1, D2], self.store.get_dates())
+    self.assertEqual([2, 1], [p.rank for p in
+                              self.store.get_rank_trajectory('y')])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+
+import httpx
+from fastapi import FastAPI
+
+from spotify import metrics
+
+
+class MetricsTest(unittest.IsolatedAsyncioTestCase):
+
+  def test_render_counter_and_histogram(self):
+    registry = metrics.Registry()
+    counter = registry.register(
+      metrics.Counter('requests_total', 'Requests.', ('status',)))
+    histogram = registry.register(
+      metrics.Histogram('duration_seconds', 'Duration.', ('route',),
+                        buckets=(0.1, 1.0)))
+    counter.inc('200')
+    counter.inc('200')
+    counter.inc('5"00')
+    histogram.observe(0.05, '/a')
+    histogram.observe(0.5, '/a')
+    histogram.observe(3, '/a')
+
+    self.assertEqual(
+      '# HELP requests_total Requests.\n'
+      '# TYPE requests_total counter\n'
+      'requests_total{status="200"} 2\n'
+      'requests_total{status="5\\"00"} 1\n'
+      '# HELP duration_seconds Duration.\n'
+      '# TYPE duration_seconds histogram\n'
+      'duration_seconds_bucket{route="/a",le="0.1"} 1\n'
+      'duration_seconds_bucket{route="/a",le="1"} 2\n'
+      'duration_seconds_bucket{route="/a",le="+Inf"} 3\n'
+      'duration_seconds_sum{route="/a"} 3.55\n'
+      'duration_seconds_count{route="/a"} 3\n',
+      registry.render())
+
+  async def test_middleware_records_route_template(self):
+    app = FastAPI()
+    app.add_middleware(metrics.MetricsMiddleware)
+
+    @app.get('/tracks/{id}')
+    async def get_track(id: str):
+      return id
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport,
+                                 base_url='http://app') as client:
+      before = metrics.HTTP_REQUEST_DURATION.count('GET', '/tracks/{id}', '200')
+      await client.get('/tracks/a')
+      await client.get('/tracks/b')
+      await client.get('/missing')
+
+    self.assertEqual(
+      before + 2,
+      metrics.HTTP_REQUEST_DURATION.count('GET', '/tracks/{id}', '200'))
+    self.assertEqual(
+      1, metrics.HTTP_REQUEST_DURATION.count('GET', 'unmatched', '404'))
+
+
+if __name__ == '__main__':
+  unittest.main()
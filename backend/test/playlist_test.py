@@ -0,0 +1,177 @@
+import random
+import unittest
+from typing import List
+
+import httpx
+
+from spotify import api, auth, cache, chart, fake, playlist, service, user
+from spotify.http_client import HttpClient, HttpSettings
+
+URL = 'http://fake'
+
+
+def apply(uris: List[str], operations: List[playlist.Operation]) -> List[str]:
+  # Spotifyと同じ意味で操作を適用する
+  uris = list(uris)
+  for operation in operations:
+    if isinstance(operation, playlist.RemoveItems):
+      uris = [uri for uri in uris if uri not in operation.uris]
+    elif isinstance(operation, playlist.MoveItem):
+      uri = uris[operation.range_start]
+      uris.insert(operation.insert_before, None)
+      uris.remove(uri)
+      uris[uris.index(None)] = uri
+    else:
+      uris[operation.position:operation.position] = operation.uris
+  return uris
+
+
+class DiffPlaylistTest(unittest.TestCase):
+
+  def test_small_changes(self):
+    current = ['a', 'b', 'c', 'd', 'e']
+    self.assertEqual([], playlist.diff_playlist(current, current))
+    self.assertEqual(
+      [playlist.RemoveItems(['c']), playlist.AddItems(['x', 'y'], 4)],
+      playlist.diff_playlist(current, ['a', 'b', 'd', 'e', 'x', 'y']))
+    # 1曲だけ順位が上がった
+    self.assertEqual([playlist.MoveItem(3, 1)],
+                     playlist.diff_playlist(current, ['a', 'd', 'b', 'c', 'e']))
+    self.assertIsNone(playlist.diff_playlist(['a', 'a'], ['a']))
+
+  def test_random_changes(self):
+    rng = random.Random(0)
+    pool = [f"spotify:track:{i}" for i in range(150)]
+    for _ in range(300):
+      current = rng.sample(pool, rng.randint(0, 100))
+      if rng.random() < 0.5:
+        # チャートの小さな変動
+        target = [uri for uri in current if rng.random() > 0.05]
+        for _ in range(rng.randint(0, 3)):
+          uri = target.pop(rng.randrange(len(target))) if target else None
+          if uri:
+            target.insert(rng.randrange(len(target) + 1), uri)
+        new = [uri for uri in pool if uri not in current]
+        for uri in rng.sample(new, min(len(new), rng.randint(0, 5))):
+          target.insert(rng.randrange(len(target) + 1), uri)
+        target = target[:100]
+      else:
+        target = rng.sample(pool, rng.randint(0, 100))
+
+      operations = playlist.diff_playlist(current, target)
+      self.assertEqual(target, apply(current, operations))
+
+
+class PlaylistStoreTest(unittest.TestCase):
+
+  def test_put_and_get(self):
+    store = playlist.PlaylistStore(':memory:')
+    self.assertIsNone(store.get('u1', 'p1'))
+    store.put('u1', 'p1', playlist.PlaylistState(['a', 'b'], 's1'))
+    self.assertEqual(playlist.PlaylistState(['a', 'b'], 's1'),
+                     store.get('u1', 'p1'))
+    self.assertIsNone(store.get('u2', 'p1'))
+    store.delete('u1', 'p1')
+    self.assertIsNone(store.get('u1', 'p1'))
+    store.close()
+
+
+class FakeRankingService:
+
+  def __init__(self, ids: List[str]):
+    self.ids = ids
+
+  async def get_index(self, key=None) -> chart.ChartIndex:
+    return chart.build_chart_index(
+      [api.Track(id, id, 0, [api.Artist(f"a{id}", "a")]) for id in self.ids])
+
+
+class ReplacePlaylistTest(unittest.IsolatedAsyncioTestCase):
+
+  async def asyncSetUp(self):
+    self.urls = api.ACCOUNTS_URL, api.API_URL
+    api.ACCOUNTS_URL = api.API_URL = URL
+    self.app = fake.create_app()
+    self.http_client = HttpClient(
+      HttpSettings(rate_limit=0, backoff_base=0),
+      transport=httpx.ASGITransport(app=self.app))
+    credentials = api.ClientCredentials('id', 'secret')
+
+    self.user_data = user.UserData()
+    self.user_data.profile = api.Profile('u1', 'u1', 'uri', 'JP')
+    self.user_data.token = await api.fetch_token(
+      self.http_client, 'u1', credentials, 'http://app/callback')
+    self.user_data.reload_playlist_id = 'u1-p0'
+    self.ranking_service = FakeRankingService([str(i) for i in range(10)])
+    self.store = playlist.PlaylistStore(':memory:')
+    self.playlists_cache = cache.TtlCache(ttl=60)
+    self.user_service = service.UserService(
+      self.user_data,
+      api.UserResourceApiClient(credentials, self.http_client,
+                                self.user_data.token),
+      self.ranking_service,
+      auth.TokenManager(credentials, self.http_client),
+      self.store,
+      self.playlists_cache)
+
+  async def asyncTearDown(self):
+    api.ACCOUNTS_URL, api.API_URL = self.urls
+    await self.http_client.aclose()
+    self.store.close()
+
+  def spotify_playlist(self) -> fake.FakePlaylist:
+    return self.app.state.spotify.playlists['u1']['u1-p0']
+
+  def writes(self) -> dict:
+    requests = self.app.state.spotify.requests
+    return {k: v for k, v in requests.items()
+            if k.startswith(('PUT /v1', 'POST /v1', 'DELETE /v1'))}
+
+  async def test_skip_unchanged_and_send_diff(self):
+    await self.user_service.replace_playlist()
+    expected = [f"spotify:track:{i}" for i in range(10)]
+    self.assertEqual(expected, self.spotify_playlist().uris)
+    writes = {'PUT /v1/playlists/{id}': 1, 'PUT /v1/playlists/{id}/tracks': 1}
+    self.assertEqual(writes, self.writes())
+
+    # 変更がなければ書き込まない
+    await self.user_service.replace_playlist()
+    self.assertEqual(writes, self.writes())
+
+    self.ranking_service.ids = ['0', '2', '1', '3', '4', '5', '6', '7', '8',
+                                '10']
+    await self.user_service.replace_playlist()
+    self.assertEqual([f"spotify:track:{i}" for i in self.ranking_service.ids],
+                     self.spotify_playlist().uris)
+    # 1曲削除、1曲移動、1曲追加
+    self.assertEqual({'PUT /v1/playlists/{id}': 2,
+                      'PUT /v1/playlists/{id}/tracks': 2,
+                      'DELETE /v1/playlists/{id}/tracks': 1,
+                      'POST /v1/playlists/{id}/tracks': 1}, self.writes())
+
+  async def test_replace_when_changed_elsewhere(self):
+    await self.user_service.replace_playlist()
+    self.spotify_playlist().uris = []
+    self.spotify_playlist().snapshot += 1
+
+    await self.user_service.replace_playlist()
+    self.assertEqual(10, len(self.spotify_playlist().uris))
+    self.assertEqual(
+      self.spotify_playlist().snapshot_id,
+      self.store.get('u1', 'u1-p0').snapshot_id)
+
+  async def test_cache_playlists_until_modified(self):
+    requests = self.app.state.spotify.requests
+    playlists = await self.user_service.get_playlists()
+    self.assertIs(playlists, await self.user_service.get_playlists())
+    self.assertEqual(1, requests['GET /v1/me/playlists'])
+
+    await self.user_service.replace_playlist()
+    playlists = await self.user_service.get_playlists()
+    self.assertEqual(2, requests['GET /v1/me/playlists'])
+    self.assertEqual(self.spotify_playlist().snapshot_id,
+                     playlists[0].snapshot_id)
+
+
+if __name__ == '__main__':
+  unittest.main()
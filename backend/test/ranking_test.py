@@ -0,0 +1,228 @@
+import unittest
+from unittest import mock
+from typing import List, Dict, Union
+
+from spotify import api, data, service, metadata
+from spotify.service import ranking
+
+US_DAILY = data.ChartKey('us', 'daily')
+
+
+class FakeRankingClient:
+  version = 'v1'
+
+  def __init__(self, ids: List[str]):
+    self.ids = ids
+    self.song_list = []
+
+  async def get_song_list(self, force_refresh: bool = False):
+    self.song_list = [data.Song(i + 1, f"title-{i}", "artist", 100,
+                                f"https://open.spotify.com/track/{id}")
+                      for i, id in enumerate(self.ids)]
+    return self.song_list
+
+
+class FakeRankingClients:
+
+  def __init__(self,
+    clients: Union[FakeRankingClient, Dict[data.ChartKey, FakeRankingClient]]
+  ):
+    if isinstance(clients, FakeRankingClient):
+      clients = {data.DEFAULT_CHART_KEY: clients}
+    self.clients = clients
+    self.keys = tuple(clients)
+
+  def get(self, key: data.ChartKey = data.DEFAULT_CHART_KEY):
+    return self.clients[key]
+
+  async def get_song_lists(self, keys=None, force_refresh: bool = False):
+    keys = list(self.keys if keys is None else keys)
+    return {k: await self.get(k).get_song_list(force_refresh) for k in keys}
+
+
+class FakeApiClient:
+
+  def __init__(self, failing_ids=()):
+    self.failing_ids = set(failing_ids)
+    self.calls = []
+
+  async def get_several_tracks(self, ids: List[str]) -> List[api.Track]:
+    self.calls.append(ids)
+    if self.failing_ids.intersection(ids):
+      raise api.ApiError("500: error")
+    return [api.Track(id, id, 0, [api.Artist(f"a{int(id) % 7}", "a")])
+            for id in ids]
+
+
+class RankingServiceTest(unittest.IsolatedAsyncioTestCase):
+
+  async def test_hydrate_all_batches_in_order(self):
+    ids = [str(i) for i in range(230)]
+    api_client = FakeApiClient()
+    ranking_service = service.RankingService(
+      api_client, FakeRankingClients(FakeRankingClient(ids)), None, 2)
+
+    tracks = await ranking_service.get_tracks()
+    self.assertEqual(ids, [t.id for t in tracks])
+    self.assertEqual([50, 50, 50, 50, 30], [len(c) for c in api_client.calls])
+    self.assertEqual(7, len(await ranking_service.get_artists()))
+
+  async def test_skip_unchanged_chart(self):
+    ranking_client = FakeRankingClient(['1', '2'])
+    api_client = FakeApiClient()
+    ranking_service = service.RankingService(
+      api_client, FakeRankingClients(ranking_client))
+    await ranking_service.get_tracks()
+    await ranking_service.get_tracks()
+    self.assertEqual(1, len(api_client.calls))
+
+    ranking_client.version = 'v2'
+    await ranking_service.get_tracks()
+    self.assertEqual(2, len(api_client.calls))
+    self.assertEqual('v2', ranking_service.get_version())
+
+  async def test_notify_updated_index(self):
+    ranking_client = FakeRankingClient(['1', '2'])
+    updates = []
+    ranking_service = service.RankingService(
+      FakeApiClient(), FakeRankingClients(ranking_client), None, 4,
+      lambda key, index: updates.append((key, index.version)))
+    await ranking_service.get_tracks()
+    await ranking_service.get_tracks()
+    self.assertEqual([(data.DEFAULT_CHART_KEY, 'v1')], updates)
+
+    ranking_client.version = 'v2'
+    await ranking_service.get_tracks()
+    self.assertEqual('v2', updates[-1][1])
+    self.assertEqual(2, len(updates))
+
+  async def test_notify_only_version_changes(self):
+    # 失敗したバッチを取り直しても、通知しない(タブが取り直し続けないように)
+    ids = [str(i) for i in range(120)]
+    api_client = FakeApiClient(failing_ids=['60'])
+    updates = []
+    ranking_service = service.RankingService(
+      api_client, FakeRankingClients(FakeRankingClient(ids)), None, 4,
+      lambda key, index: updates.append(index.version), 0)
+    for _ in range(5):
+      await ranking_service.get_index()
+    api_client.failing_ids.clear()
+    self.assertEqual(len(ids), len(await ranking_service.get_tracks()))
+    self.assertEqual(['v1'], updates)
+
+  async def test_partial_failure(self):
+    ids = [str(i) for i in range(120)]
+    api_client = FakeApiClient(failing_ids=['60'])
+    ranking_service = service.RankingService(
+      api_client, FakeRankingClients(FakeRankingClient(ids)), None, 4, None,
+      0)
+
+    tracks = await ranking_service.get_tracks()
+    self.assertEqual(ids[:50] + ids[100:], [t.id for t in tracks])
+    failures = ranking_service.get_hydration_failures()
+    self.assertEqual([1], [f.index for f in failures])
+    self.assertEqual(ids[50:100], failures[0].ids)
+
+    # 失敗したバッチだけを取り直す
+    api_client.calls.clear()
+    api_client.failing_ids.clear()
+    tracks = await ranking_service.get_tracks()
+    self.assertEqual(ids, [t.id for t in tracks])
+    self.assertEqual([ids[50:100]], api_client.calls)
+    self.assertFalse(ranking_service.get_hydration_failures())
+
+  async def test_retry_failures_after_delay(self):
+    ids = [str(i) for i in range(120)]
+    api_client = FakeApiClient(failing_ids=['60'])
+    ranking_service = service.RankingService(
+      api_client, FakeRankingClients(FakeRankingClient(ids)))
+    index = await ranking_service.get_index()
+    for _ in range(5):
+      self.assertIs(index, await ranking_service.get_index())
+    self.assertEqual(3, len(api_client.calls))
+
+    # 取り直す時刻を過ぎても失敗が続くなら、インデックスは作り直さない
+    with mock.patch.object(ranking.time, 'monotonic',
+                           return_value=ranking.time.monotonic() + 31):
+      self.assertIs(index, await ranking_service.get_index())
+    self.assertEqual(4, len(api_client.calls))
+    self.assertEqual(ids[50:100], api_client.calls[-1])
+
+  async def test_all_batches_failed(self):
+    ranking_service = service.RankingService(
+      FakeApiClient(failing_ids=['0']),
+      FakeRankingClients(FakeRankingClient(['0'])))
+    with self.assertRaises(api.ApiError):
+      await ranking_service.get_tracks()
+
+  async def test_keep_index_when_all_batches_failed(self):
+    # 取得済みのチャートがあれば、全部失敗しても500にせずそれを返す
+    ranking_client = FakeRankingClient(['1', '2'])
+    api_client = FakeApiClient()
+    ranking_service = service.RankingService(
+      api_client, FakeRankingClients(ranking_client))
+    index = await ranking_service.get_index()
+
+    ranking_client.version = 'v2'
+    ranking_client.ids = ['3', '1']
+    api_client.failing_ids.add('3')
+    for _ in range(3):
+      self.assertIs(index, await ranking_service.get_index())
+    self.assertEqual(2, len(api_client.calls))
+    self.assertEqual('v1', ranking_service.get_version())
+    failures = ranking_service.get_hydration_failures()
+    self.assertEqual(['3', '1'], failures[0].ids)
+
+    api_client.failing_ids.clear()
+    with mock.patch.object(ranking.time, 'monotonic',
+                           return_value=ranking.time.monotonic() + 31):
+      tracks = await ranking_service.get_tracks()
+    self.assertEqual(['3', '1'], [t.id for t in tracks])
+    self.assertEqual('v2', ranking_service.get_version())
+    self.assertFalse(ranking_service.get_hydration_failures())
+
+  async def test_fetch_only_missing_tracks(self):
+    track_store = metadata.TrackStore(':memory:', 60)
+    ids = [str(i) for i in range(60)]
+    api_client = FakeApiClient()
+    await service.RankingService(
+      api_client, FakeRankingClients(FakeRankingClient(ids)),
+      track_store).get_tracks()
+
+    ids = [str(i) for i in range(10, 80)]
+    api_client.calls.clear()
+    tracks = await service.RankingService(
+      api_client, FakeRankingClients(FakeRankingClient(ids)),
+      track_store).get_tracks()
+    self.assertEqual(ids, [t.id for t in tracks])
+    self.assertEqual([ids[-20:]], api_client.calls)
+    self.assertEqual('a3', tracks[0].artists[0].id)
+
+  async def test_refetch_stale_tracks(self):
+    track_store = metadata.TrackStore(':memory:', 0)
+    track_store.put_tracks([api.Track('1', '1', 0, [])])
+    api_client = FakeApiClient()
+    await service.RankingService(
+      api_client, FakeRankingClients(FakeRankingClient(['1'])),
+      track_store).get_tracks()
+    self.assertEqual([['1']], api_client.calls)
+
+  async def test_share_tracks_between_charts(self):
+    api_client = FakeApiClient()
+    ranking_clients = FakeRankingClients({
+      data.DEFAULT_CHART_KEY: FakeRankingClient(['1', '2', '3']),
+      US_DAILY: FakeRankingClient(['3', '4']),
+    })
+    ranking_service = service.RankingService(api_client, ranking_clients)
+    await ranking_service.refresh_all()
+    self.assertEqual([['1', '2', '3', '4']], api_client.calls)
+
+    tracks = await ranking_service.get_tracks(US_DAILY)
+    self.assertEqual(['3', '4'], [t.id for t in tracks])
+    tracks = await ranking_service.get_tracks()
+    self.assertEqual(['1', '2', '3'], [t.id for t in tracks])
+    self.assertEqual(1, len(api_client.calls))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,80 @@
+import time
+import unittest
+
+import httpx
+
+from spotify import api
+from spotify.http_client import HttpClient, HttpSettings
+from spotify.ratelimit import TokenBucket
+
+
+class TokenBucketTest(unittest.IsolatedAsyncioTestCase):
+
+  async def test_burst_then_rate(self):
+    bucket = TokenBucket(rate=100, burst=5)
+    started = time.monotonic()
+    for _ in range(5):
+      await bucket.acquire()
+    self.assertLess(time.monotonic() - started, 0.02)
+
+    for _ in range(5):
+      await bucket.acquire()
+    self.assertGreaterEqual(time.monotonic() - started, 0.04)
+
+  async def test_pause(self):
+    bucket = TokenBucket(rate=1000, burst=10)
+    bucket.pause(0.05)
+    started = time.monotonic()
+    await bucket.acquire()
+    self.assertGreaterEqual(time.monotonic() - started, 0.045)
+
+
+class HttpClientRetryTest(unittest.IsolatedAsyncioTestCase):
+
+  def handler(self, request: httpx.Request) -> httpx.Response:
+    self.requests.append(request)
+    if self.responses:
+      return self.responses.pop(0)
+    return httpx.Response(200, json={})
+
+  async def asyncSetUp(self):
+    self.requests = []
+    self.responses = []
+    settings = HttpSettings(max_retries=2, backoff_base=0.001)
+    self.http_client = HttpClient(
+      settings, transport=httpx.MockTransport(self.handler))
+
+  async def asyncTearDown(self):
+    await self.http_client.aclose()
+
+  async def test_retry_after(self):
+    self.responses = [
+      httpx.Response(429, headers={'Retry-After': '0.05'}),
+    ]
+    started = time.monotonic()
+    r = await self.http_client.post('https://api.spotify.com/v1/x')
+    self.assertEqual(200, r.status_code)
+    self.assertEqual(2, len(self.requests))
+    self.assertGreaterEqual(time.monotonic() - started, 0.045)
+
+  async def test_rate_limit_error(self):
+    self.responses = [httpx.Response(429, headers={'Retry-After': '0'})] * 3
+    r = await self.http_client.get('https://api.spotify.com/v1/x')
+    self.assertEqual(3, len(self.requests))
+    with self.assertRaises(api.RateLimitError) as cm:
+      api.validate_response(r)
+    self.assertEqual(0, cm.exception.retry_after)
+
+  async def test_retry_only_idempotent(self):
+    self.responses = [httpx.Response(503)]
+    r = await self.http_client.put('https://api.spotify.com/v1/x')
+    self.assertEqual(200, r.status_code)
+
+    self.responses = [httpx.Response(503)]
+    r = await self.http_client.post('https://api.spotify.com/v1/x')
+    self.assertEqual(503, r.status_code)
+    self.assertEqual(3, len(self.requests))
+
+
+if __name__ == '__main__':
+  unittest.main()
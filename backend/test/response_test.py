@@ -0,0 +1,75 @@
+import gzip
+import json
+import unittest
+from unittest import mock
+
+from spotify import api, cache, chart, data, response, user
+
+
+def make_index() -> chart.ChartIndex:
+  artists = [api.Artist('a1', 'アーティスト'), api.Artist('a2', 'B')]
+  return chart.build_chart_index([
+    api.Track('t1', '曲1', 1, [artists[0]]),
+    api.Track('t2', 'Song "2"', 1, [artists[1], artists[0]]),
+  ], 'v1')
+
+
+class ResponseTest(unittest.TestCase):
+
+  def test_build_tracks_and_artists(self):
+    user_data = user.UserData()
+    user_data.blocking_tracks = {'t2'}
+    user_data.blocking_artists = {'a1'}
+    expected = dict(
+      tracks=[
+        dict(id='t1', name='曲1', artistIds=['a1'], blocked=False),
+        dict(id='t2', name='Song "2"', artistIds=['a2', 'a1'], blocked=True),
+      ],
+      artists=[
+        dict(id='a1', name='アーティスト', blocked=True),
+        dict(id='a2', name='B', blocked=False),
+      ],
+    )
+    body = response.build_tracks_and_artists(make_index(), user_data)
+    self.assertEqual(expected, json.loads(body))
+
+    # orjsonがなくても同じ内容を返す
+    with mock.patch.object(response, 'orjson', None):
+      fallback = response.build_tracks_and_artists(make_index(), user_data)
+    self.assertEqual(expected, json.loads(fallback))
+    self.assertIn('曲1'.encode('utf-8'), fallback)
+
+  def test_build_playlists(self):
+    playlists = [api.Playlist('p1', 'P', True, 'uri', 'me', 's1')]
+    expected = [dict(id='p1', name='P', public=True, uri='uri',
+                     owner_id='me', snapshot_id='s1')]
+    self.assertEqual(expected, json.loads(response.build_playlists(playlists)))
+    with mock.patch.object(response, 'orjson', None):
+      self.assertEqual(expected,
+                       json.loads(response.build_playlists(playlists)))
+
+  def test_slots(self):
+    track = data.UserTrack('t1', 'name', [], False)
+    with self.assertRaises(AttributeError):
+      track.extra = 1
+
+  def test_negotiate_encoding(self):
+    size = response.MIN_COMPRESS_SIZE
+    self.assertIsNone(response.negotiate_encoding(None, size))
+    self.assertIsNone(response.negotiate_encoding('gzip', size - 1))
+    self.assertIsNone(response.negotiate_encoding('gzip;q=0, identity', size))
+    self.assertEqual('gzip', response.negotiate_encoding('gzip, deflate', size))
+    with mock.patch.object(response, 'brotli', None):
+      self.assertEqual('gzip', response.negotiate_encoding('br, gzip', size))
+    with mock.patch.object(response, 'brotli', object()):
+      self.assertEqual('br', response.negotiate_encoding('gzip, br', size))
+      self.assertEqual('gzip',
+                       response.negotiate_encoding('br;q=0.5, gzip', size))
+
+  def test_get_encoded(self):
+    body = b'{"a":"' + b'x' * 2000 + b'"}'
+    cached = cache.ResponseCache().put('user', 1, body)
+    encoded = response.get_encoded(cached, response.GZIP)
+    self.assertEqual(body, gzip.decompress(encoded))
+    self.assertIs(encoded, response.get_encoded(cached, response.GZIP))
+    self.assertEqual({response.GZIP: encoded}, cached.encoded)
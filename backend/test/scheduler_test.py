@@ -0,0 +1,124 @@
+import asyncio
+import unittest
+from typing import List
+
+from spotify import chart, scheduler
+
+
+class FakeRankingService:
+
+  def __init__(self, version: str):
+    self.version = version
+    self.calls = 0
+
+  async def get_index(self, key=None) -> chart.ChartIndex:
+    self.calls += 1
+    return chart.build_chart_index([], self.version)
+
+
+class RefreshSchedulerTest(unittest.IsolatedAsyncioTestCase):
+
+  def setUp(self):
+    self.job_store = scheduler.JobStore(':memory:')
+    self.ranking_service = FakeRankingService('v1')
+    self.users = ['a', 'b', 'c']
+    self.refreshed: List[str] = []
+    self.failures = {}
+
+  def tearDown(self):
+    self.job_store.close()
+
+  def create_scheduler(self, **kwargs) -> scheduler.RefreshScheduler:
+    settings = scheduler.SchedulerSettings(
+      **dict(dict(window=0.01, concurrency=2, max_attempts=3, retry_delay=0),
+             **kwargs))
+    return scheduler.RefreshScheduler(
+      self.ranking_service, self.job_store, self.list_users,
+      self.refresh_user, settings=settings)
+
+  async def list_users(self) -> List[str]:
+    return self.users
+
+  async def refresh_user(self, profile_id: str):
+    if self.failures.get(profile_id, 0) > 0:
+      self.failures[profile_id] -= 1
+      raise Exception("failed")
+    await asyncio.sleep(0)
+    self.refreshed.append(profile_id)
+
+  async def test_refresh_once_per_version(self):
+    self.failures = {'b': 1, 'c': 5}
+    s = self.create_scheduler()
+    run = await s.poll()
+    self.assertEqual(['a', 'b'], sorted(self.refreshed))
+    self.assertEqual(['c'], [j.profile_id for j in
+                             self.job_store.get_jobs(run.id, scheduler.FAILED)])
+    self.assertEqual(3, self.job_store.get_jobs(run.id, scheduler.FAILED)[0]
+                     .attempts)
+
+    # チャートが変わらなければ何もしない
+    self.assertIsNone(await s.poll())
+    self.assertEqual(2, len(self.refreshed))
+
+    self.ranking_service.version = 'v2'
+    self.refreshed.clear()
+    await s.poll()
+    self.assertEqual(['a', 'b', 'c'], sorted(self.refreshed))
+
+  async def test_resume_after_restart(self):
+    s = self.create_scheduler(window=60)
+    task = asyncio.create_task(s.poll())
+    await asyncio.sleep(0.05)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    self.assertEqual([], self.refreshed)
+
+    run = self.job_store.get_latest_run('jp/daily')
+    for job in self.job_store.get_jobs(run.id):
+      job.next_at = 0
+      self.job_store.update_job(job)
+    self.users = []
+    await self.create_scheduler().poll()
+    self.assertEqual(['a', 'b', 'c'], sorted(self.refreshed))
+    self.assertTrue(self.job_store.get_latest_run('jp/daily').finished)
+
+  async def test_skip_jobs_of_old_version(self):
+    s = self.create_scheduler(window=60)
+    task = asyncio.create_task(s.poll())
+    await asyncio.sleep(0.05)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    old = self.job_store.get_latest_run('jp/daily')
+
+    self.ranking_service.version = 'v2'
+    self.users = ['a']
+    await self.create_scheduler().poll()
+    self.assertEqual(['a'], self.refreshed)
+    self.assertEqual(3, len(self.job_store.get_jobs(old.id,
+                                                    scheduler.SKIPPED)))
+
+  async def test_notice_new_chart_while_processing(self):
+    s = self.create_scheduler(window=60, interval=0.01)
+    task = asyncio.create_task(s.run_forever())
+    await asyncio.sleep(0.05)
+    old = self.job_store.get_latest_run('jp/daily')
+
+    # 古い回のジョブを待っている間に、新しいチャートが来る
+    s.settings.window = 0.01
+    self.ranking_service.version = 'v2'
+    self.users = ['a']
+    for _ in range(100):
+      if self.refreshed:
+        break
+      await asyncio.sleep(0.01)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+    self.assertEqual(['a'], self.refreshed)
+    self.assertEqual(3, len(self.job_store.get_jobs(old.id,
+                                                    scheduler.SKIPPED)))
+    self.assertEqual('v2', self.job_store.get_latest_run('jp/daily').version)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,70 @@
+import time
+import unittest
+
+import jwt
+
+from spotify import session
+
+SECRET = 'secret' * 6
+
+
+class SessionManagerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.session_manager = session.SessionManager(SECRET, ttl=60)
+
+  def test_issue_and_verify(self):
+    token = self.session_manager.issue('a')
+    current = self.session_manager.verify(token)
+    self.assertEqual('a', current.profile_id)
+    self.assertAlmostEqual(time.time() + 60, current.expires_at, delta=2)
+    self.assertIs(current, self.session_manager.verify(token))
+
+  def test_invalid_token(self):
+    for token in [
+      'invalid',
+      jwt.encode(dict(sub='a'), SECRET, 'HS256'),
+      jwt.encode(dict(sub='a', jti='x', exp=int(time.time()) - 1), SECRET,
+                 'HS256'),
+      session.SessionManager('other' * 8).issue('a'),
+    ]:
+      with self.assertRaises(session.SessionError):
+        self.session_manager.verify(token)
+
+  def test_revoke(self):
+    token = self.session_manager.issue('a')
+    other = self.session_manager.issue('a')
+    self.session_manager.verify(token)
+    self.session_manager.revoke(token)
+    with self.assertRaises(session.SessionError):
+      self.session_manager.verify(token)
+    self.assertEqual('a', self.session_manager.verify(other).profile_id)
+
+  def test_events_token(self):
+    token = self.session_manager.issue('a')
+    current = self.session_manager.verify(token)
+    events_token = self.session_manager.issue_events_token(current, ttl=10)
+    verified = self.session_manager.verify_events_token(events_token)
+    self.assertEqual(('a', current.session_id),
+                     (verified.profile_id, verified.session_id))
+    self.assertAlmostEqual(time.time() + 10, verified.expires_at, delta=2)
+
+    # それぞれ、もう一方の用途には使えない
+    with self.assertRaises(session.SessionError):
+      self.session_manager.verify_events_token(token)
+    with self.assertRaises(session.SessionError):
+      self.session_manager.verify(events_token)
+
+    self.session_manager.revoke(token)
+    with self.assertRaises(session.SessionError):
+      self.session_manager.verify_events_token(events_token)
+
+  def test_expired_events_token(self):
+    current = self.session_manager.verify(self.session_manager.issue('a'))
+    events_token = self.session_manager.issue_events_token(current, ttl=-1)
+    with self.assertRaises(session.SessionError):
+      self.session_manager.verify_events_token(events_token)
+
+
+if __name__ == '__main__':
+  unittest.main()
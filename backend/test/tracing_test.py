@@ -0,0 +1,73 @@
+import asyncio
+import pathlib
+import tempfile
+import unittest
+
+import httpx
+from fastapi import FastAPI
+
+from spotify import tracing
+
+
+def create_app(profiler=None) -> FastAPI:
+  app = FastAPI()
+  app.add_middleware(tracing.TracingMiddleware, profiler=profiler)
+
+  @app.get('/slow')
+  async def slow():
+    with tracing.span('jwt'):
+      pass
+
+    async def fetch():
+      with tracing.span('fetch'):
+        await asyncio.sleep(0.01)
+
+    await asyncio.gather(fetch(), fetch())
+    return 'ok'
+
+  return app
+
+
+class TracingTest(unittest.IsolatedAsyncioTestCase):
+
+  async def request(self, app: FastAPI, path: str) -> httpx.Response:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport,
+                                 base_url='http://app') as client:
+      return await client.get(path)
+
+  def test_span_without_trace(self):
+    with tracing.span('ignored'):
+      self.assertIsNone(tracing.current_trace())
+
+  async def test_server_timing(self):
+    with self.assertLogs('spotify.tracing', 'INFO') as logs:
+      r = await self.request(create_app(), '/slow')
+
+    entries = dict(e.split(';dur=')
+                   for e in r.headers['Server-Timing'].split(', '))
+    self.assertEqual(['jwt', 'fetch', 'total'], list(entries))
+    # 並行したspanは合計される
+    self.assertGreaterEqual(float(entries['fetch']), 20)
+    self.assertIn('route:/slow\tstatus:200', logs.output[0])
+    self.assertIn('\tspan.fetch:', logs.output[0])
+    self.assertIsNone(tracing.current_trace())
+
+  async def test_profile_slow_request(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      directory = pathlib.Path(tmp)
+      app = create_app(tracing.Profiler(directory, 0.005, 1.0))
+      with self.assertLogs('spotify.tracing', 'INFO') as logs:
+        await self.request(app, '/slow')
+      files = list(directory.glob('*-GET_slow-*ms.prof'))
+      self.assertEqual(1, len(files))
+      self.assertIn(f'profile:{files[0]}', logs.output[0])
+
+      app = create_app(tracing.Profiler(directory, 60, 1.0))
+      with self.assertLogs('spotify.tracing', 'INFO'):
+        await self.request(app, '/slow')
+      self.assertEqual(1, len(list(directory.iterdir())))
+
+
+if __name__ == '__main__':
+  unittest.main()
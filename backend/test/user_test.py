@@ -0,0 +1,343 @@
+import json
+import pathlib
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from spotify import api, user
+
+
+def create_user_data(profile_id: str) -> user.UserData:
+  user_data = user.UserData()
+  user_data.profile = api.Profile(profile_id, 'name', 'uri', 'JP')
+  user_data.token = api.AuthorizationCodeFlowToken(
+    'access', 'Bearer', 'scope', 3600, 'refresh')
+  return user_data
+
+
+def assert_auto_refresh_profile_ids(test: unittest.TestCase,
+                                    store: user.UserStore):
+  for profile_id, auto_refresh, playlist_id, has_token in [
+    ('a', True, 'p', True),
+    ('b', False, 'p', True),
+    ('c', True, None, True),
+    ('d', True, 'p', False),
+    ('e', True, 'p', True),
+  ]:
+    user_data = create_user_data(profile_id)
+    user_data.auto_refresh = auto_refresh
+    user_data.reload_playlist_id = playlist_id
+    if not has_token:
+      user_data.token = None
+    store.save(user_data)
+  test.assertEqual(['a', 'e'], store.list_auto_refresh_profile_ids())
+
+
+def assert_keep_blocking_on_stale_save(test: unittest.TestCase,
+                                       store: user.UserStore):
+  # ブロックリストを変更する前に読み込んだUserDataを保存しても、変更は戻らない
+  store.save(create_user_data('a'))
+  stale = store.get('a')
+  store.update_blocking('a', {'t1': True}, {'a1': True})
+  stale.blocking_tracks.add('t2')
+  stale.reload_playlist_id = 'p'
+  store.save(stale)
+
+  loaded = store.get('a')
+  test.assertEqual({'t1'}, loaded.blocking_tracks)
+  test.assertEqual({'a1'}, loaded.blocking_artists)
+  test.assertEqual(1, loaded.blocking_version)
+  test.assertEqual('p', loaded.reload_playlist_id)
+
+
+class SqliteUserStoreTest(unittest.TestCase):
+
+  def setUp(self):
+    self.store = user.SqliteUserStore(':memory:')
+
+  def tearDown(self):
+    self.store.close()
+
+  def test_save_and_get(self):
+    self.assertIsNone(self.store.get('a'))
+    user_data = create_user_data('a')
+    user_data.reload_playlist_id = 'p'
+    user_data.auto_refresh = True
+    self.store.save(user_data)
+
+    loaded = self.store.get('a')
+    self.assertEqual(user_data, loaded)
+    self.assertEqual(['a'], self.store.list_profile_ids())
+
+  def test_save_without_blocking(self):
+    assert_keep_blocking_on_stale_save(self, self.store)
+
+  def test_update_blocking(self):
+    self.store.save(create_user_data('a'))
+    user_data = self.store.update_blocking('a', {'t1': True, 't2': True},
+                                           {'a1': True})
+    self.assertEqual({'t1', 't2'}, user_data.blocking_tracks)
+    self.assertEqual({'a1'}, user_data.blocking_artists)
+    self.assertEqual(1, user_data.blocking_version)
+
+    user_data = self.store.update_blocking('a', {'t1': False}, {'a1': True})
+    self.assertEqual({'t2'}, user_data.blocking_tracks)
+    self.assertEqual(2, user_data.blocking_version)
+
+    # 変更がなければversionは変わらない
+    user_data = self.store.update_blocking('a', {'t1': False}, {})
+    self.assertEqual(2, user_data.blocking_version)
+    self.assertIsNone(self.store.update_blocking('b', {'t1': True}, {}))
+
+    # token更新などの保存でブロックリストが消えない
+    user_data.token = None
+    self.store.save(user_data)
+    self.assertEqual({'t2'}, self.store.get('a').blocking_tracks)
+
+  def test_list_auto_refresh_profile_ids(self):
+    assert_auto_refresh_profile_ids(self, self.store)
+
+  def test_add_columns_to_old_schema(self):
+    with tempfile.TemporaryDirectory() as directory:
+      path = pathlib.Path(directory) / 'users.sqlite3'
+      conn = sqlite3.connect(str(path))
+      conn.execute("CREATE TABLE users (profile_id TEXT PRIMARY KEY,"
+                   " token TEXT, profile TEXT, reload_playlist_id TEXT,"
+                   " blocking_version INTEGER NOT NULL DEFAULT 0)")
+      conn.execute("INSERT INTO users (profile_id) VALUES ('a')")
+      conn.commit()
+      conn.close()
+
+      store = user.SqliteUserStore(path)
+      self.assertFalse(store.get('a').auto_refresh)
+      store.close()
+
+
+class JsonUserStoreTest(unittest.TestCase):
+
+  def test_list_auto_refresh_profile_ids(self):
+    with tempfile.TemporaryDirectory() as directory:
+      store = user.JsonUserStore(pathlib.Path(directory))
+      assert_auto_refresh_profile_ids(self, store)
+
+  def test_save_without_blocking(self):
+    with tempfile.TemporaryDirectory() as directory:
+      store = user.JsonUserStore(pathlib.Path(directory))
+      assert_keep_blocking_on_stale_save(self, store)
+
+
+class CachedUserStoreTest(unittest.TestCase):
+
+  def test_cache(self):
+    store = user.CachedUserStore(user.SqliteUserStore(':memory:'), 2)
+    store.save(create_user_data('a'))
+    user_data = store.get('a')
+    self.assertIs(user_data, store.get('a'))
+
+    updated = store.update_blocking('a', {'t1': True}, {})
+    self.assertIs(user_data, updated)
+    self.assertEqual({'t1'}, user_data.blocking_tracks)
+
+    store.save(create_user_data('b'))
+    store.save(create_user_data('c'))
+    store.get('b')
+    store.get('c')
+    self.assertIsNot(user_data, store.get('a'))
+    self.assertEqual({'t1'}, store.get('a').blocking_tracks)
+
+  def test_save_evicted_user_data(self):
+    # キャッシュから追い出された後も参照を持っていた(token更新の待ちなど)UserData
+    store = user.CachedUserStore(user.SqliteUserStore(':memory:'), 1)
+    store.save(create_user_data('a'))
+    store.save(create_user_data('b'))
+    stale = store.get('a')
+    store.get('b')
+    store.update_blocking('a', {'t1': True}, {})
+    store.save(stale)
+    self.assertEqual({'t1'}, store.get('a').blocking_tracks)
+
+
+class CountingStore(user.SqliteUserStore):
+
+  def __init__(self):
+    super().__init__(':memory:')
+    self.saved = []
+
+  def save(self, user_data: user.UserData):
+    self.saved.append(user_data.profile.id)
+    super().save(user_data)
+
+
+class FailingStore(CountingStore):
+
+  def __init__(self):
+    super().__init__()
+    self.failures = 0
+
+  def save(self, user_data: user.UserData):
+    if self.failures > 0:
+      self.failures -= 1
+      raise sqlite3.OperationalError("database is locked")
+    super().save(user_data)
+
+
+class WriteBehindUserStoreTest(unittest.TestCase):
+
+  def setUp(self):
+    self.inner = CountingStore()
+    # テストでは別スレッドに書かせず、flushで書き込む
+    self.store = user.WriteBehindUserStore(self.inner, delay=60)
+
+  def tearDown(self):
+    self.store.close()
+
+  def test_coalesce_saves(self):
+    user_data = create_user_data('a')
+    self.store.save(user_data)
+    user_data.reload_playlist_id = 'p'
+    self.store.save(user_data)
+    self.store.save(create_user_data('b'))
+    self.assertEqual([], self.inner.saved)
+    # 書き込み待ちの内容を返す
+    self.assertEqual('p', self.store.get('a').reload_playlist_id)
+
+    self.store.flush()
+    self.assertEqual(['a', 'b'], self.inner.saved)
+    self.assertEqual(user_data, self.inner.get('a'))
+
+  def test_save_copy(self):
+    user_data = create_user_data('a')
+    self.store.save(user_data)
+    user_data.blocking_tracks.add('t1')
+    self.store.flush()
+    self.assertEqual(set(), self.inner.get('a').blocking_tracks)
+
+  def test_keep_blocking_on_pending_save(self):
+    self.inner.save(create_user_data('a'))
+    stale = self.store.get('a')
+    self.store.update_blocking('a', {'t1': True}, {})
+    stale.reload_playlist_id = 'p'
+    self.store.save(stale)
+    # 書き込み待ちのUserDataを返すときも、ブロックリストはストアのもの
+    loaded = self.store.get('a')
+    self.assertEqual('p', loaded.reload_playlist_id)
+    self.assertEqual({'t1'}, loaded.blocking_tracks)
+    self.store.flush()
+    self.assertEqual({'t1'}, self.inner.get('a').blocking_tracks)
+
+  def test_update_blocking_after_pending_save(self):
+    self.store.save(create_user_data('a'))
+    user_data = self.store.update_blocking('a', {'t1': True}, {})
+    self.assertEqual({'t1'}, user_data.blocking_tracks)
+    self.assertEqual(['a'], self.inner.saved)
+
+  def test_flush_on_close(self):
+    store = user.WriteBehindUserStore(self.inner, delay=60)
+    store.save(create_user_data('c'))
+    store.close()
+    self.assertEqual(['c'], self.inner.saved)
+
+  def test_retry_failed_save(self):
+    inner = FailingStore()
+    inner.failures = 1
+    store = user.WriteBehindUserStore(inner, delay=60)
+    user_data = create_user_data('a')
+    user_data.reload_playlist_id = 'p1'
+    store.save(user_data)
+    store.flush()
+    self.assertEqual([], inner.saved)
+    # 書き込み待ちに残っている
+    self.assertEqual('p1', store.get('a').reload_playlist_id)
+    with self.assertRaises(user.UserDataError):
+      inner.failures = 1
+      store.update_blocking('a', {'t1': True}, {})
+
+    store.flush()
+    self.assertEqual(['a'], inner.saved)
+    self.assertEqual('p1', inner.get('a').reload_playlist_id)
+    store.close()
+
+  def test_keep_newer_save_over_failed(self):
+    inner = FailingStore()
+    store = user.WriteBehindUserStore(inner, delay=60)
+    user_data = create_user_data('a')
+    user_data.reload_playlist_id = 'old'
+    store.save(user_data)
+    original_save = inner.save
+
+    def save(data: user.UserData):
+      # 書き込んでいる間に新しく保存された
+      newer = create_user_data('a')
+      newer.reload_playlist_id = 'new'
+      store.save(newer)
+      inner.save = original_save
+      raise sqlite3.OperationalError("database is locked")
+
+    inner.save = save
+    store.flush()
+    store.flush()
+    self.assertEqual('new', inner.get('a').reload_playlist_id)
+    store.close()
+
+  def test_list_auto_refresh_with_pending_saves(self):
+    enabled = create_user_data('a')
+    enabled.auto_refresh = True
+    enabled.reload_playlist_id = 'p'
+    self.inner.save(enabled)
+    self.inner.save(create_user_data('b'))
+    self.inner.saved.clear()
+
+    # 書き込み待ちの変更も反映し、書き込みは待たない
+    disabled = user.copy_user_data(enabled)
+    disabled.auto_refresh = False
+    self.store.save(disabled)
+    b = create_user_data('b')
+    b.auto_refresh = True
+    b.reload_playlist_id = 'p'
+    self.store.save(b)
+    self.assertEqual(['b'], self.store.list_auto_refresh_profile_ids())
+    self.assertEqual([], self.inner.saved)
+
+  def test_close_without_waiting_delay(self):
+    store = user.WriteBehindUserStore(self.inner, delay=60)
+    store.save(create_user_data('c'))
+    # 書き込みスレッドがdelayを待ち始めてから閉じる
+    time.sleep(0.05)
+    started = time.monotonic()
+    store.close()
+    self.assertLess(time.monotonic() - started, 5)
+    self.assertEqual(['c'], self.inner.saved)
+
+  def test_flush_in_background(self):
+    inner = CountingStore()
+    store = user.WriteBehindUserStore(inner, delay=0.01)
+    store.save(create_user_data('a'))
+    for _ in range(100):
+      if inner.saved:
+        break
+      time.sleep(0.01)
+    self.assertEqual(['a'], inner.saved)
+    store.close()
+
+
+class MigrationTest(unittest.TestCase):
+
+  def test_migrate_json_users(self):
+    with tempfile.TemporaryDirectory() as directory:
+      directory = pathlib.Path(directory)
+      user_data = create_user_data('a')
+      user_data.blocking_artists = {'a1'}
+      (directory / 'a').write_text(json.dumps(user_data.to_dict()))
+      (directory / 'broken').write_text('{')
+
+      store = user.SqliteUserStore(':memory:')
+      self.assertEqual(['a'], user.migrate_json_users(directory, store))
+      self.assertEqual(user_data, store.get('a'))
+
+      with self.assertRaises(user.UserDataError):
+        user.JsonUserStore(directory).get('broken')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,6 +1,5 @@
 import React from "react";
-import {JwtContext} from "../../../../contexts/JwtContext";
-import {BASE_URL} from "../../App";
+import {BlockingQueue} from "../BlockingQueue";
 
 export class UserArtist {
   id: string;
@@ -21,6 +20,7 @@ export class UserArtist {
 interface Props {
   userArtist: UserArtist;
   updateParent: Function;
+  blockingQueue: BlockingQueue;
 }
 
 interface State {
@@ -28,8 +28,6 @@ interface State {
 }
 
 export class ArtistRow extends React.Component<Props, State> {
-  static contextType = JwtContext;
-
   constructor(props: Props) {
     super(props);
     this.state = {inProgress: false};
@@ -40,17 +38,12 @@ export class ArtistRow extends React.Component<Props, State> {
       return;
     }
     this.setState({inProgress: true})
-    const url = `${BASE_URL}/artists/${artistId}`;
-    fetch(url, {
-      method: 'PUT',
-      headers: {
-        'content-type': 'application/json',
-        'authorization': `Bearer ${this.context}`,
-      },
-      body: JSON.stringify({mute: mute}),
-    }).then(() => {
+    // 他のクリックとまとめて送る
+    this.props.blockingQueue.setArtist(artistId, mute).then(() => {
       this.props.userArtist.blocked = mute;
       this.props.updateParent();
+    }).catch(() => {
+      // 保存できなかった場合は表示を変えない
     }).finally(() => {
       this.setState({inProgress: false})
     })
@@ -0,0 +1,106 @@
+import {BASE_URL} from "../App";
+
+// 連続したミュートの切り替えをまとめて、1回のPOST /blockingで送る
+const DELAY_MS = 500;
+// サーバーが1回で受け付ける変更の数(MAX_BLOCKING_CHANGES)
+export const MAX_BLOCKING_CHANGES = 1000;
+
+interface Pending {
+  resolve: () => void;
+  reject: (e: any) => void;
+}
+
+export class BlockingQueue {
+  private readonly jwt: string;
+  private tracks: Record<string, boolean> = {};
+  private artists: Record<string, boolean> = {};
+  private pending: Pending[] = [];
+  private timer?: ReturnType<typeof setTimeout>;
+
+  constructor(jwt: string) {
+    this.jwt = jwt;
+  }
+
+  setTrack(trackId: string, mute: boolean): Promise<void> {
+    this.tracks[trackId] = mute;
+    return this.schedule();
+  }
+
+  setArtist(artistId: string, mute: boolean): Promise<void> {
+    this.artists[artistId] = mute;
+    return this.schedule();
+  }
+
+  private schedule(): Promise<void> {
+    if (this.timer !== undefined) {
+      clearTimeout(this.timer);
+    }
+    this.timer = setTimeout(() => this.flush(), DELAY_MS);
+    return new Promise((resolve, reject) => {
+      this.pending.push({resolve, reject});
+    });
+  }
+
+  flush() {
+    if (this.timer !== undefined) {
+      clearTimeout(this.timer);
+      this.timer = undefined;
+    }
+    if (this.pending.length === 0) {
+      return;
+    }
+    // 上限を超える分は分けて送り、すべて届いたら完了にする
+    const bodies: string[] = [];
+    let tracks: Record<string, boolean> = {};
+    let artists: Record<string, boolean> = {};
+    let count = 0;
+    const push = () => {
+      bodies.push(JSON.stringify({tracks: tracks, artists: artists}));
+      tracks = {};
+      artists = {};
+      count = 0;
+    };
+    for (const [id, mute] of Object.entries(this.tracks)) {
+      tracks[id] = mute;
+      if (++count >= MAX_BLOCKING_CHANGES) {
+        push();
+      }
+    }
+    for (const [id, mute] of Object.entries(this.artists)) {
+      artists[id] = mute;
+      if (++count >= MAX_BLOCKING_CHANGES) {
+        push();
+      }
+    }
+    if (count > 0) {
+      push();
+    }
+    const pending = this.pending;
+    this.tracks = {};
+    this.artists = {};
+    this.pending = [];
+
+    Promise.all(bodies.map((body) => this.post(body))).then(() => {
+      pending.forEach((p) => p.resolve());
+    }).catch((e) => {
+      pending.forEach((p) => p.reject(e));
+    })
+  }
+
+  private post(body: string): Promise<void> {
+    return fetch(`${BASE_URL}/blocking`, {
+      method: 'POST',
+      headers: {
+        'content-type': 'application/json',
+        'authorization': `Bearer ${this.jwt}`,
+      },
+      body: body,
+      // ページを閉じる直前に送る場合も届くようにする
+      keepalive: true,
+    }).then((response) => {
+      if (!response.ok) {
+        throw new Error(`${response.status}`);
+      }
+    });
+  }
+}
@@ -1,6 +1,5 @@
 import React from "react";
-import {JwtContext} from "../../../../contexts/JwtContext";
-import {BASE_URL} from "../../App";
+import {BlockingQueue} from "../BlockingQueue";
 import {UserArtist} from "../ArtistRow";
 
 export class UserTrack {
@@ -26,6 +25,7 @@ interface Props {
   rank: number;
   userTrack: UserTrack;
   updateParent: Function;
+  blockingQueue: BlockingQueue;
 }
 
 interface State {
@@ -34,8 +34,6 @@ interface State {
 
 
 export class TrackRow extends React.Component<Props, State> {
-  static contextType = JwtContext;
-
   constructor(props: Props) {
     super(props);
     this.state = {inProgress: false}
@@ -46,17 +44,12 @@ export class TrackRow extends React.Component<Props, State> {
       return;
     }
     this.setState({inProgress: true})
-    const url = `${BASE_URL}/tracks/${trackId}`;
-    fetch(url, {
-      method: 'PUT',
-      headers: {
-        'content-type': 'application/json',
-        'authorization': `Bearer ${this.context}`,
-      },
-      body: JSON.stringify({mute: mute})
-    }).then(() => {
+    // 他のクリックとまとめて送る
+    this.props.blockingQueue.setTrack(trackId, mute).then(() => {
       this.props.userTrack.blocked = mute;
       this.props.updateParent();
+    }).catch(() => {
+      // 保存できなかった場合は表示を変えない
     }).finally(() => {
       this.setState({inProgress: false})
     })
@@ -5,6 +5,7 @@ import {TrackRow, UserTrack} from "./TrackRow";
 import {ArtistRow, UserArtist} from "./ArtistRow";
 import {JwtContext} from "../../../contexts/JwtContext";
 import {ReplacePlaylistButton} from "../../projects/PlaylistReplaceButton";
+import {BlockingQueue} from "./BlockingQueue";
 
 interface ResponseTrack {
   id: string;
@@ -19,6 +20,9 @@ interface ResponseArtist {
   blocked: boolean;
 }
 
+// SSEにつなげなかったときに、つなぎ直すまでの時間
+const RESUBSCRIBE_DELAY_MS = 5000;
+
 interface Props {
 }
 
@@ -26,10 +30,28 @@ interface State {
   userTracks: UserTrack[];
   userArtists: UserArtist[];
   inProgress: boolean;
+  playlistStatus: string;
+}
+
+interface ChartEvent {
+  chart: string;
+  version: string;
+}
+
+interface PlaylistEvent {
+  chart: string;
+  status: 'done' | 'failed';
+  error?: string;
 }
 
 export class RankingPage extends React.Component<Props, State> {
   static contextType = JwtContext;
+  private blockingQueue?: BlockingQueue;
+  private eventSource?: EventSource;
+  private resubscribeTimer?: ReturnType<typeof setTimeout>;
+  private unmounted = false;
+  // 最後に通知されたチャートのバージョン。変わったときだけ取り直す
+  private chartVersion?: string;
 
   constructor(props: Props) {
     super(props);
@@ -37,13 +59,104 @@ export class RankingPage extends React.Component<Props, State> {
       userTracks: [],
       userArtists: [],
       inProgress: false,
+      playlistStatus: '',
     };
   }
 
+  getBlockingQueue(): BlockingQueue {
+    if (this.blockingQueue === undefined) {
+      this.blockingQueue = new BlockingQueue(this.context);
+    }
+    return this.blockingQueue;
+  }
+
+  flushBlocking = () => {
+    this.blockingQueue?.flush();
+  }
+
+  componentWillUnmount() {
+    window.removeEventListener('pagehide', this.flushBlocking);
+    this.flushBlocking();
+    this.unmounted = true;
+    this.eventSource?.close();
+    if (this.resubscribeTimer !== undefined) {
+      clearTimeout(this.resubscribeTimer);
+    }
+  }
+
   componentDidMount() {
+    window.addEventListener('pagehide', this.flushBlocking);
+    this.fetchTracksAndArtists();
+    this.subscribe();
+  }
+
+  subscribe() {
+    // タブごとに1本の接続で、チャートとプレイリストの更新を受け取る
+    // EventSourceはヘッダーを付けられないので、SSE専用の短い期限のトークンを
+    // 発行してもらい、クエリで渡す(セッションのJWTはURLに載せない)
+    fetch(`${BASE_URL}/events/token`, {
+      method: 'POST',
+      headers: {Authorization: `Bearer ${this.context}`},
+    })
+    .then(response => {
+      if (!response.ok) {
+        throw new Error(`${response.status}`);
+      }
+      return response.json();
+    })
+    .then(data => {
+      if (!this.unmounted) {
+        this.openEventSource(data['token']);
+      }
+    })
+    .catch(() => this.resubscribeLater());
+  }
+
+  resubscribeLater() {
+    if (this.unmounted || this.resubscribeTimer !== undefined) {
+      return;
+    }
+    this.resubscribeTimer = setTimeout(() => {
+      this.resubscribeTimer = undefined;
+      this.subscribe();
+    }, RESUBSCRIBE_DELAY_MS);
+  }
+
+  openEventSource(token: string) {
+    const eventSource = new EventSource(
+        `${BASE_URL}/events?token=${encodeURIComponent(token)}`);
+    eventSource.onerror = () => {
+      // 切断されるとブラウザが同じURLで再接続するが、トークンの期限が切れていると
+      // 403で閉じられるので、トークンを発行し直してつなぎ直す
+      if (eventSource.readyState === EventSource.CLOSED) {
+        this.resubscribeLater();
+      }
+    };
+    eventSource.addEventListener('chart', (e) => {
+      const event: ChartEvent = JSON.parse((e as MessageEvent).data);
+      // 接続(再接続)した直後にも今のチャートが届くので、変わっていなければ何もしない
+      if (this.chartVersion !== undefined && this.chartVersion !== event.version) {
+        this.fetchTracksAndArtists();
+      }
+      this.chartVersion = event.version;
+    });
+    eventSource.addEventListener('playlist', (e) => {
+      const event: PlaylistEvent = JSON.parse((e as MessageEvent).data);
+      this.setState({
+        playlistStatus: event.status === 'done'
+            ? 'プレイリストを更新しました'
+            : `プレイリストの更新に失敗しました: ${event.error}`,
+      });
+    });
+    this.eventSource = eventSource;
+  }
+
+  fetchTracksAndArtists() {
     const jwt = this.context;
+    // ETagで再検証させ、変更がなければ304とブラウザのキャッシュで済ませる
     fetch(BASE_URL + '/tracks_and_artists', {
-      headers: {Authorization: `Bearer ${jwt}`}
+      headers: {Authorization: `Bearer ${jwt}`},
+      cache: 'no-cache',
     })
     .then(response => {
       return response.json()
@@ -84,6 +197,7 @@ export class RankingPage extends React.Component<Props, State> {
     return (
         <div className="App">
           <ReplacePlaylistButton/>
+          <span>{this.state.playlistStatus}</span>
           <div style={{display: "flex"}}>
             <div>
               <table>
@@ -100,6 +214,7 @@ export class RankingPage extends React.Component<Props, State> {
                       rank={i + 1}
                       userTrack={userTrack}
                       updateParent={() => this.forceUpdate()}
+                      blockingQueue={this.getBlockingQueue()}
                       key={userTrack.id}/>
                 })}
                 </tbody>
@@ -117,6 +232,7 @@ export class RankingPage extends React.Component<Props, State> {
                   return <ArtistRow
                       userArtist={userArtist}
                       updateParent={() => this.forceUpdate()}
+                      blockingQueue={this.getBlockingQueue()}
                       key={userArtist.id}/>
                 })}
                 </tbody>